@@ -0,0 +1,30 @@
+"""activity raw_xml_hash
+
+The hash of every stored activity is filled in by one UPDATE, in the
+migration's transaction: every activity row is rewritten and locked
+until the migration commits. The digest is computed by postgres so the
+raw_xml text never leaves the server.
+
+Revision ID: 1f9a3c4d2b7e
+Revises: aaf932f393c
+Create Date: 2026-10-18 10:12:40.118342
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f9a3c4d2b7e'
+down_revision = 'aaf932f393c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('activity', sa.Column('raw_xml_hash', sa.Unicode(length=32), nullable=True))
+
+    op.execute(
+        "UPDATE activity SET raw_xml_hash = md5(convert_to(raw_xml, 'UTF8'))")
+
+
+def downgrade():
+    op.drop_column('activity', 'raw_xml_hash')
@@ -0,0 +1,24 @@
+"""resource sniff verdict
+
+Revision ID: 2b7d9c3e6f51
+Revises: 5e8b2f7c4a16
+Create Date: 2026-10-18 15:27:40.631207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b7d9c3e6f51'
+down_revision = '5e8b2f7c4a16'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('document_encoding', sa.Unicode(), nullable=True))
+    op.add_column('resource', sa.Column('document_rejected', sa.Unicode(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resource', 'document_rejected')
+    op.drop_column('resource', 'document_encoding')
@@ -0,0 +1,32 @@
+"""resource document_hash
+
+The hash of every stored document is filled in by one UPDATE, in the
+migration's transaction, so the resource rows are locked until the
+migration commits.
+
+Revision ID: 3a6b1e0c9d42
+Revises: 1f9a3c4d2b7e
+Create Date: 2026-10-18 11:02:07.551829
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a6b1e0c9d42'
+down_revision = '1f9a3c4d2b7e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('document_hash', sa.Unicode(length=32), nullable=True))
+    op.add_column('resource', sa.Column('skipped_parses', sa.Integer(), nullable=False,
+        server_default='0'))
+
+    op.execute("UPDATE resource SET document_hash = md5(document) "
+               "WHERE document IS NOT NULL")
+
+
+def downgrade():
+    op.drop_column('resource', 'skipped_parses')
+    op.drop_column('resource', 'document_hash')
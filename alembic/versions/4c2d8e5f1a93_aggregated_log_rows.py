@@ -0,0 +1,25 @@
+"""aggregated log rows
+
+Revision ID: 4c2d8e5f1a93
+Revises: 3a6b1e0c9d42
+Create Date: 2026-10-18 12:20:51.904417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c2d8e5f1a93'
+down_revision = '3a6b1e0c9d42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('log', sa.Column('occurrences', sa.Integer(), nullable=False,
+        server_default='1'))
+    op.add_column('log', sa.Column('sample_ids', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('log', 'sample_ids')
+    op.drop_column('log', 'occurrences')
@@ -0,0 +1,29 @@
+"""compressed raw xml
+
+Activity.raw_xml becomes bytea, to hold compressed values. Values are
+converted as they are, uncompressed; `iati compression recompress`
+compresses them afterwards. Before downgrading, run it with --level 0
+to store them uncompressed again.
+
+Revision ID: 4c8e2a6d1f93
+Revises: 9d4e1a7c3b25
+Create Date: 2026-10-18 21:04:12.863512
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c8e2a6d1f93'
+down_revision = '9d4e1a7c3b25'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("ALTER TABLE activity ALTER COLUMN raw_xml TYPE bytea "
+               "USING convert_to(raw_xml, 'UTF8')")
+
+
+def downgrade():
+    op.execute("ALTER TABLE activity ALTER COLUMN raw_xml TYPE text "
+               "USING convert_from(raw_xml, 'UTF8')")
@@ -0,0 +1,26 @@
+"""resource parse stats
+
+Revision ID: 5e8b2f7c4a16
+Revises: 4c2d8e5f1a93
+Create Date: 2026-10-18 14:03:12.218644
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e8b2f7c4a16'
+down_revision = '4c2d8e5f1a93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('activity_count', sa.Integer(), nullable=True))
+    op.add_column('resource', sa.Column('warning_count', sa.Integer(), nullable=True))
+    op.add_column('resource', sa.Column('parse_seconds', sa.Float(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resource', 'parse_seconds')
+    op.drop_column('resource', 'warning_count')
+    op.drop_column('resource', 'activity_count')
@@ -0,0 +1,22 @@
+"""resource parse profile
+
+Revision ID: 6a1f3d8b2c70
+Revises: 2b7d9c3e6f51
+Create Date: 2026-10-18 16:48:05.302914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1f3d8b2c70'
+down_revision = '2b7d9c3e6f51'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('parse_profile', sa.Unicode(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resource', 'parse_profile')
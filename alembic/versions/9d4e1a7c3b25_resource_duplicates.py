@@ -0,0 +1,24 @@
+"""resource duplicates
+
+Revision ID: 9d4e1a7c3b25
+Revises: 6a1f3d8b2c70
+Create Date: 2026-10-18 18:12:40.517203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d4e1a7c3b25'
+down_revision = '6a1f3d8b2c70'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('duplicate_count', sa.Integer(), nullable=True))
+    op.add_column('resource', sa.Column('duplicates', sa.Unicode(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('resource', 'duplicates')
+    op.drop_column('resource', 'duplicate_count')
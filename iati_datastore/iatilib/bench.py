@@ -0,0 +1,365 @@
+"""
+Benchmarks, run with `iati bench <name>`.
+
+The ingest benchmarks use the configured database. Everything they write
+is rolled back, so they can be pointed at a populated database, but the
+timings include contention with whatever else is using it.
+"""
+import datetime
+import glob
+import os
+import resource
+import tempfile
+import time
+import timeit
+
+from dateutil.parser import parse as parse_date
+from flask.ext.script import Command, Manager, Option
+from lxml import etree as ET
+
+from iatilib import db, ingest, orgcache, parse, synthetic
+
+manager = Manager(usage="Benchmarks")
+
+
+def _reset_session():
+    db.session.rollback()
+    db.session._unique_cache = {}
+    orgcache.cache.clear()
+
+
+def ingest_rows_per_second(filename, bulk):
+    """
+    Time writing the activities of `filename` with the ORM or BulkWriter.
+
+    Parsing is done up front and not included. Returns (rows, seconds).
+    """
+    _reset_session()
+    activities = list(parse.document(filename))
+    try:
+        start = time.time()
+        if bulk:
+            writer = ingest.BulkWriter()
+            writer.add_all(activities)
+            rows = writer.rows
+        else:
+            db.session.add_all(activities)
+            db.session.flush()
+            rows = None
+        return rows, time.time() - start
+    finally:
+        _reset_session()
+
+
+@manager.option('-r', '--repeat', action="store", type=int, default=3)
+@manager.option('filename')
+def ingest_rows(filename, repeat=3):
+    "Compare ORM and bulk ingest rows/s for a file"
+    rows = None
+    for bulk in (True, False):
+        name = "bulk" if bulk else "orm"
+        best = None
+        for _ in range(repeat):
+            counted, seconds = ingest_rows_per_second(filename, bulk)
+            rows = counted or rows
+            best = seconds if best is None else min(best, seconds)
+        print "{0:5} {1} rows in {2:.2f}s, {3:.0f} rows/s".format(
+            name, rows, best, rows / best)
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'test', 'fixtures')
+
+
+def fixture_dates():
+    """Every date attribute and text in the test fixtures, in document order"""
+    dates = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, '*.xml'))):
+        try:
+            tree = ET.parse(filename)
+        except ET.XMLSyntaxError:
+            continue
+        dates.extend(tree.xpath(
+            "//@iso-date | //@value-date | //@last-updated-datetime"))
+    return [unicode(d) for d in dates if d]
+
+
+@manager.option('-r', '--repeat', action="store", type=int, default=5)
+def dates(repeat=5):
+    "Time iati_date against dateutil over the fixture dates"
+    values = fixture_dates()
+
+    def dateutil():
+        for value in values:
+            try:
+                parse_date(value, fuzzy=True).date()
+            except ValueError:
+                pass
+
+    def cold():
+        for value in values:
+            parse._date_cache.clear()
+            try:
+                parse.iati_date(value)
+            except parse.InvalidDateError:
+                pass
+
+    def cached():
+        for value in values:
+            try:
+                parse.iati_date(value)
+            except parse.InvalidDateError:
+                pass
+
+    print "{0} dates, {1} distinct".format(len(values), len(set(values)))
+    for name, func in [("dateutil", dateutil), ("iati_date uncached", cold),
+                       ("iati_date", cached)]:
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print "{0:20} {1:8.1f} us/date".format(name, best * 1e6 / len(values))
+
+
+def insert_transactions(count):
+    """
+    Insert `count` transactions with a mix of known and unknown codes.
+
+    Returns the identifier of the activity they belong to.
+    """
+    from iatilib import codelists
+    from iatilib.model import Activity, Transaction
+    identifier = u"bench-transactions"
+    db.session.execute(Activity.__table__.insert(), [{
+        "iati_identifier": identifier,
+        "raw_xml": u"<iati-activity/>",
+        "last_change_datetime": datetime.datetime.now(),
+    }])
+    codes = [
+        ("type", codelists.TransactionType),
+        ("value_currency", codelists.Currency),
+        ("flow_type", codelists.FlowType),
+        ("finance_type", codelists.FinanceType),
+        ("aid_type", codelists.AidType),
+        ("tied_status", codelists.TiedStatus),
+        ("disbursement_channel", codelists.DisbursementChannel),
+    ]
+    values = dict((key, sorted(cl.values()) + [u"X-UNKNOWN"])
+                  for key, cl in codes)
+    rows = []
+    for i in xrange(count):
+        row = {"activity_id": identifier, "value_amount": i}
+        for key, choices in values.items():
+            row[key] = choices[i % len(choices)]
+        rows.append(row)
+        if len(rows) == ingest.BATCH_SIZE:
+            db.session.execute(Transaction.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Transaction.__table__.insert(), rows)
+    return identifier
+
+
+@manager.option('-r', '--repeat', action="store", type=int, default=3)
+@manager.option('-n', '--count', action="store", type=int, default=100000)
+def load_transactions(count=100000, repeat=3):
+    "Time loading transactions through the ORM, exercising the enum columns"
+    from iatilib.model import Transaction
+    _reset_session()
+    try:
+        identifier = insert_transactions(count)
+
+        def load():
+            db.session.query(Transaction)\
+                .filter_by(activity_id=identifier).all()
+            db.session.expunge_all()
+
+        best = min(timeit.repeat(load, number=1, repeat=repeat))
+        print "{0} transactions in {1:.2f}s, {2:.0f} rows/s".format(
+            count, best, count / best)
+    finally:
+        _reset_session()
+
+
+def rss_mb():
+    "Resident set size of this process, in MB"
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except IOError:
+        return peak_rss_mb()
+    return pages * resource.getpagesize() / 1024.0 ** 2
+
+
+def peak_rss_mb():
+    "The most this process has had resident, in MB"
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def time_document(filename, in_memory=False):
+    """
+    Parse `filename` with parse.document, streaming it from the file or
+    reading it into memory first as the crawler does.
+
+    Returns the finished parse.Document. Organisations it inserts are
+    rolled back.
+    """
+    _reset_session()
+    try:
+        with open(filename, 'rb') as f:
+            document = parse.document(f.read() if in_memory else f)
+            for _ in document:
+                pass
+        return document
+    finally:
+        _reset_session()
+
+
+class ParseBenchmark(Command):
+    """
+    Time parse.document over a generated IATI file of --size bytes, or
+    over FILENAME. Peak memory is the process's high water mark, so run
+    one size per process to compare sizes.
+    """
+
+    option_list = (
+        Option('filename', nargs='?',
+               help="parse this file instead of a generated one"),
+        Option('-s', '--size', default='10MB',
+               help="size of the generated file, e.g. 1MB, 100MB, 1GB"),
+        Option('-v', '--iati-version', dest='version', default='2.03',
+               help="IATI version of the generated file, 1.x or 2.x"),
+        Option('--seed', type=int, default=0),
+        Option('-k', '--keep', metavar='PATH',
+               help="write the generated file to PATH and keep it"),
+        Option('-m', '--in-memory', action='store_true', dest='in_memory',
+               help="read the document into memory before parsing"),
+        Option('-r', '--repeat', type=int, default=1),
+        Option('-p', '--profile', action='store_true',
+               help="also print the time spent in each field extractor"),
+    )
+
+    def run(self, filename=None, size='10MB', version='2.03', seed=0,
+            keep=None, in_memory=False, repeat=1, profile=False):
+        generated = None
+        if filename is None:
+            if keep:
+                filename = keep
+            else:
+                fd, filename = tempfile.mkstemp(suffix='.xml')
+                os.close(fd)
+                generated = filename
+            start = time.time()
+            with open(filename, 'wb') as f:
+                count = synthetic.write(f, synthetic.parse_size(size), version, seed)
+            print "Generated {0} activities, {1:.1f} MB of IATI {2} in {3:.1f}s".format(
+                count, os.path.getsize(filename) / 1024.0 ** 2, version,
+                time.time() - start)
+        try:
+            self.report(filename, in_memory, repeat)
+            if profile:
+                with parse.profiling() as field_profile:
+                    time_document(filename, in_memory)
+                print field_profile.report()
+        finally:
+            if generated:
+                os.remove(generated)
+
+    def report(self, filename, in_memory, repeat):
+        mb = os.path.getsize(filename) / 1024.0 ** 2
+        baseline = rss_mb()
+        best = None
+        for _ in range(repeat):
+            document = time_document(filename, in_memory)
+            seconds = document.seconds
+            best = seconds if best is None else min(best, seconds)
+            print "{0} activities, {1} warnings, {2:.1f}s: {3:.0f} activities/s, {4:.2f} MB/s".format(
+                document.activity_count, document.warning_count, seconds,
+                document.activity_count / seconds, mb / seconds)
+        if repeat > 1:
+            print "best {0:.1f}s: {1:.0f} activities/s, {2:.2f} MB/s".format(
+                best, document.activity_count / best, mb / best)
+        peak = peak_rss_mb()
+        print "peak memory {0:.0f} MB, {1:.0f} MB above the {2:.0f} MB before parsing".format(
+            peak, max(peak - baseline, 0), baseline)
+
+
+manager.add_command('parse', ParseBenchmark())
+
+
+BENCH_RESOURCE = u"http://bench.invalid/swap.xml"
+
+
+def stage_document(filename, resource_url):
+    """
+    Stage every activity of `filename` for the resource and swap them in.
+    Returns the StagingWriter.
+    """
+    writer = ingest.StagingWriter(resource_url)
+    with open(filename, 'rb') as f:
+        for activity in parse.document(f):
+            activity.resource_url = resource_url
+            writer.seen(activity.iati_identifier)
+            writer.add(activity)
+    writer.swap()
+    return writer
+
+
+def time_deletes(resource_url):
+    """
+    Time deleting the resource's activities with ON DELETE CASCADE and
+    with ingest.delete_activities, rolling each back.
+
+    Returns (cascade seconds, set based seconds).
+    """
+    from iatilib.model import Activity
+    connection = db.session.connection()
+    activities = Activity.__table__.c.resource_url == resource_url
+    timings = []
+    for delete in [
+            lambda: connection.execute(
+                Activity.__table__.delete().where(activities)),
+            lambda: ingest.delete_activities(connection, activities)]:
+        savepoint = connection.begin_nested()
+        try:
+            start = time.time()
+            delete()
+            timings.append(time.time() - start)
+        finally:
+            savepoint.rollback()
+    return timings
+
+
+@manager.option('-r', '--repeat', action="store", type=int, default=3)
+@manager.option('-v', '--iati-version', action="store", dest="version", default='2.03')
+@manager.option('-n', '--count', action="store", type=int, default=20000)
+def swap(count=20000, version='2.03', repeat=3):
+    "Time the delete and insert phases of replacing a resource's activities"
+    from iatilib.model import Dataset, Resource
+    fd, filename = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            synthetic.write(f, version=version, count=count)
+        _reset_session()
+        now = datetime.datetime.utcnow()
+        db.session.add(Dataset(name=u"bench-swap", first_seen=now, last_seen=now))
+        db.session.add(Resource(url=BENCH_RESOURCE, dataset_id=u"bench-swap"))
+        db.session.flush()
+
+        start = time.time()
+        writer = stage_document(filename, BENCH_RESOURCE)
+        print "Parsed and staged {0} activities, {1} rows in {2:.1f}s".format(
+            count, writer.rows, time.time() - start)
+        print "insert phase {0:.2f}s".format(writer.insert_seconds)
+        rows = dict(
+            (table.name, db.session.query(table).count())
+            for table in ingest.activity_tables())
+        print ", ".join("{0} {1}".format(n, rows[n]) for n in sorted(rows))
+
+        cascade = staged = None
+        for _ in range(repeat):
+            c, s = time_deletes(BENCH_RESOURCE)
+            cascade = c if cascade is None else min(cascade, c)
+            staged = s if staged is None else min(staged, s)
+        print "delete phase, ON DELETE CASCADE {0:.2f}s, statement per table {1:.2f}s".format(
+            cascade, staged)
+    finally:
+        _reset_session()
+        os.remove(filename)
@@ -3,7 +3,9 @@ Load IATI codelists into enums.
 
 IATI define a farly large number of codelists. These are maintained as
 CSV files, and the csv files are checked-in as part of the project.
-This module build enum types for all the codelists at import time.
+This module build enum types for all the codelists at import time, from
+a pre-built cache when it is up to date (see build_cache) and from the CSV
+files otherwise.
 
 For more info on the enum type, see:
 http://techspot.zzzeek.org/2011/01/14/the-enum-recipe/
@@ -11,6 +13,7 @@ http://techspot.zzzeek.org/2011/01/14/the-enum-recipe/
 
 import os
 import codecs
+import marshal
 import warnings
 import copy
 
@@ -69,18 +72,79 @@ def codelist_reader(itr):
     for line in itr:
         yield line[:2]
 
+
+# Pre-built codelists, written by "iati build_codelist_cache". Reading it
+# avoids parsing and transliterating every CSV file at import time.
+CACHE_FILE = os.path.join(data_dir, "codelists.cache")
+CACHE_VERSION = 1
+
+
+def csv_filename(major_version, name):
+    return os.path.join(data_dir, major_version, "%s.csv" % name)
+
+
+def read_csv(major_version, name):
+    "Enum members for codelist `name`, as {identifier: (code, name)}"
+    with codecs.open(csv_filename(major_version, name)) as cl_file:
+        reader = codelist_reader(csv.reader(cl_file, encoding="utf-8"))
+        return {ident(name): (code, name) for code, name in reader}
+
+
+def fingerprint():
+    """
+    Size and mtime of every codelist CSV file. The cache is only used if
+    this matches the fingerprint it was built with.
+    """
+    stats = []
+    for major_version in sorted(urls):
+        for name in sorted(urls[major_version]):
+            try:
+                st = os.stat(csv_filename(major_version, name))
+            except OSError:
+                return None
+            stats.append((major_version, name, st.st_size, int(st.st_mtime)))
+    return stats
+
+
+def build_cache(filename=CACHE_FILE):
+    "Write the codelists from the CSV files to `filename`"
+    data = dict(
+        (major_version, dict(
+            (name, read_csv(major_version, name))
+            for name in urls[major_version]))
+        for major_version in urls)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as cache_file:
+        marshal.dump((CACHE_VERSION, fingerprint(), data), cache_file)
+    os.rename(tmp, filename)
+
+
+def read_cache(filename=CACHE_FILE):
+    "The codelists from `filename`, or None if it is missing or stale"
+    try:
+        with open(filename, "rb") as cache_file:
+            version, built_from, data = marshal.load(cache_file)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != CACHE_VERSION or built_from != fingerprint():
+        return None
+    return data
+
+
+cached = read_cache()
+
 by_major_version = {}
 for major_version in ['1', '2']:
     by_major_version[major_version] = type('Codelists'+major_version, (object,), {})
     for name in urls[major_version].keys():
         try:
-            with codecs.open(os.path.join(data_dir, major_version, "%s.csv" % name)) as cl_file:
-                reader = codelist_reader(csv.reader(cl_file, encoding="utf-8"))
-                enums = {ident(name): (code, name) for code, name in reader}
-                codelist = type(name, (DeclEnum,), enums)
-                setattr(by_major_version[major_version], name, codelist)
-                if major_version == '1':
-                    globals()[name] = codelist
+            if cached is not None:
+                enums = cached[major_version][name]
+            else:
+                enums = read_csv(major_version, name)
+            codelist = type(name, (DeclEnum,), enums)
+            setattr(by_major_version[major_version], name, codelist)
+            if major_version == '1':
+                globals()[name] = codelist
         except IOError, exc:
             warnings.warn(str(exc))
-
@@ -1,12 +1,21 @@
 # http://techspot.zzzeek.org/2011/01/14/the-enum-recipe/
 from sqlalchemy.types import SchemaType, TypeDecorator, UnicodeText
 import re
-from requests.structures import CaseInsensitiveDict
+
+# Distinct unknown codes remembered per codelist before the intern table
+# is emptied, so junk data can't grow it without limit.
+UNKNOWN_CACHE_SIZE = 1024
+
+
+def _from_string(cls_, value):
+    return cls_.from_string(value)
 
 
 class EnumSymbol(object):
     """Define a fixed symbol tied to a parent class."""
 
+    __slots__ = ('cls_', 'name', 'value', 'description')
+
     def __init__(self, cls_, name, value, description):
         self.cls_ = cls_
         self.name = name
@@ -29,6 +38,8 @@ class EnumSymbol(object):
     def __reduce__(self):
         """Allow unpickling to return the symbol
         linked to the DeclEnum class."""
+        if self.name is None:
+            return _from_string, (self.cls_, self.value)
         return getattr, (self.cls_, self.name)
 
     def __iter__(self):
@@ -47,6 +58,11 @@ class EnumMeta(type):
             if isinstance(v, tuple):
                 sym = reg[v[0]] = EnumSymbol(cls, k, *v)
                 setattr(cls, k, sym)
+        # Codes are matched case insensitively, the exact codes are kept
+        # alongside so the common case needs no lower().
+        cls._lookup = dict((code.lower(), sym) for code, sym in reg.items())
+        cls._lookup.update(reg)
+        cls._unknown = {}
         return type.__init__(cls, classname, bases, dict_)
 
     def __iter__(cls):
@@ -57,14 +73,25 @@ class DeclEnum(object):
     """Declarative enumeration."""
 
     __metaclass__ = EnumMeta
-    _reg = CaseInsensitiveDict()
+    _reg = {}
 
     @classmethod
     def from_string(cls, value):
         try:
-            return cls._reg[value]
-        except (KeyError, AttributeError):
+            sym = cls._lookup.get(value) or cls._unknown.get(value)
+        except TypeError:
             return EnumSymbol(cls, None, value, None)
+        if sym is not None:
+            return sym
+        try:
+            sym = cls._lookup.get(value.lower())
+        except AttributeError:
+            pass
+        if sym is None:
+            if len(cls._unknown) >= UNKNOWN_CACHE_SIZE:
+                cls._unknown.clear()
+            sym = cls._unknown[value] = EnumSymbol(cls, None, value, None)
+        return sym
 
     @classmethod
     def values(cls):
@@ -93,4 +120,21 @@ class DeclEnumType(TypeDecorator):
     def process_result_value(self, value, dialect):
         if value is None:
             return None
-        return self.enum.from_string(value.strip())
+        return self.enum._lookup.get(value) or \
+            self.enum.from_string(value.strip())
+
+    def result_processor(self, dialect, coltype):
+        # Runs for every enum column of every row loaded, so known codes
+        # are looked up here directly rather than through the two calls
+        # TypeDecorator would wrap around process_result_value.
+        lookup = self.enum._lookup.get
+        from_string = self.enum.from_string
+        impl_processor = self.impl.result_processor(dialect, coltype)
+
+        def process(value):
+            if impl_processor:
+                value = impl_processor(value)
+            if value is None:
+                return None
+            return lookup(value) or from_string(value.strip())
+        return process
@@ -0,0 +1,210 @@
+"""
+Compressed columns for documents and raw activity xml.
+
+Values of CompressedBinary and CompressedText columns are stored zlib
+compressed at COMPRESS_LEVEL, behind a marker XML can't start with (a NUL
+byte and "z" for zlib), and decompressed when loaded. Values without the
+marker and a valid zlib header after it, or that don't decompress, are
+read as they are, so rows written before compression, or at level 0, need
+no conversion, and values too small to gain from compression are left
+alone. A UTF-16 document starting "z" has a NUL where the zlib header
+would be, so is never taken for a compressed one.
+
+Activity.raw_xml is deferred, so decompressed only when it is used: the
+XML and JSON serializers ask for it with the activities.
+
+`iati compression recompress` rewrites stored values at the current
+level a batch at a time, and `iati compression report` gives the size of
+the tables and the time taken by the activity API.
+"""
+import os
+import time
+import zlib
+
+from flask import current_app
+from flask.ext.script import Manager
+import sqlalchemy as sa
+from sqlalchemy.types import TypeDecorator, LargeBinary
+
+from iatilib import db
+
+# zlib level values are compressed at; 0 stores them uncompressed
+COMPRESS_LEVEL = int(os.environ.get('IATI_COMPRESS_LEVEL', 6))
+
+ZLIB = '\x00z'
+
+
+def compress(data, level=None):
+    "`data`, a str, as it is stored at `level`, by default COMPRESS_LEVEL"
+    if level is None:
+        level = COMPRESS_LEVEL
+    if is_compressed(data):
+        # stored already
+        return data
+    if level:
+        compressed = ZLIB + zlib.compress(data, level)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+
+def decompress(value):
+    if is_compressed(value):
+        try:
+            return zlib.decompress(value[len(ZLIB):])
+        except zlib.error:
+            pass  # only looked compressed
+    return value
+
+
+def is_compressed(value):
+    "Whether `value` has the marker followed by a zlib header"
+    if len(value) < len(ZLIB) + 2 or not value.startswith(ZLIB):
+        return False
+    cmf, flg = ord(value[len(ZLIB)]), ord(value[len(ZLIB) + 1])
+    # deflate, a valid header check and no preset dictionary
+    return cmf & 0x0f == 8 and (cmf * 256 + flg) % 31 == 0 and not flg & 0x20
+
+
+class CompressedBinary(TypeDecorator):
+    "A str stored compressed"
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # psycopg2 returns a buffer
+        return decompress(str(value))
+
+
+class CompressedText(CompressedBinary):
+    "A unicode stored utf-8 encoded and compressed"
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress(value.encode('utf-8'))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress(str(value)).decode('utf-8')
+
+
+def compressed_columns():
+    "(table, primary key column, column) for each compressed column"
+    for table in db.metadata.sorted_tables:
+        for column in table.columns:
+            if isinstance(column.type, CompressedBinary):
+                yield table, table.primary_key.columns.values()[0], column
+
+
+def recompress_column(table, key, column, level=None, batch=1000,
+                      session=None):
+    """
+    Rewrite the values of `column` compressed at `level`, `batch` rows per
+    commit, taking the rows in `key` order. Returns the rows rewritten
+    and the bytes stored before and after.
+    """
+    if level is None:
+        level = COMPRESS_LEVEL
+    session = session or db.session
+    # the stored bytes, not the values the column type makes of them
+    stored = sa.type_coerce(column, LargeBinary)
+    update = table.update().where(key == sa.bindparam('_key')).values(
+        {column.name: sa.bindparam('_value', type_=LargeBinary)})
+    rewritten = before = after = 0
+    last = None
+    while True:
+        query = sa.select([key, stored]).where(column != None)\
+            .order_by(key).limit(batch)
+        if last is not None:
+            query = query.where(key > last)
+        rows = session.execute(query).fetchall()
+        if not rows:
+            break
+        changed = []
+        for row_key, value in rows:
+            value = str(value)
+            new = compress(decompress(value), level)
+            before += len(value)
+            after += len(new)
+            if new != value:
+                changed.append({'_key': row_key, '_value': new})
+        if changed:
+            session.execute(update, changed)
+        session.commit()
+        rewritten += len(changed)
+        last = rows[-1][0]
+    return rewritten, before, after
+
+
+def table_sizes(session=None):
+    "Bytes on disk of each table with compressed columns, None if unknown"
+    session = session or db.session
+    sizes = {}
+    for table in set(t for t, _, _ in compressed_columns()):
+        if session.bind.dialect.name == 'postgresql':
+            sizes[table.name] = session.execute(
+                "SELECT pg_total_relation_size(:name)",
+                {"name": table.name}).scalar()
+        else:
+            sizes[table.name] = None
+    return sizes
+
+
+def api_latency(path, repeat=10):
+    "Median seconds to GET `path` from the app"
+    client = current_app.test_client()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        resp = client.get(path)
+        resp.data
+        times.append(time.time() - start)
+        if resp.status_code != 200:
+            raise ValueError("%s returned %s" % (path, resp.status_code))
+    return sorted(times)[len(times) // 2]
+
+
+manager = Manager(usage="Compressed columns")
+
+
+@manager.option('-l', '--level', action="store", type=int,
+                help="zlib level, 0 to store uncompressed, "
+                     "defaults to IATI_COMPRESS_LEVEL")
+@manager.option('-n', '--batch', action="store", type=int, default=1000,
+                help="rows rewritten per commit")
+def recompress(level=None, batch=1000):
+    "Rewrite compressed columns at the current level"
+    if level is None:
+        level = COMPRESS_LEVEL
+    for table, key, column in compressed_columns():
+        rewritten, before, after = recompress_column(
+            table, key, column, level, batch)
+        print "%s.%s: rewrote %d rows, %d bytes stored before, %d after" % (
+            table.name, column.name, rewritten, before, after)
+
+
+API_PATHS = [
+    "/api/1/access/activity.xml?limit=50",
+    "/api/1/access/activity?limit=50",
+    "/api/1/access/activity.csv?limit=50",
+]
+
+
+@manager.option('-r', '--repeat', action="store", type=int, default=10)
+def report(repeat=10):
+    "Table sizes, and the time taken by the activity API"
+    for name, size in sorted(table_sizes().items()):
+        if size is None:
+            print "%-10s size unknown" % name
+        else:
+            print "%-10s %8.1f MB" % (name, size / 1024.0 / 1024)
+    for path in API_PATHS:
+        print "%-40s %7.1f ms" % (path, api_latency(path, repeat) * 1000)
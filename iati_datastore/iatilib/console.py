@@ -1,5 +1,6 @@
 import os
 import codecs
+import importlib
 import logging
 import datetime as dt
 
@@ -8,13 +9,31 @@ from flask.ext.script import Manager
 from sqlalchemy import not_
 
 from iatilib.frontend import create_app
-from iatilib import parse, codelists, model, db, redis
-from iatilib.crawler import manager as crawler_manager
-from iatilib.queue import manager as queue_manager
+from iatilib import ingest, parse, codelists, model, db, redis
+
+
+class LazyManager(Manager):
+    """
+    Sub-manager for the `manager` of `module`, which is only imported when
+    one of its commands is run. Keeps the crawler's registry client and the
+    queue out of every other command's start-up.
+    """
+    def __init__(self, module, usage):
+        super(LazyManager, self).__init__(usage=usage)
+        self.module = module
+
+    def run(self, commands=None, default_command=None):
+        sub_manager = importlib.import_module(self.module).manager
+        sub_manager.parent = self.parent
+        return sub_manager.run(commands, default_command)
+
 
 manager = Manager(create_app(DEBUG=False))
-manager.add_command("crawl", crawler_manager)
-manager.add_command("queue", queue_manager)
+manager.add_command("crawl", LazyManager("iatilib.crawler", "Crawl IATI registry"))
+manager.add_command("queue", LazyManager("iatilib.queue", "Background task queue"))
+manager.add_command("bench", LazyManager("iatilib.bench", "Benchmarks"))
+manager.add_command("documents", LazyManager("iatilib.docstore", "Document store"))
+manager.add_command("compression", LazyManager("iatilib.compression", "Compressed columns"))
 
 
 @manager.shell
@@ -40,6 +59,13 @@ def download_codelists():
             assert len(resp.text) > 0, "Response is empty"
             with codecs.open(filename, "w", encoding=resp.encoding) as cl:
                 cl.write(resp.text)
+    build_codelist_cache()
+
+
+@manager.command
+def build_codelist_cache():
+    "Pre-build the codelists from the CSV files for faster start-up"
+    codelists.build_cache()
 
 
 @manager.command
@@ -60,15 +86,34 @@ def cleanup():
 @manager.option(
         '-s', '--fail-on-spec-errors',
         action="store_true", dest="fail_spec")
+@manager.option(
+        '-b', '--bulk', action="store_true",
+        help="write activities with bulk COPY rather than the ORM")
+@manager.option(
+        '-c', '--chunk-size', action="store", type=int, dest="chunk_size",
+        help="stream the file and commit every this many activities")
+@manager.option(
+        '-p', '--profile', action="store_true", default=None,
+        help="print the time spent in each field extractor")
 @manager.option('-v', '--verbose', action="store_true")
 @manager.option('filenames', nargs='+')
-def parse_file(filenames, verbose=False, fail_xml=False, fail_spec=False):
+def parse_file(filenames, verbose=False, fail_xml=False, fail_spec=False,
+               bulk=False, chunk_size=None, profile=None):
+    if profile is None:
+        profile = parse.PARSE_PROFILE
     for filename in filenames:
         if verbose:
             print "Parsing", filename
         try:
-            db.session.add_all(parse.document(filename))
-            db.session.commit()
+            with parse.profiling(profile) as field_profile:
+                if chunk_size:
+                    with open(filename, 'rb') as source:
+                        ingest.store(parse.document(source), bulk, chunk_size)
+                else:
+                    ingest.store(parse.document(filename), bulk, chunk_size)
+            if field_profile is not None:
+                print "Slowest fields parsing", filename
+                print field_profile.report(20)
         except parse.ParserError, exc:
             logging.error("Could not parse file %r", filename)
             db.session.rollback()
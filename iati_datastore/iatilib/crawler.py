@@ -1,25 +1,36 @@
 import datetime
 import hashlib
+import json
 import logging
+import os
 import traceback
 
 import sqlalchemy as sa
-import requests
 import ckanapi
 from dateutil.parser import parse as date_parser
 from .queue import get_queue
 from werkzeug.http import http_date
 
-from iatilib import db, parse
+from iatilib import (
+    db, docstore, download, fetcher, ingest, loghandlers, orgcache, parse,
+    sessions)
 from iatilib.model import Dataset, Resource, Activity, Log, DeletedActivity
 from iatilib.loghandlers import DatasetMessage as _
+from iatilib.duplicates import Duplicates, DuplicateIdentifiers, POLICIES
 
 log = logging.getLogger("crawler")
 
 CKAN_WEB_BASE = 'https://iatiregistry.org/dataset/%s'
 CKAN_API = 'https://iatiregistry.org'
 
-registry = ckanapi.RemoteCKAN(CKAN_API, get_only=True)
+# Write parsed activities with iatilib.ingest.BulkWriter instead of the ORM
+BULK_INGEST = bool(os.environ.get('IATI_BULK_INGEST'))
+# Commit parsed activities every this many activities to bound memory; 0 commits once per resource
+PARSE_CHUNK_SIZE = int(os.environ.get('IATI_PARSE_CHUNK_SIZE', 0))
+# Replace a resource's activities through staging tables (iatilib.ingest.StagingWriter)
+SWAP_INGEST = bool(os.environ.get('IATI_SWAP_INGEST'))
+
+registry = ckanapi.RemoteCKAN(CKAN_API, get_only=True, session=sessions.current)
 
 
 class CouldNotFetchPackageList(Exception):
@@ -119,7 +130,11 @@ def delete_datasets(datasets):
             deleted_activities.append(DeletedActivity(iati_identifier=a.iati_identifier, deletion_date=now))
     db.session.add_all(deleted_activities)
     db.session.commit()
+    resource_urls = [url for url, in db.session.query(Resource.url).filter(
+        Resource.dataset_id.in_(datasets))]
     deleted = deleted_datasets.delete(synchronize_session='fetch')
+    for url in resource_urls:
+        download.remove(url)
     log.info("Deleted {0} datasets".format(deleted))
     return deleted
 
@@ -156,103 +171,269 @@ def fetch_dataset_metadata(dataset):
 
 def fetch_resource(resource):
     '''
-    Gets the resource using the request library and sets the times of last successful update based on the status code.
+    Gets the resource over the pooled session and sets the times of last successful update based on the status code.
+    The document is streamed to disk if IATI_DOWNLOAD_DIR is set (see iatilib.download).
     :param resource:
     :return:
     '''
+    get = download.get if download.streaming() else sessions.get
+    resp = get(resource.url, headers=request_headers(resource))
+    return record_response(resource, resp)
+
+
+def fetch_resources(resources, threads=None, per_host=None):
+    '''
+    Fetches many resources at once with a fetcher.Fetcher, recording each response as fetch_resource does and
+    committing it as it arrives.
+    :param resources:
+    :param threads: downloads at a time, defaults to IATI_FETCH_THREADS
+    :param per_host: downloads at a time from one host, defaults to IATI_FETCH_PER_HOST
+    :return: (resource, exception) for each resource, the exception None if it was fetched
+    '''
+    by_url = dict((r.url, r) for r in resources)
+    engine = fetcher.Fetcher(
+        threads or fetcher.FETCH_THREADS, per_host or fetcher.FETCH_PER_HOST,
+        download.get if download.streaming() else None)
+    for result in engine.fetch(
+            (url, url, request_headers(r)) for url, r in by_url.items()):
+        resource = by_url[result.key]
+        if result.error is None:
+            record_response(resource, result.response)
+            db.session.commit()
+        yield resource, result.error
+    log.info(
+            "HTTP connections: %(requests)d requests, %(connections)d opened, "
+            "%(reused)d reused", sessions.stats.stats())
+
+
+def request_headers(resource):
+    "The conditional GET headers for a resource fetched before"
     headers = {}
     if resource.last_succ:
         headers['If-Modified-Since'] = http_date(resource.last_succ)
     if resource.etag:
         headers["If-None-Match"] = resource.etag.encode('ascii')
-    resp = requests.get(resource.url, headers=headers)
+    return headers
+
+
+def record_response(resource, resp):
+    """
+    Record the response to fetching a resource on it, a requests.Response
+    or a download.SpooledResponse.
+    """
+    spooled = isinstance(resp, download.SpooledResponse)
     resource.last_status_code = resp.status_code
     resource.last_fetch = datetime.datetime.utcnow()
-    if resp.status_code == 200:
-        resource.document = resp.content
+    if spooled and resp.too_large:
+        log.warn("Not storing document of %s: %s", resource.url, resp.too_large)
+        resource.document_rejected = unicode(resp.too_large)
+    elif resp.status_code == 200:
         if "etag" in resp.headers:
             resource.etag = resp.headers.get('etag').decode('ascii')
         else:
             resource.etag = None
         resource.last_succ = datetime.datetime.utcnow()
-        resource.last_parsed = None
-        resource.last_parse_error = None
+        if spooled:
+            document_hash = resp.md5
+        else:
+            document_hash = unicode(hashlib.md5(resp.content).hexdigest())
+        if document_hash == resource.document_hash and resource.last_parsed:
+            # many servers ignore If-Modified-Since, a byte-identical
+            # document that parsed last time needs no new parse.
+            resource.skipped_parses = (resource.skipped_parses or 0) + 1
+            if spooled:
+                resp.discard()
+        else:
+            keep_document(resource, resp, document_hash)
+            resource.document_hash = document_hash
+            resource.last_parsed = None
+            resource.last_parse_error = None
+            resource.document_rejected = None
     if resp.status_code == 304:
         resource.last_succ = datetime.datetime.utcnow()
     db.session.add(resource)
     return resource
 
 
-def check_for_duplicates(activities):
-    if activities:
-        dup_activity = Activity.query.filter(
-                Activity.iati_identifier.in_(
-                        a.iati_identifier for a in activities
-                )
-        )
-        for db_activity in dup_activity:
-            res_activity = next(
-                    a for a in activities
-                    if a.iati_identifier == db_activity.iati_identifier
-            )
-            activities.remove(res_activity)
-            db.session.expunge(res_activity)
-    return activities
+def _end_chunk(writer, chunk, commit=True):
+    if writer is not None:
+        writer.flush()
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    for activity in chunk:
+        db.session.expunge(activity)
+    del chunk[:]
+
+
+def _store(activities, writer, chunk):
+    if writer is not None:
+        for activity in activities:
+            writer.add(activity)
+    else:
+        db.session.add_all(activities)
+        chunk.extend(activities)
+        db.session.flush()
+    return len(activities)
+
 
+def parse_activity(new_identifiers, old_xml, resource, bulk=False,
+                   chunk_size=None, swap=False, duplicates=None, source=None):
+    """
+    Store the activities of a resource document, leaving those whose raw
+    xml and document version are unchanged since the last parse as they
+    are in the database and deleting those no longer in the document.
+
+    With chunk_size, the session is committed and the stored activities
+    expunged every chunk_size activities, so memory use does not grow with
+    the document. The resource is then no longer replaced atomically,
+    unless the duplicate policy is reject: the activities are then only
+    flushed and expunged, so a rejected resource leaves nothing behind.
 
-def hash(string):
-    m = hashlib.md5()
-    m.update(string.encode('utf-8'))
-    return m.digest()
+    With swap, changed activities are written to staging tables and
+    swapped in at the end (see ingest.StagingWriter). chunk_size then
+    only sets how many activities are staged at a time, nothing is
+    committed before the swap, and the activities of other resources
+    replaced under the newest-wins duplicate policy are deleted in it.
 
+    Activities are checked for identifiers stored for other resources a
+    batch at a time by `duplicates`, a duplicates.Duplicates.
 
-def parse_activity(new_identifiers, old_xml, resource):
-    for activity in parse.document(resource.document, resource):
-        activity.resource = resource
+    The document is read from `source`, by default resource.document.
 
+    Returns the number of activities written and the parse.Document.
+    """
+    if duplicates is None:
+        duplicates = Duplicates(resource.url)
+    if swap:
+        writer = staging = ingest.StagingWriter(
+            resource.url, batch_size=chunk_size or ingest.BATCH_SIZE,
+            skip_existing=False)
+    elif bulk:
+        writer, staging = ingest.BulkWriter(), None
+    else:
+        writer = staging = None
+    if source is None:
+        source = resource.document
+    activities = parse.document(source, resource)
+    written = committed = 0
+    chunk = []
+    pending = []
+    for activity in activities:
         if activity.iati_identifier not in new_identifiers:
             new_identifiers.add(activity.iati_identifier)
-            try:
-                if hash(activity.raw_xml) == old_xml[activity.iati_identifier][1]:
-                    activity.last_change_datetime = old_xml[activity.iati_identifier][0]
-                else:
-                    activity.last_change_datetime = datetime.datetime.now()
-            except KeyError:
-                activity.last_change_datetime = datetime.datetime.now()
-            db.session.add(activity)
-            check_for_duplicates([activity])
+            if swap:
+                writer.seen(activity.iati_identifier)
+            old = old_xml.get(activity.iati_identifier)
+            if old is not None:
+                # the version comes from <iati-activities>, not the raw xml
+                if (activity.raw_xml_hash, activity.version,
+                        activity.major_version) == old[1:]:
+                    continue
+                if not swap:
+                    db.session.query(Activity).filter_by(
+                        iati_identifier=activity.iati_identifier
+                    ).delete(synchronize_session='evaluate')
+            activity.resource = resource
+            activity.last_change_datetime = datetime.datetime.now()
+            pending.append(activity)
+            if len(pending) == ingest.BATCH_SIZE:
+                written += _store(duplicates.filter(pending, staging), writer, chunk)
+                pending = []
+                if chunk_size and not swap and written - committed >= chunk_size:
+                    _end_chunk(writer, chunk,
+                               commit=duplicates.policy != 'reject')
+                    committed = written
         else:
             parse.log.warn(
                     _("Duplicate identifier {0} in same resource document".format(
                             activity.iati_identifier),
-                            logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                            logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                            iati_identifier=activity.iati_identifier),
                     exc_info=''
             )
-
-        db.session.flush()
+            db.session.flush()
+    written += _store(duplicates.filter(pending, staging), writer, chunk)
+    duplicates.check()
+    if swap:
+        writer.swap()
+        log.info(
+            "Swapped in %d activities for %s: deleted %d in %.2fs, "
+            "inserted in %.2fs", written, resource.url, writer.deleted,
+            writer.delete_seconds, writer.insert_seconds)
+    elif writer is not None:
+        writer.flush()
+
+    # remove activities that are no longer in the document
+    removed = set(old_xml) - new_identifiers
+    if removed and not swap:
+        db.session.query(Activity) \
+            .filter(Activity.iati_identifier.in_(removed)) \
+            .delete(synchronize_session="fetch")
     db.session.commit()
+    return written, activities
 
 
-def parse_resource(resource):
+def keep_document(resource, resp, document_hash):
+    """
+    Keep a newly fetched document in the document store if there is one,
+    otherwise in IATI_DOWNLOAD_DIR if it was streamed there, otherwise on
+    the resource.
+    """
+    store = docstore.get_store()
+    spooled = isinstance(resp, download.SpooledResponse)
+    if store is not None:
+        if spooled:
+            store.put_file(resp.path, document_hash)
+            resp.discard()
+        else:
+            store.put(resp.content, document_hash)
+        resource.document = None
+        download.remove(resource.url)
+    elif spooled:
+        download.keep(resource.url, resp)
+        resource.document = None
+    else:
+        resource.document = resp.content
+        download.remove(resource.url)
+
+
+def parse_resource(resource, bulk=False, chunk_size=None,
+                   swap=False, duplicate_policy=None):
     db.session.add(resource)
     now = datetime.datetime.utcnow()
-    current = Activity.query.filter_by(resource_url=resource.url)
-    current_identifiers = set([i.iati_identifier for i in current.all()])
 
-    # obtains the iati-identifier, last-updated datetime, and a hash of the existing xml associated with
-    # every activity associated with the current url.
-    old_xml = dict([(i[0], (i[1], hash(i[2]))) for i in db.session.query(
+    # obtains the iati-identifier, last-updated datetime, the stored hash of the xml and
+    # the document version of every activity associated with the current url.
+    old_xml = dict([(i[0], tuple(i[1:])) for i in db.session.query(
             Activity.iati_identifier, Activity.last_change_datetime,
-            Activity.raw_xml).filter_by(resource_url=resource.url)])
+            Activity.raw_xml_hash, Activity.version,
+            Activity.major_version).filter_by(resource_url=resource.url)])
 
-    db.session.query(Activity).filter_by(resource_url=resource.url).delete()
     new_identifiers = set()
-    parse_activity(new_identifiers, old_xml, resource)
-
-    resource.version = parse.document_metadata(resource.document)
+    duplicates = Duplicates(resource.url, duplicate_policy)
+    source = download.document(resource)
+    if source is None:
+        raise parse.ParserError("No document stored for {0}".format(resource.url))
+    try:
+        written, document = parse_activity(
+            new_identifiers, old_xml, resource, bulk, chunk_size, swap,
+            duplicates, source)
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
+    duplicates.record(resource)
+
+    resource.version = document.version
+    resource.activity_count = document.activity_count
+    resource.warning_count = document.warning_count
+    resource.parse_seconds = document.seconds
+    resource.document_encoding = document.verdict.encoding
+    resource.document_rejected = None
 
     # add any identifiers that are no longer present to deleted_activity table
-    diff = current_identifiers - new_identifiers
+    diff = set(old_xml) - new_identifiers
     now = datetime.datetime.utcnow()
     deleted = [
         DeletedActivity(iati_identifier=deleted_activity, deletion_date=now)
@@ -267,19 +448,35 @@ def parse_resource(resource):
             .delete(synchronize_session="fetch")
 
     log.info(
-            "Parsed %d activities from %s",
-            resource.activities.count(),
-            resource.url)
+            "Parsed %d activities from %s in %.2fs with %d warnings, "
+            "%d written, %d deleted, %d stored for other resources",
+            document.activity_count, resource.url, document.seconds,
+            document.warning_count, written, len(diff),
+            len(duplicates.conflicts))
     resource.last_parsed = now
     return resource  # , new_identifiers
 
 
-def update_activities(resource_url):
+def update_activities(resource_url, bulk=None, chunk_size=None,
+                      profile=None, swap=None, duplicate_policy=None):
     '''
     Parses and stores the raw XML associated with a resource [see parse_resource()], or logs the invalid resource
     :param resource_url:
+    :param bulk: write activities with COPY/executemany rather than the ORM, defaults to IATI_BULK_INGEST
+    :param chunk_size: commit every this many activities, defaults to IATI_PARSE_CHUNK_SIZE or once per resource
+    :param profile: time each field extractor and store the report on the resource, defaults to IATI_PARSE_PROFILE
+    :param swap: replace the resource's activities through staging tables, defaults to IATI_SWAP_INGEST
+    :param duplicate_policy: first-wins, newest-wins or reject for activities stored for other resources, defaults to IATI_DUPLICATE_POLICY
     :return:
     '''
+    if swap is None:
+        swap = SWAP_INGEST
+    if profile is None:
+        profile = parse.PARSE_PROFILE
+    if bulk is None:
+        bulk = BULK_INGEST
+    if chunk_size is None:
+        chunk_size = PARSE_CHUNK_SIZE
     # clear up previous job queue log errors
     db.session.query(Log).filter(sa.and_(
             Log.logger == 'job iatilib.crawler.update_activities',
@@ -294,11 +491,29 @@ def update_activities(resource_url):
                         ['activity_importer', 'failed_activity', 'xml_parser']),
                 Log.resource == resource_url,
         )).delete(synchronize_session=False)
-        parse_resource(resource)
+        # parser warnings are counted in memory and written in one go
+        with loghandlers.aggregated(parse.log, parse.sqlalchemyLog) as warnings, \
+                parse.profiling(profile) as field_profile:
+            parse_resource(resource, bulk, chunk_size, swap,
+                           duplicate_policy)
+            warnings.write()
+        if field_profile is not None:
+            resource.parse_profile = field_profile.to_json()
+            log.info("Slowest fields parsing %s:\n%s",
+                     resource_url, field_profile.report(20))
         db.session.commit()
+        log.info(
+                "Organisation id cache: %(hits)d hits, %(redis_hits)d redis hits, "
+                "%(misses)d misses, %(size)d cached",
+                orgcache.cache.stats())
     except parse.ParserError, exc:
         db.session.rollback()
         resource.last_parse_error = str(exc)
+        if isinstance(exc, parse.RejectedDocument):
+            resource.document_encoding = exc.verdict.encoding
+            resource.document_rejected = exc.verdict.reason
+        if isinstance(exc, DuplicateIdentifiers):
+            exc.duplicates.record(resource)
         db.session.add(Log(
                 dataset=resource.dataset_id,
                 resource=resource.url,
@@ -327,8 +542,13 @@ def update_resource(resource_url):
     rq = get_queue()
     resource = fetch_resource(Resource.query.get(resource_url))
     db.session.commit()
+    log.info(
+            "HTTP connections: %(requests)d requests, %(connections)d opened, "
+            "%(reused)d reused", sessions.stats.stats())
 
-    if resource.last_status_code == 200:
+    # a document rejected as too large was never stored
+    if resource.last_status_code == 200 and not resource.last_parsed \
+            and not resource.document_rejected:
         rq.enqueue(update_activities, args=(resource.url,), result_ttl=0, timeout=300)
 
 
@@ -378,21 +598,23 @@ def metadata(verbose=False):
         fetch_dataset_metadata(dataset)
 
 
-@manager.command
-def documents(verbose=False):
-    for dataset in Dataset.query.all():
-        if verbose:
-            print "Fetching documents for %s" % dataset.name
-        for resource in dataset.resources:
-            if verbose:
-                print "Fetching %s" % resource.url,
-            try:
-                fetch_resource(resource)
-            except IOError:
-                print "Failed to fetch %s" % resource.url,
-            if verbose:
-                print resource.last_status_code
-            db.session.commit()
+@manager.option('-v', '--verbose', action="store_true")
+@manager.option('-t', '--threads', action="store", type=int,
+                help="fetch this many documents at a time")
+@manager.option('--per-host', action="store", type=int, dest="per_host",
+                help="fetch this many documents at a time from one host")
+def documents(verbose=False, threads=None, per_host=None):
+    resources = Resource.query.join(Dataset).all()
+    if verbose:
+        print "Fetching %d documents" % len(resources)
+    for resource, error in fetch_resources(resources, threads, per_host):
+        if error is not None:
+            print "Failed to fetch %s: %s" % (resource.url, error)
+        elif verbose:
+            print "Fetched %s %s" % (resource.url, resource.last_status_code)
+    if verbose:
+        print "%(requests)d requests, %(connections)d connections opened, " \
+              "%(reused)d reused" % sessions.stats.stats()
 
 
 def status_line(msg, filt, tot):
@@ -412,17 +634,44 @@ def status_line(msg, filt, tot):
 
 @manager.option('--dataset', action="store", type=unicode,
                 help="update a single dataset")
-def manual_update(dataset=None):
+@manager.option('-b', '--bulk', action="store_true", default=None,
+                help="write activities with bulk COPY rather than the ORM")
+@manager.option('-c', '--chunk-size', action="store", type=int, dest="chunk_size",
+                help="commit every this many activities")
+@manager.option('-p', '--profile', action="store_true", default=None,
+                help="time each field extractor and store the report on the resource")
+@manager.option('-s', '--swap', action="store_true", default=None,
+                help="replace each resource's activities through staging tables")
+@manager.option('-d', '--duplicates', action="store", dest="duplicate_policy",
+                choices=POLICIES,
+                help="which activity to keep when an identifier is in two resources")
+def manual_update(dataset=None, bulk=None, chunk_size=None,
+                  profile=None, swap=None, duplicate_policy=None):
     if dataset:
         print "Updating {0}".format(dataset)
         ds = Dataset.query.get(dataset)
         fetch_dataset_metadata(ds)
         db.session.commit()
-        res = Resource.query.filter(Resource.dataset_id == dataset)
+        res = Resource.query.filter(Resource.dataset_id == dataset).all()
+        for resource, error in fetch_resources(res):
+            if error is not None:
+                print "Failed to fetch {0}: {1}".format(resource.url, error)
         for resource in res:
-            fetch_resource(resource)
-            db.session.commit()
-            update_activities(resource.url)
+            update_activities(resource.url, bulk, chunk_size, profile,
+                              swap, duplicate_policy)
+
+
+@manager.option('-n', '--limit', action="store", type=int, default=10)
+def slowest(limit=10):
+    "Resources that took longest to parse, with their slowest fields if profiled"
+    resources = Resource.query.filter(Resource.parse_seconds != None)\
+        .order_by(Resource.parse_seconds.desc()).limit(limit)
+    for resource in resources:
+        print "{0:8.1f}s {1:6d} activities  {2}".format(
+            resource.parse_seconds, resource.activity_count or 0, resource.url)
+        if resource.parse_profile:
+            for row in json.loads(resource.parse_profile)[:5]:
+                print "          {seconds:8.2f}s {calls:8d} calls  {field}".format(**row)
 
 
 @manager.command
@@ -482,6 +731,35 @@ def status():
             Resource.query,
     )
 
+    print "{0} parses avoided for unchanged documents".format(
+            db.session.query(sa.func.coalesce(
+                sa.func.sum(Resource.skipped_parses), 0)).scalar())
+
+    print status_line(
+            "resources rejected without parsing",
+            Resource.query.filter(Resource.document_rejected != None),
+            Resource.query,
+    )
+
+    print status_line(
+            "resources had activities stored for other resources",
+            Resource.query.filter(Resource.duplicate_count > 0),
+            Resource.query.filter(Resource.duplicate_count != None),
+    )
+
+    print status_line(
+            "resources had parser warnings",
+            Resource.query.filter(Resource.warning_count > 0),
+            Resource.query.filter(Resource.warning_count != None),
+    )
+
+    activities, warnings, seconds = db.session.query(
+            sa.func.coalesce(sa.func.sum(Resource.activity_count), 0),
+            sa.func.coalesce(sa.func.sum(Resource.warning_count), 0),
+            sa.func.coalesce(sa.func.sum(Resource.parse_seconds), 0)).one()
+    print "{0} activities parsed in {1:.0f}s ({2:.0f}/s) with {3} warnings".format(
+            activities, seconds, activities / seconds if seconds else 0, warnings)
+
     print
 
     total_activities = Activity.query.count()
@@ -0,0 +1,285 @@
+"""
+Resource documents kept outside the database, by content.
+
+With IATI_DOCUMENT_STORE set, documents are put in a store keyed by their
+md5, Resource.document_hash, instead of Resource.document. A document
+published as several resources, or fetched again unchanged, is stored
+once. Stores are picked by the scheme of the setting:
+
+/var/lib/iati/documents         a FileStore in that directory
+file:///var/lib/iati/documents  the same
+
+FileStore gzips documents at IATI_DOCUMENT_STORE_COMPRESS, a zlib level.
+At 0 they are stored as they are, and the parser reads them through mmap;
+compressed documents are decompressed as the parser reads them. Documents
+already stored are read either way, so the level can be changed.
+
+`iati documents migrate` moves documents out of the database, and
+`iati documents gc` removes those no resource refers to any more.
+"""
+import gzip
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+from urlparse import urlsplit
+
+from flask.ext.script import Manager
+
+from iatilib import db
+from iatilib.model import Resource
+
+# Where to keep resource documents, if not in the database
+DOCUMENT_STORE = os.environ.get('IATI_DOCUMENT_STORE')
+# zlib level stored documents are gzipped at; 0 stores them uncompressed
+DOCUMENT_STORE_COMPRESS = int(os.environ.get('IATI_DOCUMENT_STORE_COMPRESS', 6))
+COPY_BYTES = 64 * 1024
+
+
+def makedirs(directory):
+    "Make `directory` unless it's there, as other workers may do at once"
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another worker meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+
+def map_file(f):
+    "A read-only mmap of the open file `f`"
+    if os.fstat(f.fileno()).st_size == 0:
+        # mmap can't map an empty file
+        return StringIO('')
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class FileStore(object):
+    """
+    Documents in files under `root`, <root>/ab/abcdef....xml, or .xml.gz
+    if compressed.
+    """
+
+    def __init__(self, root, compress=DOCUMENT_STORE_COMPRESS):
+        self.root = root
+        self.compress = compress
+
+    def _path(self, key, compressed):
+        return os.path.join(self.root, key[:2], key + (
+            '.xml.gz' if compressed else '.xml'))
+
+    def _find(self, key):
+        for compressed in (bool(self.compress), not self.compress):
+            path = self._path(key, compressed)
+            if os.path.exists(path):
+                return path, compressed
+        return None, None
+
+    def has(self, key):
+        return self._find(key)[0] is not None
+
+    def _touch(self, key):
+        """
+        Mark a stored document as stored now, so gc keeps it until the
+        resource that is about to refer to it commits. False if it isn't
+        stored.
+        """
+        path = self._find(key)[0]
+        if path is None:
+            return False
+        try:
+            os.utime(path, None)
+        except OSError:
+            # removed by gc meanwhile
+            return False
+        return True
+
+    def put(self, data, key=None):
+        """
+        Store the document `data`, its md5 `key`. Returns the key and
+        whether it was stored, False if it already was.
+        """
+        if key is None:
+            key = unicode(hashlib.md5(data).hexdigest())
+        if self._touch(key):
+            return key, False
+        return self._write(key, lambda f: f.write(data)), True
+
+    def put_file(self, filename, key):
+        "As put, for the document in `filename`, which is left as it is"
+        if self._touch(key):
+            return key, False
+        def copy(f):
+            with open(filename, 'rb') as source:
+                shutil.copyfileobj(source, f, COPY_BYTES)
+        return self._write(key, copy), True
+
+    def _write(self, key, write):
+        path = self._path(key, bool(self.compress))
+        directory = os.path.dirname(path)
+        makedirs(directory)
+        fd, tmp = tempfile.mkstemp(suffix='.part', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if self.compress:
+                    with gzip.GzipFile(
+                            filename='', mode='wb', fileobj=f,
+                            compresslevel=self.compress, mtime=0) as gz:
+                        write(gz)
+                else:
+                    write(f)
+            # another worker storing the same document writes the same bytes
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        return key
+
+    def open(self, key):
+        """
+        The document for the parser to read, an mmap if it is stored
+        uncompressed. IOError if it isn't stored.
+        """
+        path, compressed = self._find(key)
+        if path is None:
+            raise IOError("No document %s in %s" % (key, self.root))
+        if compressed:
+            return gzip.open(path, 'rb')
+        with open(path, 'rb') as f:
+            return map_file(f)
+
+    def read(self, key):
+        document = self.open(key)
+        try:
+            return document.read()
+        finally:
+            document.close()
+
+    def size(self, key):
+        "Bytes the document takes up in the store"
+        path = self._find(key)[0]
+        return os.path.getsize(path) if path else 0
+
+    def stored_at(self, key):
+        "When the document was last stored, as a timestamp"
+        path = self._find(key)[0]
+        return os.path.getmtime(path) if path else None
+
+    def keys(self):
+        if not os.path.isdir(self.root):
+            return
+        for directory in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, directory)
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                if not name.endswith('.part'):
+                    yield name.split('.', 1)[0]
+
+    def remove(self, key):
+        for compressed in (True, False):
+            try:
+                os.remove(self._path(key, compressed))
+            except OSError:
+                pass
+
+
+STORES = {
+    'file': FileStore,
+    '': FileStore,
+}
+
+_stores = {}
+
+
+def get_store(location=None):
+    "The store at `location`, by default DOCUMENT_STORE. None if not set"
+    location = location or DOCUMENT_STORE
+    if not location:
+        return None
+    key = (location, DOCUMENT_STORE_COMPRESS)
+    if key not in _stores:
+        parts = urlsplit(location)
+        try:
+            store = STORES[parts.scheme]
+        except KeyError:
+            raise ValueError("Unknown document store %r, expected one of %s" % (
+                location, ", ".join(s for s in STORES if s)))
+        _stores[key] = store(parts.path, compress=DOCUMENT_STORE_COMPRESS)
+    return _stores[key]
+
+
+manager = Manager(usage="Document store")
+
+
+@manager.option('-n', '--batch', action="store", type=int, default=100,
+                help="documents moved per commit")
+def migrate(batch=100):
+    "Move resource documents out of the database into IATI_DOCUMENT_STORE"
+    from iatilib import download
+    store = get_store()
+    if store is None:
+        print "IATI_DOCUMENT_STORE is not set"
+        return
+    moved = stored = size = stored_size = 0
+    while True:
+        # urls first, then each document on its own, to bound memory
+        urls = [url for url, in db.session.query(Resource.url).filter(
+            Resource.document != None).order_by(Resource.url).limit(batch)]
+        if not urls:
+            break
+        for url in urls:
+            resource = Resource.query.get(url)
+            document = resource.document
+            key, new = store.put(document)
+            size += len(document)
+            if new:
+                stored += 1
+                stored_size += store.size(key)
+            resource.document_hash = key
+            resource.document = None
+            moved += 1
+        db.session.commit()
+        db.session.expunge_all()
+        print "Moved %d documents" % moved
+    if download.DOWNLOAD_DIR:
+        # and those streamed to IATI_DOWNLOAD_DIR
+        for resource in Resource.query.filter(Resource.document_hash != None):
+            path = download.path(resource.url)
+            if os.path.exists(path):
+                key, new = store.put_file(path, resource.document_hash)
+                size += os.path.getsize(path)
+                if new:
+                    stored += 1
+                    stored_size += store.size(key)
+                download.remove(resource.url)
+                moved += 1
+    print "Moved %d documents, %d bytes, as %d files, %d bytes" % (
+        moved, size, stored, stored_size)
+
+
+@manager.option('-g', '--grace', action="store", type=int, default=3600,
+                help="keep documents stored less than this many seconds ago")
+def gc(grace=3600):
+    """
+    Remove stored documents no resource refers to. Those stored, or
+    stored again, recently are kept, as a fetch may not have committed
+    its resource yet.
+    """
+    store = get_store()
+    if store is None:
+        print "IATI_DOCUMENT_STORE is not set"
+        return
+    referenced = set(key for key, in db.session.query(
+        Resource.document_hash).filter(Resource.document_hash != None))
+    removed = 0
+    cutoff = time.time() - grace
+    for key in list(store.keys()):
+        if key not in referenced and store.stored_at(key) < cutoff:
+            store.remove(key)
+            removed += 1
+    print "Removed %d documents" % removed
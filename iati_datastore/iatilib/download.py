@@ -0,0 +1,140 @@
+"""
+Stream resource documents to disk rather than into the database.
+
+With IATI_DOWNLOAD_DIR set, a document is written to a spool file in that
+directory a chunk at a time as it downloads, its md5 computed on the way,
+so it is never held in memory whole. A document found to be larger than
+DOWNLOAD_MAX_BYTES, from its Content-Length or while reading it, is
+abandoned. The spool file then replaces the resource's file in the
+directory, one per resource url, and Resource.document is left empty.
+The parser reads the file through an mmap (see document()).
+
+The directory has to be shared by the workers that fetch and parse. With
+a document store (see iatilib.docstore) documents are kept there instead,
+and the directory only holds them while they download.
+"""
+import hashlib
+import os
+import tempfile
+
+from iatilib import docstore, sessions
+
+# Keep downloaded documents in this directory instead of the database
+DOWNLOAD_DIR = os.environ.get('IATI_DOWNLOAD_DIR')
+# Abandon streamed documents larger than this; 0 for no limit
+DOWNLOAD_MAX_BYTES = int(os.environ.get('IATI_DOWNLOAD_MAX_BYTES', 1 << 30))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+
+class SpooledResponse(object):
+    """
+    A response whose body, for a 200, is in the spool file `path`, `size`
+    bytes with the md5 hexdigest `md5`. `too_large` says why a body was
+    abandoned, path is then None.
+    """
+
+    def __init__(self, resp):
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self.path = self.size = self.md5 = self.too_large = None
+
+    def discard(self):
+        if self.path is not None:
+            _remove(self.path)
+            self.path = None
+
+
+def streaming():
+    return bool(DOWNLOAD_DIR)
+
+
+def path(url):
+    "The file a resource's document is kept in"
+    return os.path.join(
+        DOWNLOAD_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.xml')
+
+
+def get(url, max_bytes=None, **kw):
+    "GET url, spooling a 200's body to DOWNLOAD_DIR, as a SpooledResponse"
+    if max_bytes is None:
+        max_bytes = DOWNLOAD_MAX_BYTES
+    resp = sessions.get(url, stream=True, **kw)
+    try:
+        spooled = SpooledResponse(resp)
+        if resp.status_code == 200:
+            spool(resp, spooled, max_bytes)
+        return spooled
+    finally:
+        resp.close()
+
+
+def spool(resp, spooled, max_bytes):
+    length = resp.headers.get('content-length')
+    if max_bytes and length and length.isdigit() and int(length) > max_bytes:
+        spooled.too_large = "Content-Length %s is over the limit of %d bytes" % (
+            length, max_bytes)
+        return
+    docstore.makedirs(DOWNLOAD_DIR)
+    fd, spooled.path = tempfile.mkstemp(suffix='.part', dir=DOWNLOAD_DIR)
+    digest = hashlib.md5()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    spooled.too_large = "Document is over the limit of %d bytes" % (
+                        max_bytes)
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+    except:
+        spooled.discard()
+        raise
+    if spooled.too_large:
+        spooled.discard()
+    else:
+        spooled.size = size
+        spooled.md5 = unicode(digest.hexdigest())
+
+
+def keep(url, spooled):
+    "Make a spooled document the resource's, in place of the last"
+    os.rename(spooled.path, path(url))
+    spooled.path = None
+
+
+def remove(url):
+    "Remove a resource's document file, if it has one"
+    if DOWNLOAD_DIR:
+        _remove(path(url))
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def document(resource):
+    """
+    The resource's document for the parser: from the document store if it
+    is there, an mmap of its file if it was streamed, otherwise the bytes
+    stored on it.
+    """
+    store = docstore.get_store()
+    if store is not None and resource.document_hash:
+        try:
+            return store.open(resource.document_hash)
+        except IOError:
+            pass
+    if DOWNLOAD_DIR:
+        try:
+            f = open(path(resource.url), 'rb')
+        except IOError:
+            pass
+        else:
+            with f:
+                return docstore.map_file(f)
+    return resource.document
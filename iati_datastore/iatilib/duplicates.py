@@ -0,0 +1,127 @@
+"""
+Activities whose identifiers are already stored for another resource.
+
+An activity is stored for one resource. When a document has an activity
+whose identifier is stored for another resource, DUPLICATE_POLICY decides
+which of the two is kept:
+
+first-wins   the stored activity, the new one is dropped
+newest-wins  the one with the later last-updated-datetime, the stored one
+             if neither is later
+reject       neither changes: the resource is not updated, and parsing
+             stops at the first conflict
+
+Parsed activities are checked in batches with one query each, rather than
+one per activity, and the conflicts found are recorded on the resource.
+"""
+import datetime
+import json
+import os
+from collections import namedtuple
+
+import sqlalchemy as sa
+
+from iatilib import db, ingest, parse
+from iatilib.model import Activity
+
+POLICIES = ('first-wins', 'newest-wins', 'reject')
+# Which activity to keep when an identifier is in two resources
+DUPLICATE_POLICY = os.environ.get('IATI_DUPLICATE_POLICY', 'first-wins')
+# Conflicts listed on a resource, beyond these they are only counted
+DUPLICATES_REPORTED = 100
+
+# kept is "stored" or "new"
+Conflict = namedtuple('Conflict', 'iati_identifier resource_url kept')
+
+
+class DuplicateIdentifiers(parse.ParserError):
+    "A resource rejected for identifiers stored for other resources"
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        conflicts = duplicates.conflicts
+        super(DuplicateIdentifiers, self).__init__(
+            "%d activities are already stored for other resources, "
+            "first %s in %s" % (len(conflicts), conflicts[0].iati_identifier,
+                                conflicts[0].resource_url))
+
+
+class Duplicates(object):
+    "The conflicts of one resource's activities with those of others"
+
+    def __init__(self, resource_url, policy=None, session=None):
+        if policy is None:
+            policy = DUPLICATE_POLICY
+        if policy not in POLICIES:
+            raise ValueError("Unknown duplicate policy %r, expected one of %s"
+                             % (policy, ", ".join(POLICIES)))
+        self.resource_url = resource_url
+        self.policy = policy
+        self.session = session or db.session
+        self.conflicts = []
+
+    def filter(self, activities, staging=None):
+        """
+        The parsed `activities` to store. Under newest-wins the stored
+        activities they replace are deleted, or by `staging`, an
+        ingest.StagingWriter, when it swaps its activities in. Under reject
+        DuplicateIdentifiers is raised for the first batch with conflicts.
+        """
+        if not activities:
+            return activities
+        stored = dict((r.iati_identifier, r) for r in self.session.query(
+                Activity.iati_identifier, Activity.resource_url,
+                Activity.last_updated_datetime
+        ).filter(
+            Activity.iati_identifier.in_([a.iati_identifier for a in activities]),
+            sa.or_(Activity.resource_url != self.resource_url,
+                   Activity.resource_url == None)))
+        if not stored:
+            return activities
+        keep, replaced = [], []
+        for activity in activities:
+            other = stored.get(activity.iati_identifier)
+            if other is None:
+                keep.append(activity)
+            elif self.policy == 'newest-wins' and _newer(activity, other):
+                self.conflicts.append(Conflict(
+                    other.iati_identifier, other.resource_url, "new"))
+                replaced.append(other.iati_identifier)
+                keep.append(activity)
+            else:
+                self.conflicts.append(Conflict(
+                    other.iati_identifier, other.resource_url, "stored"))
+        self.check()
+        if replaced and staging is not None:
+            staging.replace(replaced)
+        elif replaced:
+            ingest.delete_activities(
+                self.session.connection(),
+                Activity.__table__.c.iati_identifier.in_(replaced))
+        return keep
+
+    def check(self):
+        "Raise DuplicateIdentifiers if the resource is to be rejected"
+        if self.policy == 'reject' and self.conflicts:
+            raise DuplicateIdentifiers(self)
+
+    def record(self, resource):
+        "Record the conflicts on `resource`"
+        resource.duplicate_count = len(self.conflicts)
+        resource.duplicates = json.dumps([
+            c._asdict() for c in self.conflicts[:DUPLICATES_REPORTED]
+        ]) if self.conflicts else None
+
+
+def _when(value):
+    # the parser reads last-updated-datetime as a date
+    if value is not None and not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def _newer(activity, stored):
+    new, old = _when(activity.last_updated_datetime), _when(stored.last_updated_datetime)
+    if new is None:
+        return False
+    return old is None or new > old
@@ -0,0 +1,112 @@
+"""
+Download many resources at once.
+
+Fetcher runs the requests in a pool of threads, with no more than
+FETCH_PER_HOST at a time to any one publisher's host, and hands the
+responses back to the calling thread as they arrive. The threads only
+talk HTTP, sharing the process's pooled session (iatilib.sessions) so
+connections to a host are reused: the responses are applied to the
+resources, and committed, by the caller, as crawler.fetch_resources does.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict, deque, namedtuple
+from Queue import Queue
+from urlparse import urlsplit
+
+from iatilib import sessions
+
+log = logging.getLogger(__name__)
+
+# Threads downloading resources
+FETCH_THREADS = int(os.environ.get('IATI_FETCH_THREADS', 16))
+# Connections to one host at a time
+FETCH_PER_HOST = int(os.environ.get('IATI_FETCH_PER_HOST', 4))
+
+# one of response and error is None
+Result = namedtuple('Result', 'key response error')
+
+
+def host(url):
+    return (urlsplit(url).hostname or u"").lower()
+
+
+class _Requests(object):
+    """
+    Requests waiting for a thread, queued per host. next() hands out the
+    oldest request to a host with a connection to spare, taking the hosts
+    in turn, and waits while every host with requests is at its limit.
+    """
+
+    def __init__(self, requests, per_host):
+        self.per_host = per_host
+        self.queues = OrderedDict()
+        for request in requests:
+            self.queues.setdefault(host(request[1]), deque()).append(request)
+        self.active = dict((h, 0) for h in self.queues)
+        self.condition = threading.Condition()
+
+    def next(self):
+        with self.condition:
+            while self.queues:
+                for name, queue in self.queues.items():
+                    if self.active[name] < self.per_host:
+                        request = queue.popleft()
+                        if not queue:
+                            del self.queues[name]
+                        else:
+                            # to the back of the line
+                            self.queues[name] = self.queues.pop(name)
+                        self.active[name] += 1
+                        return request
+                self.condition.wait()
+            return None
+
+    def done(self, request):
+        with self.condition:
+            self.active[host(request[1])] -= 1
+            self.condition.notify_all()
+
+
+class Fetcher(object):
+    def __init__(self, threads=FETCH_THREADS, per_host=FETCH_PER_HOST, get=None):
+        self.threads = threads
+        self.per_host = per_host
+        self.get = get
+
+    def fetch(self, requests):
+        """
+        GET each (key, url, headers) of `requests`, yielding a Result for
+        each as it completes, in no particular order.
+        """
+        pending = _Requests(requests, self.per_host)
+        total = sum(len(q) for q in pending.queues.values())
+        # finished responses wait here for the caller, at most this many
+        results = Queue(maxsize=self.threads * 2)
+        workers = [
+            threading.Thread(target=self._work, args=(pending, results))
+            for _ in range(min(self.threads, total))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for _ in range(total):
+            yield results.get()
+        for worker in workers:
+            worker.join()
+
+    def _work(self, pending, results):
+        get = self.get or sessions.get
+        while True:
+            request = pending.next()
+            if request is None:
+                return
+            key, url, headers = request
+            try:
+                result = Result(key, get(url, headers=headers), None)
+            except Exception, exc:
+                log.debug("Failed to fetch %s", url, exc_info=True)
+                result = Result(key, None, exc)
+            finally:
+                pending.done(request)
+            results.put(result)
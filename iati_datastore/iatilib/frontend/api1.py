@@ -1,3 +1,4 @@
+import json
 from collections import namedtuple
 from datetime import datetime
 import sqlalchemy as sa
@@ -58,6 +59,12 @@ def about_dataset(dataset):
             'last_successful_fetch': r.last_succ.isoformat() if r.last_succ else None,
             'last_parsed': r.last_parsed.isoformat() if r.last_parsed else None,
             'num_of_activities': r.activities.count(),
+            'version': r.version,
+            'num_of_activities_parsed': r.activity_count,
+            'num_of_parser_warnings': r.warning_count,
+            'parse_seconds': r.parse_seconds,
+            'num_of_duplicate_identifiers': r.duplicate_count,
+            'duplicate_identifiers': json.loads(r.duplicates) if r.duplicates else [],
         })
 
     return jsonify(
@@ -89,6 +96,9 @@ def fetch_status_about_dataset():
             'last_status_code': ds_r.last_status_code,
             'last_successful_fetch': ds_r.last_succ.isoformat() if ds_r.last_succ else None,
             'last_parsed': ds_r.last_parsed.isoformat() if ds_r.last_parsed else None,
+            'version': ds_r.version,
+            'num_of_activities_parsed': ds_r.activity_count,
+            'num_of_parser_warnings': ds_r.warning_count,
         }
         datasets[dataset.name] = resources
 
@@ -136,6 +146,8 @@ def resource_error():
                 'msg' : log.msg,
                 'traceback' : log.trace,
                 'datestamp' : log.created_at.isoformat(),
+                'count' : log.occurrences,
+                'sample_identifiers' : log.sample_ids.split('\n') if log.sample_ids else [],
             } for log in error_logs.all()
     ]
     return jsonify(errors=errors)
@@ -152,6 +164,8 @@ def dataset_error(dataset_id):
                 'msg' : log.msg,
                 'traceback' : log.trace,
                 'datestamp' : log.created_at.isoformat(),
+                'count' : log.occurrences,
+                'sample_identifiers' : log.sample_ids.split('\n') if log.sample_ids else [],
             } for log in error_logs.all() ]
 
     return jsonify(errors=errors)
@@ -171,6 +185,7 @@ def dataset_log_error(dataset_id):
         error['resource_url'] = log.resource
         error['logger'] = log.logger
         error['msg'] = log.msg
+        error['count'] = log.occurrences
         error['traceback'] = log.trace.split('\n')
         error['datestamp'] = log.created_at.isoformat()
         errors.append(error)
@@ -211,7 +226,7 @@ class DataStoreView(MethodView):
             self._valid_args = validators.activity_api_args(MultiDict(request.args))
         return self._valid_args
 
-    def get_response(self, serializer=None, mimetype="text/csv"):
+    def get_response(self, serializer=None, mimetype="text/csv", options=()):
         if serializer is None:
             serializer = self.serializer
 
@@ -220,6 +235,8 @@ class DataStoreView(MethodView):
         except (validators.MultipleInvalid, validators.Invalid), e:
             return make_response(render_template('invalid_filter.html', errors=e), 400)
         query = self.filter(valid_args)
+        if options:
+            query = query.options(*options)
 
         if self.streaming:
             query = query.yield_per(100)
@@ -238,9 +255,12 @@ class ActivityView(DataStoreView):
     filter = staticmethod(dsfilter.activities)
 
     def get(self, format):
+        # raw_xml is deferred, load it with the activities for the
+        # serializers that use it
+        raw_xml = (sa.orm.undefer(Activity.raw_xml),)
         forms = {
-            ".xml": (serialize.xml, "application/xml"),
-            ".json": (serialize.json, "application/json"),  # rfc4627
+            ".xml": (serialize.xml, "application/xml", raw_xml),
+            ".json": (serialize.json, "application/json", raw_xml),  # rfc4627
             ".db.json": (serialize.datastore_json, "application/json"),
             ".csv": (serialize.csv, "text/csv")  # rfc4180
         }
@@ -0,0 +1,459 @@
+"""
+Bulk ingest of parsed activities.
+
+Adding each parsed Activity to the session and flushing it issues one
+INSERT per row across activity, transaction, the percentage tables,
+participation, budget and so on. BulkWriter instead collects the rows of
+many activities per table and writes each table in one go: with COPY on
+PostgreSQL and executemany elsewhere (sqlite in the tests).
+
+Activities handed to the writer must not be added to the session.
+Organisations are resolved through iatilib.orgcache, which inserts any
+new ones, so rows can refer to them by id.
+
+StagingWriter writes the same rows into staging tables and swaps them in
+for a resource's activities at the end.
+"""
+import binascii
+import datetime
+import time
+from collections import defaultdict
+from cStringIO import StringIO
+
+import sqlalchemy as sa
+from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY
+
+from iatilib import db
+
+# Rows in the percentage tables point at their transaction, so transaction
+# ids are allocated before the rows are written rather than by the insert.
+ALLOCATE_IDS = frozenset(['transaction'])
+
+BATCH_SIZE = 500
+
+
+def _default(column):
+    default = column.default
+    if default is None:
+        return None
+    if default.is_scalar:
+        return default.arg
+    if default.is_callable:
+        return default.arg(None)
+    # SQL expression defaults on the model are all now()
+    return datetime.datetime.now()
+
+
+class BulkWriter(object):
+    """
+    Collects parsed activities and writes them in batches.
+
+    With skip_existing, activities whose identifier is already in the
+    database are dropped.
+    """
+
+    def __init__(self, session=None, batch_size=BATCH_SIZE, skip_existing=False):
+        self.session = session or db.session
+        self.batch_size = batch_size
+        self.skip_existing = skip_existing
+        self.activities = []
+        self.rows = 0
+
+    def add(self, activity):
+        self.activities.append(activity)
+        if len(self.activities) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, activities):
+        for activity in activities:
+            self.add(activity)
+        self.flush()
+
+    def flush(self):
+        if not self.activities:
+            return
+        # organisations created by the parser need their ids
+        self.session.flush()
+        connection = self.session.connection()
+        activities = self.activities
+        if self.skip_existing:
+            activities = self._new_activities(connection, activities)
+        tables = defaultdict(list)
+        pending_ids = defaultdict(list)
+        for activity in activities:
+            self._collect(activity, {}, tables, pending_ids)
+        self._allocate_ids(connection, pending_ids)
+        for table in db.metadata.sorted_tables:
+            rows = tables.get(table.name)
+            if rows:
+                self._write(connection, table, rows)
+                self.rows += len(rows)
+        self.activities = []
+
+    def _write(self, connection, table, rows):
+        write_rows(connection, table, rows)
+
+    def _new_activities(self, connection, activities):
+        table = db.metadata.tables['activity']
+        existing = set(r[0] for r in connection.execute(
+            sa.select([table.c.iati_identifier]).where(
+                table.c.iati_identifier.in_(
+                    [a.iati_identifier for a in activities]))))
+        return [a for a in activities if a.iati_identifier not in existing]
+
+    def _collect(self, obj, foreign_keys, tables, pending_ids):
+        mapper = sa.orm.object_mapper(obj)
+        table = mapper.local_table
+        row = {}
+        for prop in mapper.column_attrs:
+            column = prop.columns[0]
+            value = obj.__dict__.get(prop.key)
+            if value is None:
+                value = _default(column)
+            if value is None and column.primary_key and column.autoincrement \
+                    and isinstance(column.type, sa.Integer):
+                continue
+            row[column.name] = value
+        row.update(foreign_keys)
+
+        children = []
+        for rel in mapper.relationships:
+            if rel.key not in obj.__dict__:
+                continue
+            target = obj.__dict__[rel.key]
+            if rel.direction is MANYTOONE and target is not None:
+                for local, remote in rel.local_remote_pairs:
+                    row[local.name] = getattr(target, remote.key)
+            elif rel.direction is ONETOMANY and target:
+                children.append((rel, target))
+
+        if table.name in ALLOCATE_IDS:
+            pending_ids[table.name].append(row)
+        tables[table.name].append(row)
+
+        for rel, targets in children:
+            child_keys = dict(
+                (remote.name, _Ref(row, local.name))
+                for local, remote in rel.local_remote_pairs)
+            for child in targets:
+                self._collect(child, child_keys, tables, pending_ids)
+
+    def _allocate_ids(self, connection, pending_ids):
+        for name, rows in pending_ids.items():
+            table = db.metadata.tables[name]
+            for row, new_id in zip(rows, allocate_ids(connection, table, len(rows))):
+                row['id'] = new_id
+
+
+class StagingWriter(BulkWriter):
+    """
+    Replaces the activities of a resource through staging tables.
+
+    Rows are written as by BulkWriter, but into temporary copies of the
+    activity tables rather than the tables themselves. swap() then
+    deletes the resource's activities that were staged again or are no
+    longer in the document, children first so as not to depend on the
+    database enforcing ON DELETE CASCADE, and copies the staged rows in
+    with INSERT ... SELECT. Until then the activity tables are only read,
+    so the rows locked and the time writers wait on them are limited to
+    the swap at the end of the transaction.
+
+    Call seen() with every identifier in the document, staged or not, so
+    that activities left out of it can be told from unchanged ones, and
+    replace() with those of other resources' activities the staged ones
+    replace, which are deleted in the swap too. With skip_existing,
+    activities already stored for other resources are dropped.
+    """
+
+    def __init__(self, resource_url, session=None, batch_size=BATCH_SIZE,
+                 skip_existing=True):
+        super(StagingWriter, self).__init__(session, batch_size, skip_existing)
+        self.resource_url = resource_url
+        self.identifiers = []
+        self.replaced = []
+        self.staging = {}
+        self.tables = activity_tables()
+        self.delete_seconds = self.insert_seconds = 0
+        self.deleted = 0
+        connection = self.session.connection()
+        for table in self.tables + [_SEEN]:
+            self.staging[table.name] = create_staging_table(connection, table)
+
+    def seen(self, iati_identifier):
+        self.identifiers.append({"iati_identifier": iati_identifier})
+        if len(self.identifiers) >= self.batch_size:
+            self._flush_seen()
+
+    def replace(self, iati_identifiers):
+        self.replaced.extend(iati_identifiers)
+
+    def _flush_seen(self):
+        if self.identifiers:
+            write_rows(self.session.connection(),
+                       self.staging[_SEEN.name], self.identifiers)
+            self.identifiers = []
+
+    def _new_activities(self, connection, activities):
+        table = db.metadata.tables['activity']
+        existing = set(r[0] for r in connection.execute(
+            sa.select([table.c.iati_identifier]).where(sa.and_(
+                table.c.iati_identifier.in_(
+                    [a.iati_identifier for a in activities]),
+                sa.or_(table.c.resource_url != self.resource_url,
+                       table.c.resource_url == None)))))
+        return [a for a in activities if a.iati_identifier not in existing]
+
+    def _write(self, connection, table, rows):
+        write_rows(connection, self.staging[table.name], rows)
+
+    def _allocate_ids(self, connection, pending_ids):
+        for name, rows in pending_ids.items():
+            ids = allocate_ids(connection, db.metadata.tables[name], len(rows),
+                               self.staging[name])
+            for row, new_id in zip(rows, ids):
+                row['id'] = new_id
+
+    def swap(self):
+        """
+        Replace the resource's activities with the staged ones, in the
+        session's transaction. Returns the number of activities deleted.
+        """
+        self.flush()
+        self._flush_seen()
+        connection = self.session.connection()
+        activity = db.metadata.tables['activity']
+        staged = self.staging['activity']
+        seen = self.staging[_SEEN.name]
+        ours = activity.c.resource_url == self.resource_url
+        restaged = sa.and_(ours, activity.c.iati_identifier.in_(
+            sa.select([staged.c.iati_identifier])))
+        removed = sa.and_(ours, ~sa.exists().where(
+            seen.c.iati_identifier == activity.c.iati_identifier))
+
+        start = time.time()
+        self.deleted = 0
+        for i in range(0, len(self.replaced), self.batch_size):
+            self.deleted += delete_activities(
+                connection, activity.c.iati_identifier.in_(
+                    self.replaced[i:i + self.batch_size]))
+        self.replaced = []
+        self.deleted += delete_activities(connection, restaged) + \
+            delete_activities(connection, removed)
+        self.delete_seconds = time.time() - start
+
+        start = time.time()
+        for table in self.tables:
+            staging = self.staging[table.name]
+            connection.execute(table.insert(inline=True).from_select(
+                [c.name for c in table.columns],
+                sa.select([staging.c[c.name] for c in table.columns])))
+        self.insert_seconds = time.time() - start
+
+        for table in self.staging.values():
+            drop_staging_table(connection, table)
+        self.staging = {}
+        return self.deleted
+
+
+def activity_tables():
+    """
+    The activity table and those whose rows are deleted with an activity
+    by ON DELETE CASCADE, parents before children.
+    """
+    owned = []
+    for table in db.metadata.sorted_tables:
+        if table.name == 'activity' or any(
+                fk.ondelete == 'CASCADE' and fk.column.table in owned
+                for fk in table.foreign_keys):
+            owned.append(table)
+    return owned
+
+
+def delete_activities(connection, activities):
+    """
+    Delete the activities matching the where clause `activities`, and
+    their rows in activity_tables(), with a statement per table and
+    foreign key. Returns the number of activities deleted.
+    """
+    for table in reversed(activity_tables()):
+        for owned in _owned(table, activities):
+            result = connection.execute(table.delete().where(owned))
+    return result.rowcount
+
+
+def _owned(table, activities):
+    """
+    Where clauses for the rows of `table` belonging to `activities`, one
+    for each way of reaching them. They are not joined with OR, which
+    keeps PostgreSQL from planning each as a semi-join.
+    """
+    if table.name == 'activity':
+        return [activities]
+    clauses = []
+    for fk in table.foreign_keys:
+        if fk.ondelete == 'CASCADE':
+            for parent in _owned(fk.column.table, activities):
+                clauses.append(fk.parent.in_(
+                    sa.select([fk.column]).where(parent)))
+    return clauses
+
+
+# Identifiers in the document being staged
+_SEEN = sa.Table('seen', sa.MetaData(), sa.Column('iati_identifier', sa.Unicode))
+
+
+def create_staging_table(connection, table):
+    """
+    An empty temporary table with the columns of `table`, named
+    staging_<table>. On PostgreSQL it takes the table's defaults, so
+    serial ids come from the table's own sequence.
+    """
+    staging = sa.sql.table(
+        'staging_%s' % table.name,
+        *[sa.sql.column(c.name, c.type) for c in table.columns])
+    quote = connection.dialect.identifier_preparer.quote_identifier
+    drop_staging_table(connection, staging)
+    if table.metadata is not db.metadata:
+        columns = ", ".join(
+            "%s %s" % (quote(c.name), c.type.compile(connection.dialect))
+            for c in table.columns)
+        connection.execute("CREATE TEMPORARY TABLE %s (%s)" % (
+            quote(staging.name), columns))
+    elif connection.dialect.name == 'postgresql':
+        connection.execute("CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (
+            quote(staging.name), quote(table.name)))
+    else:
+        connection.execute("CREATE TEMPORARY TABLE %s AS SELECT * FROM %s WHERE 0" % (
+            quote(staging.name), quote(table.name)))
+    return staging
+
+
+def drop_staging_table(connection, staging):
+    quote = connection.dialect.identifier_preparer.quote_identifier
+    connection.execute("DROP TABLE IF EXISTS %s" % quote(staging.name))
+
+
+def store(activities, bulk=False, chunk_size=None, session=None):
+    """
+    Save parsed activities, with BulkWriter if `bulk`.
+
+    With chunk_size the session is committed every chunk_size activities
+    and the saved activities expunged, so that neither the session nor the
+    writer holds more than a chunk at a time. Otherwise everything is
+    committed once at the end.
+    """
+    session = session or db.session
+    writer = BulkWriter(session, batch_size=chunk_size or BATCH_SIZE) if bulk else None
+    chunk = []
+    for count, activity in enumerate(activities, 1):
+        if writer is not None:
+            writer.add(activity)
+        else:
+            session.add(activity)
+            if chunk_size:
+                chunk.append(activity)
+        if chunk_size and count % chunk_size == 0:
+            if writer is not None:
+                writer.flush()
+            session.commit()
+            for saved in chunk:
+                session.expunge(saved)
+            del chunk[:]
+    if writer is not None:
+        writer.flush()
+    session.commit()
+
+
+class _Ref(object):
+    """A parent row's key, resolved once the parent's id is allocated."""
+
+    def __init__(self, row, key):
+        self.row = row
+        self.key = key
+
+    def resolve(self):
+        return self.row[self.key]
+
+
+def _resolve(row):
+    return dict(
+        (key, value.resolve() if isinstance(value, _Ref) else value)
+        for key, value in row.items())
+
+
+def allocate_ids(connection, table, count, *staging):
+    """
+    `count` new ids for `table`. On sqlite ids are counted on from the
+    largest in the table and any `staging` tables holding rows for it.
+    """
+    if connection.dialect.name == 'postgresql':
+        return [r[0] for r in connection.execute(
+            sa.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                    "FROM generate_series(1, :count)"),
+            table=table.name, count=count)]
+    # sqlite: the tests are the only writer
+    start = max(connection.execute(
+        sa.select([sa.func.coalesce(sa.func.max(t.c.id), 0)])).scalar()
+        for t in (table,) + staging)
+    return range(start + 1, start + 1 + count)
+
+
+def write_rows(connection, table, rows):
+    rows = [_resolve(row) for row in rows]
+    if connection.dialect.name == 'postgresql':
+        copy_rows(connection, table, rows)
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def _copy_text(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_processor(type_, dialect):
+    if isinstance(getattr(type_, 'impl', type_), sa.LargeBinary):
+        # bytea in hex, rather than the quoted literal psycopg2 would make
+        bind = getattr(type_, 'process_bind_param', None)
+        def process(value):
+            if bind is not None:
+                value = bind(value, dialect)
+            return '\\x' + binascii.hexlify(value)
+        return process
+    return type_.bind_processor(dialect)
+
+
+def copy_rows(connection, table, rows):
+    dialect = connection.dialect
+    columns = [c for c in table.columns if c.name in rows[0]]
+    processors = [_copy_processor(c.type.dialect_impl(dialect), dialect)
+                  for c in columns]
+    buf = StringIO()
+    for row in rows:
+        values = []
+        for column, process in zip(columns, processors):
+            value = row.get(column.name)
+            if process is not None and value is not None:
+                value = process(value)
+            values.append(_copy_text(value))
+        buf.write('\t'.join(values))
+        buf.write('\n')
+    buf.seek(0)
+    quote = dialect.identifier_preparer.quote_identifier
+    sql = "COPY %s (%s) FROM STDIN" % (
+        quote(table.name), ", ".join(quote(c.name) for c in columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    finally:
+        cursor.close()
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 import traceback
@@ -24,12 +25,99 @@ class SQLAlchemyHandler(logging.Handler):
         #db.session.commit()
 
 
+# Identifiers of the affected activities kept on an aggregated Log row
+SAMPLE_IDS = 10
+
+
+class AggregatingHandler(logging.Handler):
+    """
+    Buffer parser warnings in memory, counting repeats instead of adding a
+    Log row for each one.
+
+    Messages logged for different activities but otherwise the same (the
+    activity's identifier is taken out of the message to compare them) are
+    stored as one Log row per resource, with the number of occurrences and
+    the first SAMPLE_IDS identifiers. Nothing reaches the database until
+    write() is called.
+    """
+
+    def __init__(self, level=logging.NOTSET, samples=SAMPLE_IDS):
+        logging.Handler.__init__(self, level)
+        self.samples = samples
+        self.entries = {}
+
+    def _key(self, record):
+        msg = record.msg
+        message = msg.message
+        if msg.iati_identifier:
+            message = message.replace(msg.iati_identifier, u"")
+        return (msg.dataset, msg.resource, msg.logger, record.levelname, message)
+
+    def emit(self, record):
+        key = self._key(record)
+        entry = self.entries.get(key)
+        if entry is None:
+            # only the first occurrence's traceback is kept, so format no other
+            trace = None
+            exc = record.__dict__['exc_info']
+            if exc:
+                trace = traceback.format_exc(exc)
+            entry = self.entries[key] = {
+                'dataset': record.msg.dataset,
+                'resource': record.msg.resource,
+                'logger': record.msg.logger,
+                'level': record.levelname,
+                'trace': trace,
+                'msg': record.msg.message,
+                'created_at': datetime.fromtimestamp(record.created),
+                'occurrences': 0,
+                'sample_ids': [],
+            }
+        entry['occurrences'] += 1
+        identifier = record.msg.iati_identifier
+        if identifier and len(entry['sample_ids']) < self.samples and \
+                identifier not in entry['sample_ids']:
+            entry['sample_ids'].append(identifier)
+
+    def rows(self):
+        for entry in self.entries.values():
+            row = dict(entry)
+            row['sample_ids'] = u"\n".join(entry['sample_ids']) or None
+            yield row
+
+    def write(self, session=None):
+        """Insert the buffered warnings in one statement and empty the buffer"""
+        session = session or db.session
+        rows = list(self.rows())
+        if rows:
+            session.execute(Log.__table__.insert(), rows)
+        self.entries = {}
+
+
+@contextmanager
+def aggregated(logger, replace):
+    """
+    Swap the `replace` handler of `logger` for an AggregatingHandler for the
+    duration of the block. The caller decides when to write() it.
+    """
+    handler = AggregatingHandler(replace.level)
+    logger.removeHandler(replace)
+    logger.addHandler(handler)
+    try:
+        yield handler
+    finally:
+        logger.removeHandler(handler)
+        logger.addHandler(replace)
+
+
 class DatasetMessage(object):
-    def __init__(self, message, logger=None, dataset=None, resource=None, **kwargs):
+    def __init__(self, message, logger=None, dataset=None, resource=None,
+                 iati_identifier=None, **kwargs):
         self.message = message
         self.logger = logger
         self.dataset = dataset
         self.resource = resource
+        self.iati_identifier = iati_identifier
         self.kwargs = kwargs
 
     def __str__(self):
@@ -8,6 +8,7 @@ from sqlalchemy.ext.declarative import declared_attr
 
 from . import db
 from . import codelists
+from .compression import CompressedBinary, CompressedText
 
 act_relationship = ft.partial(
         sa.orm.relationship,
@@ -117,9 +118,14 @@ class Activity(db.Model):
     title = sa.Column(sa.Unicode, default=u"", nullable=False)
     description = sa.Column(sa.Unicode, default=u"", nullable=False)
     default_currency = sa.Column(codelists.Currency.db_type())
-    raw_xml = sa.Column(
-            sa.UnicodeText,
-            nullable=False)
+    # compressed, and only loaded when used (see iatilib.compression)
+    raw_xml = sa.orm.deferred(sa.Column(
+            CompressedText,
+            nullable=False))
+    # md5 of raw_xml, used to tell whether an activity changed on reparse
+    raw_xml_hash = sa.Column(
+            sa.Unicode(32),
+            nullable=True)
     version = sa.Column(
             sa.Unicode,
             nullable=True)
@@ -409,10 +415,24 @@ class Resource(db.Model):
     last_succ = sa.Column(sa.DateTime)  # last time status code was 200
     last_parsed = sa.Column(sa.DateTime)  # when parsing last completed
     last_parse_error = sa.Column(sa.Unicode)  # last error from xml parser
-    document = sa.orm.deferred(sa.Column(sa.LargeBinary))
+    document = sa.orm.deferred(sa.Column(CompressedBinary))
+    document_hash = sa.Column(sa.Unicode(32))  # md5 of document
+    # fetches that returned an unchanged document and so were not reparsed
+    skipped_parses = sa.Column(sa.Integer, nullable=False, default=0, server_default='0')
     etag = sa.Column(sa.Unicode)
     activities = lazy_act_relationship("Activity", cascade="all,delete", passive_deletes=True)
     version = sa.Column(sa.Unicode)
+    # from the last parse of the document, see parse.Document
+    activity_count = sa.Column(sa.Integer)  # activities parsed
+    warning_count = sa.Column(sa.Integer)  # parser warnings logged
+    parse_seconds = sa.Column(sa.Float)  # time spent parsing
+    parse_profile = sa.Column(sa.Unicode)  # JSON time per field, if profiled
+    # from sniffing the start of the document before parsing, see iatilib.sniff
+    document_encoding = sa.Column(sa.Unicode)
+    document_rejected = sa.Column(sa.Unicode)  # why it wasn't parsed
+    # activities already stored for other resources, see iatilib.duplicates
+    duplicate_count = sa.Column(sa.Integer)
+    duplicates = sa.Column(sa.Unicode)  # JSON list of the first conflicts
 
 
 class Log(db.Model):
@@ -431,6 +451,9 @@ class Log(db.Model):
     level = sa.Column(sa.String)  # info, debug, or error?
     trace = sa.Column(sa.String)  # the full traceback printout
     msg = sa.Column(sa.String)  # any custom log you may have included
+    # times the message was logged for the resource, see loghandlers.AggregatingHandler
+    occurrences = sa.Column(sa.Integer, nullable=False, default=1, server_default='1')
+    sample_ids = sa.Column(sa.String)  # newline separated identifiers of some affected activities
     created_at = sa.Column(
             sa.DateTime,
             default=sa.func.now())  # the current timestamp
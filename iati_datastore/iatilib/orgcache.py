@@ -0,0 +1,227 @@
+"""
+Organisation ids cached across jobs.
+
+Organisation.as_unique keeps its cache on the session, so every
+update_activities job starts cold and looks up each distinct
+(ref, name, type) it meets again. OrganisationIdCache keeps the ids for
+the life of the worker process in an LRU, optionally backed by a redis
+hash shared between workers, and hands back Organisation objects attached
+to the session, loaded at most once per session by primary key.
+
+The rq worker forks a work horse for every job unless IATI_QUEUE_NO_FORK
+is set (see iatilib.queue), and the LRU is lost with the horse. A forking
+worker only reuses ids across jobs through redis, so set
+IATI_ORG_CACHE_REDIS, or IATI_QUEUE_NO_FORK to keep the LRU in the worker.
+
+Organisations missing from the database are inserted with
+ON CONFLICT DO NOTHING (INSERT OR IGNORE on sqlite), so a concurrent
+insert of the same organisation by another worker waits for it rather
+than failing. The unique constraint treats NULLs as distinct, so two
+workers can still both insert an organisation without a type, as before.
+Ids of organisations inserted in the current transaction are only shared
+once it commits: a rolled back job must not leave them in the cache.
+"""
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from redis.exceptions import RedisError
+
+from iatilib import db, redis
+from iatilib.model import Organisation
+
+log = logging.getLogger(__name__)
+
+# Organisation ids kept in each worker process
+ORG_CACHE_SIZE = int(os.environ.get('IATI_ORG_CACHE_SIZE', 10000))
+# Share organisation ids between workers in a redis hash
+ORG_CACHE_REDIS = bool(os.environ.get('IATI_ORG_CACHE_REDIS'))
+
+
+class LRU(object):
+    "Mapping that drops the least recently used key beyond `size` keys"
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return None
+        self.data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+def _key(ref, name, type):
+    return ref, name, type.value if type is not None else None
+
+
+class OrganisationIdCache(object):
+    def __init__(self, size=ORG_CACHE_SIZE, use_redis=ORG_CACHE_REDIS):
+        self.lru = LRU(size)
+        self.use_redis = use_redis
+        self.hits = self.redis_hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "size": len(self.lru),
+        }
+
+    def clear(self):
+        self.lru.clear()
+        self.hits = self.redis_hits = self.misses = 0
+
+    def organisation(self, session, ref, name=u"", type=None, **kw):
+        "The Organisation for (ref, name, type), inserting it if needed"
+        if isinstance(session, sa.orm.scoped_session):
+            session = session()
+        key = _key(ref, name, type)
+        id = self.lru.get(key)
+        if id is not None:
+            self.hits += 1
+        else:
+            id = self._redis_get(key)
+            if id is not None:
+                self.redis_hits += 1
+                self.lru.set(key, id)
+            else:
+                self.misses += 1
+                id = self._load(session, key, ref, name, type)
+        return _attach(session, id, ref, name, type)
+
+    def _load(self, session, key, ref, name, type):
+        pending = _pending(session, self)
+        if key in pending:
+            return pending[key]
+        id = _select_id(session, ref, name, type)
+        if id is None:
+            id = _insert(session, key)
+            if id is not None:
+                pending[key] = id
+                return id
+            id = _select_id(session, ref, name, type)
+        self.publish(key, id)
+        return id
+
+    def publish(self, key, id):
+        self.lru.set(key, id)
+        self._redis_set(key, id)
+
+    def _redis_name(self):
+        return "iati:organisation-ids:%s" % db.engine.url.database
+
+    def _redis_get(self, key):
+        if not self.use_redis:
+            return None
+        try:
+            id = redis.hget(self._redis_name(), json.dumps(key))
+        except RedisError:
+            log.warn("Could not read organisation id from redis", exc_info=True)
+            return None
+        return int(id) if id is not None else None
+
+    def _redis_set(self, key, id):
+        if not self.use_redis:
+            return
+        try:
+            redis.hset(self._redis_name(), json.dumps(key), id)
+        except RedisError:
+            log.warn("Could not write organisation id to redis", exc_info=True)
+
+
+cache = OrganisationIdCache()
+
+
+def organisation(session, **kw):
+    return cache.organisation(session, **kw)
+
+
+def _pending(session, cache):
+    "Ids `cache` inserted in the session's current transaction"
+    pending = session.__dict__.setdefault("_org_cache_pending", {})
+    return pending.setdefault(cache, {})
+
+
+@sa.event.listens_for(sa.orm.Session, "after_commit")
+def _publish_pending(session):
+    for cache, ids in session.__dict__.pop("_org_cache_pending", {}).items():
+        for key, id in ids.items():
+            cache.publish(key, id)
+
+
+@sa.event.listens_for(sa.orm.Session, "after_rollback")
+def _discard_pending(session):
+    session.__dict__.pop("_org_cache_pending", None)
+
+
+def _select_id(session, ref, name, type):
+    with session.no_autoflush:
+        query = Organisation.unique_filter(
+            session.query(Organisation.id), ref=ref, name=name, type=type)
+        row = query.first()
+    return row[0] if row else None
+
+
+def _insert(session, key):
+    """
+    Insert the organisation unless it conflicts with an existing one.
+    Returns the new id, or None if nothing was inserted.
+    """
+    params = dict(zip(("ref", "name", "type"), key))
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        row = session.execute(sa.text(
+            "INSERT INTO organisation (ref, name, type) "
+            "VALUES (:ref, :name, :type) "
+            "ON CONFLICT DO NOTHING RETURNING id"), params).first()
+        return row[0] if row else None
+    if dialect == "sqlite":
+        result = session.execute(sa.text(
+            "INSERT OR IGNORE INTO organisation (ref, name, type) "
+            "VALUES (:ref, :name, :type)"), params)
+    else:
+        result = session.execute(Organisation.__table__.insert(), params)
+    return result.lastrowid if result.rowcount else None
+
+
+def _attach(session, id, ref, name, type):
+    """
+    A persistent Organisation for a known row: the one in the session's
+    identity map, or else loaded by primary key. SQLAlchemy 0.8 has no
+    public way to attach a row without loading it (merge(load=False)
+    refuses transient objects), so an organisation costs a primary key
+    SELECT the first time a session meets it, not a unique filter query.
+    """
+    mapper = sa.orm.class_mapper(Organisation)
+    identity = mapper.identity_key_from_primary_key([id])
+    obj = session.identity_map.get(identity)
+    if obj is None:
+        with session.no_autoflush:
+            obj = session.query(Organisation).get(id)
+    else:
+        # expired by a commit: restore what's known rather than have
+        # participating_orgs load it again
+        values = dict(id=id, ref=ref, name=name, type=type)
+        for attr, value in values.items():
+            if attr not in obj.__dict__:
+                sa.orm.attributes.set_committed_value(obj, attr, value)
+    return obj
@@ -1,23 +1,28 @@
 import os
 import re
 import datetime
+import hashlib
+import json
 import logging
+import time
+from contextlib import contextmanager
 from decimal import Decimal, InvalidOperation
 from functools import partial
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from StringIO import StringIO
 
 from lxml import etree as ET
 from dateutil.parser import parse as parse_date
-from requests.packages import chardet
 
 from . import db
 from iatilib.model import (
-    Activity, Budget, CountryPercentage, Transaction, Organisation,
+    Activity, Budget, CountryPercentage, Transaction,
     Participation, PolicyMarker, RegionPercentage, RelatedActivity,
     SectorPercentage)
 from iatilib import codelists
 from iatilib import loghandlers
+from iatilib import orgcache
+from iatilib import sniff
 from iatilib.loghandlers import DatasetMessage as _
 
 log = logging.getLogger("parser")
@@ -29,6 +34,11 @@ log.propagate = False
 NODEFAULT = object()
 no_resource = namedtuple('DummyResource', 'url dataset_id')('no_url', 'no_dataset')
 
+# Relative to any element inside an activity, so it works both on a
+# standalone <iati-activity> document and on an element still attached to
+# the <iati-activities> tree being iterparsed.
+IATI_IDENTIFIER = "ancestor-or-self::iati-activity/iati-identifier/text()"
+
 TEXT_ELEMENT = {
     '1': 'text()',
     '2': 'narrative/text()',
@@ -44,6 +54,14 @@ class XMLError(ParserError):
     pass
 
 
+class RejectedDocument(ParserError):
+    "A document sniffing showed is not worth parsing"
+
+    def __init__(self, verdict):
+        ParserError.__init__(self, verdict.reason)
+        self.verdict = verdict
+
+
 class SpecError(ParserError):
     # Errors raised by spec violations
     pass
@@ -57,9 +75,28 @@ class InvalidDateError(SpecError):
     pass
 
 
+_compiled_xpaths = {}
+
+
+def compiled_xpath(xpath):
+    """
+    Return `xpath` as an ET.XPath, compiling each distinct expression once.
+
+    Evaluating a string with ele.xpath() compiles it again on every call,
+    which is a noticeable share of parse time on large files.
+    """
+    try:
+        return _compiled_xpaths[xpath]
+    except KeyError:
+        compiled = _compiled_xpaths[xpath] = ET.XPath(xpath, smart_strings=False)
+        return compiled
+
+
 def xval(ele, xpath, default=NODEFAULT):
+    if not isinstance(xpath, ET.XPath):
+        xpath = compiled_xpath(xpath)
     try:
-        val = ele.xpath(xpath)[0]
+        val = xpath(ele)[0]
         if isinstance(val, str):
             return val.decode("utf-8")
         if isinstance(val, unicode):
@@ -67,7 +104,7 @@ def xval(ele, xpath, default=NODEFAULT):
         raise TypeError("val is not a basestring")
     except IndexError:
         if default is NODEFAULT:
-            raise MissingValue("Missing %r from %s" % (xpath, ele.tag))
+            raise MissingValue("Missing %r from %s" % (xpath.path, ele.tag))
         return default
 
 
@@ -81,14 +118,44 @@ def xpath_date(xpath, xml, resource=None, major_version='1'):
     return iati_date(iso_date)
 
 
+ISO_DATE = re.compile(
+    r"\s*(\d{4})-(\d{2})-(\d{2})"
+    r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)?(?:Z|[+-]\d{2}(?::?\d{2})?)?\s*$")
+
+# Parsed dates by string. A document repeats the same few hundred dates;
+# the cache is emptied whenever it reaches DATE_CACHE_SIZE.
+DATE_CACHE_SIZE = 4096
+_date_cache = {}
+
+
+def _parse_iso_date(iso_date):
+    match = ISO_DATE.match(iso_date)
+    if match:
+        try:
+            # the time is checked too, so only what dateutil takes is taken
+            return datetime.datetime(
+                *[int(group or 0) for group in match.groups()]).date()
+        except ValueError:
+            pass  # out of range, let dateutil decide as before
+    try:
+        return parse_date(iso_date, fuzzy=True).date()
+    except ValueError:
+        raise InvalidDateError('could not parse {0} as date'.format(iso_date))
+
+
 def iati_date(iso_date):
     if iso_date:
         try:
-            return parse_date(iso_date, fuzzy=True).date()
-        except ValueError:
-            raise InvalidDateError('could not parse {0} as date'.format(iso_date))
+            return _date_cache[iso_date]
+        except KeyError:
+            pass
+        value = _parse_iso_date(iso_date)
+        if len(_date_cache) >= DATE_CACHE_SIZE:
+            _date_cache.clear()
+        _date_cache[iso_date] = value
+        return value
     else:
-        return None 
+        return None
 
 
 def iati_int(text):
@@ -107,101 +174,109 @@ def xpath_decimal(xpath, xml, resource=None, major_version='1'):
         return None
 
 
+def xpath_percentage(xpath, xml):
+    percentage = xval(xml, xpath, None)
+    if percentage is None:
+        return None
+    try:
+        return Decimal(percentage)
+    except ValueError:
+        return None
+
+
+def organisation(**data):
+    return orgcache.organisation(db.session, **data)
+
+
 def parse_org(xml, resource=no_resource, major_version='1'):
+    X = XPATHS[major_version]
     data = {
-        "ref": xval(xml, "@ref", u""),
-        "name": xval(xml, TEXT_ELEMENT[major_version], u""),
+        "ref": xval(xml, X['ref'], u""),
+        "name": xval(xml, X['text'], u""),
     }
     try:
-        data['type'] = codelists.by_major_version[major_version].OrganisationType.from_string(xval(xml, "@type"))
+        data['type'] = codelists.by_major_version[major_version].OrganisationType.from_string(xval(xml, X['type']))
     except (MissingValue, ValueError):
         data['type'] = None
-    return Organisation.as_unique(db.session, **data)
+    return organisation(**data)
 
 
 def reporting_org(element, resource=no_resource, major_version='1'):
+    X = XPATHS[major_version]
     try:
-        xml = element.xpath("./reporting-org")[0]
+        xml = X['reporting_org'](element)[0]
     except IndexError:
         if major_version == '1':
             return None
         raise
     data = {
-        "ref": xval(xml, "@ref"),
-        "name": xval(xml, TEXT_ELEMENT[major_version], u""),
+        "ref": xval(xml, X['ref']),
+        "name": xval(xml, X['text'], u""),
     }
     try:
         data.update({
-            "type": codelists.by_major_version[major_version].OrganisationType.from_string(xval(xml, "@type"))
+            "type": codelists.by_major_version[major_version].OrganisationType.from_string(xval(xml, X['type']))
         })
     except (MissingValue, ValueError) as exe:
         data['type'] = None
-        iati_identifier = xval(xml, "/iati-identifier/text()", 'no_identifier')
+        iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
         log.warn(
             _(u"Failed to import a valid reporting-org.type in activity {0}, error was: {1}".format(
                 iati_identifier, exe),
-            logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+            logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+            iati_identifier=iati_identifier),
             exc_info=exe
         )
 
-    return Organisation.as_unique(db.session, **data)
+    return organisation(**data)
 
 
 def participating_orgs(xml, resource=None, major_version='1'):
+    X = XPATHS[major_version]
     ret = []
     seen = set()
-    for ele in xml.xpath("./participating-org"):
+    for ele in X['participating_org'](xml):
         try:
-            role = codelists.by_major_version[major_version].OrganisationRole.from_string(xval(ele, "@role").title())
+            role = codelists.by_major_version[major_version].OrganisationRole.from_string(xval(ele, X['role']).title())
             organisation = parse_org(ele, major_version=major_version)
             if not (role, organisation.ref) in seen:
                 seen.add((role, organisation.ref))
                 ret.append(Participation(role=role, organisation=organisation))
         except ValueError as e:
-            iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()", 'no_identifier')
+            iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
             log.warn(
                 _(u"Failed to import a valid sector percentage:{0} in activity {1}, error was: {2}".format(
                     'organisation_role', iati_identifier, e),
-                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                iati_identifier=iati_identifier),
                 exc_info=e
             )
     return ret
 
 
 def websites(xml, resource=None, major_version='1'):
-    return [xval(ele, "text()") for ele in xml.xpath("./activity-website") if xval(ele, "text()", None) ]
+    X = XPATHS[major_version]
+    return [xval(ele, X['plain_text']) for ele in X['activity_website'](xml) if xval(ele, X['plain_text'], None) ]
 
 
 def recipient_country_percentages(element, resource=no_resource, major_version='1'):
-    xml = element.xpath("./recipient-country")
+    X = XPATHS[major_version]
     results = []
-    for ele in xml:
-        name = xval(ele, TEXT_ELEMENT[major_version], None)
-        code = from_codelist(codelists.by_major_version[major_version].Country, "@code", ele, resource)
-        if ele.xpath("@percentage"):
-            try:
-                percentage = Decimal(xval(ele, "@percentage"))
-            except ValueError:
-                percentage = None
-        else:
-            percentage = None
+    for ele in X['recipient_country'](element):
+        name = xval(ele, X['text'], None)
+        code = from_codelist(codelists.by_major_version[major_version].Country, X['code'], ele, resource)
+        percentage = xpath_percentage(X['percentage'], ele)
         results.append(CountryPercentage(name=name, country=code, percentage=percentage))
     return results
 
 
 def recipient_region_percentages(element, resource=no_resource, major_version='1'):
-    xml = element.xpath("./recipient-region")
+    X = XPATHS[major_version]
     results = []
-    for ele in xml:
-        name=xval(ele, TEXT_ELEMENT[major_version], None)
-        region=from_codelist(codelists.by_major_version[major_version].Region, "@code", ele, resource)
-        if ele.xpath("@percentage"):
-            try:
-                percentage = Decimal(xval(ele, "@percentage"))
-            except ValueError:
-                percentage = None
-        else:
-            percentage = None
+    for ele in X['recipient_region'](element):
+        name = xval(ele, X['text'], None)
+        region = from_codelist(codelists.by_major_version[major_version].Region, X['code'], ele, resource)
+        percentage = xpath_percentage(X['percentage'], ele)
         if region:
             results.append(RegionPercentage(name=name, region=region, percentage=percentage))
     return results
@@ -213,45 +288,26 @@ def currency(path, xml, resource=None, major_version='1'):
         return codelists.by_major_version[major_version].Currency.from_string(code)
     else:
         return None
-        
 
-def transactions(xml, resource=no_resource, major_version='1'):
-    def from_cl(code, codelist):
-        return codelist.from_string(code) if code is not None else None
 
-    def from_org(path, ele, resource=None, major_version='1'):
-        organisation = ele.xpath(path)
-        if organisation:
-            return parse_org(organisation[0], major_version=major_version)
-        #return Organisation.as_unique(db.session, ref=org) if org else Nonejk
+def transaction_org(path, ele, resource=None, major_version='1'):
+    organisation = path(ele)
+    if organisation:
+        return parse_org(organisation[0], major_version=major_version)
+
+
+def transactions(xml, resource=no_resource, major_version='1'):
+    X = XPATHS[major_version]
+    field_functions = FIELDS[major_version]['transaction']
 
     def process(ele):
         data = {
-            'description' : xval(ele, "description/" + TEXT_ELEMENT[major_version], None),
-            'provider_org_text' : xval(ele, "provider-org/" + TEXT_ELEMENT[major_version], None),
-            'provider_org_activity_id' : xval(
-                                ele, "provider-org/@provider-activity-id", None),
-            'receiver_org_text' : xval(ele, "receiver-org/" + TEXT_ELEMENT[major_version], None),
-            'receiver_org_activity_id' : xval(ele, "receiver-org/@receiver-activity-id", None),
-            'ref' : xval(ele, "@ref", None),
-        }
-
-        field_functions = {
-            'date' : partial(xpath_date, "transaction-date/@iso-date"),
-            'flow_type' : partial(from_codelist_with_major_version, 'FlowType', "./flow-type/@code"),
-            'finance_type' : partial(from_codelist_with_major_version, 'FinanceType', "./finance-type/@code"),
-            'aid_type' : partial(from_codelist_with_major_version, 'AidType', "./aid-type/@code"),
-            'tied_status' : partial(from_codelist_with_major_version, 'TiedStatus', "./tied-status/@code"),
-            'disbursement_channel' : partial(from_codelist_with_major_version, 'DisbursementChannel', "./disbursement-channel/@code"),
-            'provider_org' : partial(from_org, "./provider-org"),
-            'receiver_org' : partial(from_org, "./receiver-org"),
-            'type' : partial(from_codelist_with_major_version, 'TransactionType', "./transaction-type/@code"),
-            'value_currency' : partial(currency, "value/@currency"),
-            'value_date' : partial(xpath_date, "value/@value-date"),
-            'value_amount' : partial(xpath_decimal, "value/text()"),
-            "recipient_country_percentages": recipient_country_percentages,
-            "recipient_region_percentages": recipient_region_percentages,
-            "sector_percentages": sector_percentages,
+            'description' : xval(ele, X['transaction_description'], None),
+            'provider_org_text' : xval(ele, X['provider_org_text'], None),
+            'provider_org_activity_id' : xval(ele, X['provider_org_activity_id'], None),
+            'receiver_org_text' : xval(ele, X['receiver_org_text'], None),
+            'receiver_org_activity_id' : xval(ele, X['receiver_org_activity_id'], None),
+            'ref' : xval(ele, X['ref'], None),
         }
 
         for field, function in field_functions.items():
@@ -259,160 +315,153 @@ def transactions(xml, resource=no_resource, major_version='1'):
                 data[field] = function(ele, resource, major_version)
             except (MissingValue, InvalidDateError, ValueError, InvalidOperation), exe:
                 data[field] = None
-                iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()", 'no_identifier')
+                iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
                 log.warn(
                     _(u"Failed to import a valid {0} in activity {1}, error was: {2}".format(
                         field, iati_identifier, exe),
-                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                    iati_identifier=iati_identifier),
                     exc_info=exe
                 )
-        
+
         return Transaction(**data)
 
     ret = []
-    for ele in xml.xpath("./transaction"):
+    for ele in X['transaction'](xml):
         try:
             ret.append(process(ele))
         except MissingValue as exe:
-            iati_identifier = xval(xml, "/iati-identifier/text()", 'no_identifier')
+            iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
             log.warn(
                 _(u"Failed to import a valid transaction in activity {0}, error was: {1}".format(
                     iati_identifier, exe),
-                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                iati_identifier=iati_identifier),
                 exc_info=exe
             )
     return ret
 
 
 def sector_percentages(xml, resource=no_resource, major_version='1'):
-    cl = codelists.by_major_version[major_version]
+    X = XPATHS[major_version]
+    field_functions = FIELDS[major_version]['sector']
     ret = []
-    for ele in xml.xpath("./sector"):
+    for ele in X['sector'](xml):
         sp = SectorPercentage()
-        field_functions = {
-            'sector' : partial(from_codelist, cl.Sector, "@code"),
-            'vocabulary' : partial(from_codelist, cl.Vocabulary, "@vocabulary"),
-        }
-
         for field, function in field_functions.items():
             try:
                 setattr(sp, field, function(ele, resource))
             except (MissingValue, ValueError), exe:
-                iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()", 'no_identifier')
+                iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
                 log.warn(
                     _("uFailed to import a valid {0} in activity {1}, error was: {2}".format(
                         field, iati_identifier, exe),
-                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                    iati_identifier=iati_identifier),
                     exc_info=exe
                 )
-        
-        if ele.xpath("@percentage"):
-            try:
-                sp.percentage = Decimal(xval(ele, "@percentage"))
-            except ValueError:
-                sp.percentage = None
-        if ele.xpath(TEXT_ELEMENT[major_version]):
-            sp.text = xval(ele, TEXT_ELEMENT[major_version])
+
+        sp.percentage = xpath_percentage(X['percentage'], ele)
+        text = xval(ele, X['text'], None)
+        if text is not None:
+            sp.text = text
         if any(getattr(sp, attr) for attr in "sector vocabulary percentage".split()):
             ret.append(sp)
     return ret
 
 
-def budgets(xml, resource=no_resource, major_version='1'):
-    def budget_type(ele, resource=None):
-        cl = codelists.by_major_version[major_version]
-        typestr = xval(ele, "@type", None)
-        if typestr:
-            if typestr in ['Original', 'Revised']:
-                return getattr(cl.BudgetType, typestr.lower())
-            else:
-                return cl.BudgetType.from_string(typestr)
+def budget_type(ele, resource=None, major_version='1'):
+    cl = codelists.by_major_version[major_version]
+    typestr = xval(ele, XPATHS[major_version]['type'], None)
+    if typestr:
+        if typestr in ['Original', 'Revised']:
+            return getattr(cl.BudgetType, typestr.lower())
         else:
-            return None
+            return cl.BudgetType.from_string(typestr)
+    else:
+        return None
+
+
+def budgets(xml, resource=no_resource, major_version='1'):
+    X = XPATHS[major_version]
+    field_functions = FIELDS[major_version]['budget']
 
     def process(ele):
-        field_functions = {
-            'type' : budget_type,
-            'value_currency' : partial(currency, "value/@currency"),
-            'value_amount' : partial(xpath_decimal, "value/text()"),
-            'period_start' : partial(xpath_date, "period-start/@iso-date"),
-            'period_end' : partial(xpath_date, "period-end/@iso-date"),
-        }
         data = {}
         for field, function in field_functions.items():
             try:
-                data[field] = function(ele, resource)
+                data[field] = function(ele, resource, major_version)
             except (MissingValue, InvalidDateError, ValueError, InvalidOperation) as exe:
                 data[field] = None
-                iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()", 'no_identifier')
+                iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
                 log.warn(
                     _("uFailed to import a valid budget:{0} in activity {1}, error was: {2}".format(
                         field, iati_identifier, exe),
-                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                    logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                    iati_identifier=iati_identifier),
                     exc_info=exe
                 )
 
         return Budget(**data)
 
     ret = []
-    for ele in xml.xpath("./budget"):
+    for ele in X['budget'](xml):
         ret.append(process(ele))
     return ret
 
 
 def policy_markers(xml, resource=no_resource, major_version='1'):
-    element = xml.xpath("./policy-marker")
+    X = XPATHS[major_version]
     return [ PolicyMarker(
-                code=from_codelist(codelists.by_major_version[major_version].PolicyMarker, "@code", ele, resource),
-                text=xval(ele, TEXT_ELEMENT[major_version], None),
-             ) for ele in element ]
+                code=from_codelist(codelists.by_major_version[major_version].PolicyMarker, X['code'], ele, resource),
+                text=xval(ele, X['text'], None),
+             ) for ele in X['policy_marker'](xml) ]
 
 
 def related_activities(xml, resource=no_resource, major_version='1'):
-    element = xml.xpath("./related-activity")
+    X = XPATHS[major_version]
     results = []
-    for ele in element:
-        text=xval(ele, TEXT_ELEMENT[major_version], None)
+    for ele in X['related_activity'](xml):
+        text = xval(ele, X['text'], None)
         try:
-            ref = xval(ele, "@ref")
+            ref = xval(ele, X['ref'])
             results.append(RelatedActivity(ref=ref, text=text))
         except MissingValue as e:
-            iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()", 'no_identifier')
+            iati_identifier = xval(xml, X['iati_identifier_for_log'], 'no_identifier')
             log.warn(
                 _(u"Failed to import a valid related-activity in activity {0}, error was: {1}".format(
                     iati_identifier, e),
-                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
+                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                iati_identifier=iati_identifier),
                 exc_info=e
             )
     return results
 
 
 def hierarchy(xml, resource=None, major_version='1'):
-    xml_value = xval(xml, "@hierarchy", None)
+    xml_value = xval(xml, XPATHS[major_version]['hierarchy'], None)
     if xml_value:
         return codelists.by_major_version[major_version].RelatedActivityType.from_string(xml_value)
     return None
 
 
 def last_updated_datetime(xml, resource=None, major_version='1'):
-    xml_value = xval(xml, "@last-updated-datetime", None)
+    xml_value = xval(xml, XPATHS[major_version]['last_updated_datetime'], None)
     return iati_date(xml_value)
 
 
 def default_language(xml, resource=None, major_version='1'):
-    xml_value = xval(xml, "@xml:lang", None)
+    xml_value = xval(xml, XPATHS[major_version]['default_language'], None)
     if xml_value is None:
         return None
     return codelists.by_major_version[major_version].Language.from_string(xml_value)
 
 
-def _open_resource(xml_resource, detect_encoding=False):
+def _open_resource(xml_resource):
+    if hasattr(xml_resource, 'read'):
+        # an open file or buffer, iterparse streams from it as it is
+        return xml_resource
     if isinstance(xml_resource, basestring):
-        if detect_encoding:
-            encoding = chardet.detect(xml_resource)['encoding']
-            if encoding in ('UTF-16LE', 'UTF-16BE'):
-                xml_resource = xml_resource.decode('UTF-16').encode('utf-8')
-
         try: # https://github.com/IATI/iati-datastore/issues/160
             xml_resource_is_path = os.path.exists(xml_resource)
         except TypeError:
@@ -432,13 +481,34 @@ def _open_resource(xml_resource, detect_encoding=False):
     return xmlfile
 
 
+def _activity_element(xml_resource):
+    # Elements handed over by activities() are already parsed, so use them
+    # as they are rather than serializing and parsing them a second time.
+    if isinstance(xml_resource, ET._ElementTree):
+        return xml_resource.getroot()
+    if isinstance(xml_resource, ET._Element):
+        return xml_resource
+    return ET.parse(_open_resource(xml_resource)).getroot()
+
+
+def _raw_xml(xml):
+    if xml.getparent() is None:
+        # a standalone activity document, keep any comments around it
+        return ET.tostring(xml.getroottree(), encoding=unicode)
+    return ET.tostring(xml, encoding=unicode, with_tail=False)
+
+
+def raw_xml_hash(raw_xml):
+    return unicode(hashlib.md5(raw_xml.encode('utf-8')).hexdigest())
+
+
 def from_codelist(codelist, path, xml, resource=no_resource):
     code = xval(xml, path, None)
     if code:
         try:
             return codelist.from_string(code)
         except (MissingValue, ValueError) as e:
-            iati_identifier = xval(xml, "/iati-activity/iati-identifier/text()",
+            iati_identifier = xval(xml, IATI_IDENTIFIER,
                 'no_identifier')
 
             log.warn(
@@ -446,7 +516,8 @@ def from_codelist(codelist, path, xml, resource=no_resource):
                    "{1}, error was: {2}".format(codelist, iati_identifier, e)),
                    logger='activity_importer',
                    dataset=resource.dataset_id,
-                   resource=resource.url
+                   resource=resource.url,
+                   iati_identifier=iati_identifier
                 ),
                 exc_info=e
             )
@@ -458,37 +529,118 @@ def from_codelist_with_major_version(codelist_name, path, xml, resource, major_v
 
 
 def activity(xml_resource, resource=no_resource, major_version='1', version=None):
-    xml = ET.parse(_open_resource(xml_resource))
+    xml = _activity_element(xml_resource)
+    X = XPATHS[major_version]
 
-    if major_version == '2':
-        start_planned = partial(xval_date, "./activity-date[@type='1']")
-        start_actual = partial(xval_date, "./activity-date[@type='2']")
-        end_planned = partial(xval_date, "./activity-date[@type='3']")
-        end_actual = partial(xval_date, "./activity-date[@type='4']")
+    raw_xml = _raw_xml(xml)
+    data = {
+        "iati_identifier": xval(xml, X['iati_identifier']),
+        "title": xval(xml, X['title'], u""),
+        "description": xval(xml, X['description'], u""),
+        "raw_xml": raw_xml,
+        "raw_xml_hash": raw_xml_hash(raw_xml),
+        "major_version": major_version,
+        "version": version,
+    }
 
-    else:
-        start_planned = partial(xval_date, "./activity-date[@type='start-planned']")
-        end_planned = partial(xval_date, "./activity-date[@type='end-planned']")
-        start_actual = partial(xval_date, "./activity-date[@type='start-actual']")
-        end_actual = partial(xval_date, "./activity-date[@type='end-actual']")
+    for field, function in FIELDS[major_version]['activity'].items():
+        try:
+            data[field] = function(xml, resource, major_version)
+        except (MissingValue, InvalidDateError, ValueError, InvalidOperation), exe:
+            data[field] = None
+            log.warn(
+                _(u"Failed to import a valid {0} in activity {1}, error was: {2}".format(
+                    field, data['iati_identifier'], exe),
+                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url,
+                iati_identifier=data['iati_identifier']),
+                exc_info=exe
+            )
+    return Activity(**data)
 
-    data = {
-        "iati_identifier": xval(xml.getroot(), "./iati-identifier/text()"),
-        "title": xval(xml, "./title/"+TEXT_ELEMENT[major_version], u""),
-        "description": xval(xml, "./description/"+TEXT_ELEMENT[major_version], u""),
-        "raw_xml": ET.tostring(xml, encoding=unicode)
+
+ACTIVITY_DATE_TYPES = {
+    '1': {
+        'start_planned': 'start-planned',
+        'start_actual': 'start-actual',
+        'end_planned': 'end-planned',
+        'end_actual': 'end-actual',
+    },
+    '2': {
+        'start_planned': '1',
+        'start_actual': '2',
+        'end_planned': '3',
+        'end_actual': '4',
+    },
+}
+
+
+def _xpaths(major_version):
+    text = TEXT_ELEMENT[major_version]
+    paths = {
+        'text': text,
+        'plain_text': "text()",
+        'iati_identifier': "./iati-identifier/text()",
+        'iati_identifier_for_log': IATI_IDENTIFIER,
+        'title': "./title/" + text,
+        'description': "./description/" + text,
+        'hierarchy': "@hierarchy",
+        'last_updated_datetime': "@last-updated-datetime",
+        'default_language': "@xml:lang",
+        'default_currency': "@default-currency",
+        'ref': "@ref",
+        'type': "@type",
+        'role': "@role",
+        'code': "@code",
+        'vocabulary': "@vocabulary",
+        'percentage': "@percentage",
+        'reporting_org': "./reporting-org",
+        'participating_org': "./participating-org",
+        'activity_website': "./activity-website",
+        'recipient_country': "./recipient-country",
+        'recipient_region': "./recipient-region",
+        'transaction': "./transaction",
+        'sector': "./sector",
+        'budget': "./budget",
+        'policy_marker': "./policy-marker",
+        'related_activity': "./related-activity",
+        'activity_status': "./activity-status/@code",
+        'collaboration_type': "./collaboration-type/@code",
+        'default_finance_type': "./default-finance-type/@code",
+        'default_flow_type': "./default-flow-type/@code",
+        'default_aid_type': "./default-aid-type/@code",
+        'default_tied_status': "./default-tied-status/@code",
+        'transaction_description': "description/" + text,
+        'transaction_date': "transaction-date/@iso-date",
+        'provider_org': "./provider-org",
+        'provider_org_text': "provider-org/" + text,
+        'provider_org_activity_id': "provider-org/@provider-activity-id",
+        'receiver_org': "./receiver-org",
+        'receiver_org_text': "receiver-org/" + text,
+        'receiver_org_activity_id': "receiver-org/@receiver-activity-id",
+        'flow_type': "./flow-type/@code",
+        'finance_type': "./finance-type/@code",
+        'aid_type': "./aid-type/@code",
+        'tied_status': "./tied-status/@code",
+        'disbursement_channel': "./disbursement-channel/@code",
+        'transaction_type': "./transaction-type/@code",
+        'value_currency': "value/@currency",
+        'value_date': "value/@value-date",
+        'value_amount': "value/text()",
+        'period_start': "period-start/@iso-date",
+        'period_end': "period-end/@iso-date",
     }
+    return dict((name, compiled_xpath(path)) for name, path in paths.items())
 
+
+def _fields(major_version):
+    X = XPATHS[major_version]
     cl = codelists.by_major_version[major_version]
-    activity_status = partial(from_codelist_with_major_version, 'ActivityStatus', "./activity-status/@code")
-    collaboration_type = partial(from_codelist_with_major_version, 'CollaborationType', "./collaboration-type/@code")
-    default_finance_type = partial(from_codelist_with_major_version, 'FinanceType', "./default-finance-type/@code")
-    default_flow_type = partial(from_codelist_with_major_version, 'FlowType', "./default-flow-type/@code")
-    default_aid_type = partial(from_codelist_with_major_version, 'AidType', "./default-aid-type/@code")
-    default_tied_status = partial(from_codelist_with_major_version, 'TiedStatus', "./default-tied-status/@code")
-    
-    field_functions = {
-        "default_currency" : partial(currency, "@default-currency"),
+
+    def codelist_field(codelist, path):
+        return partial(from_codelist_with_major_version, codelist, X[path])
+
+    activity_fields = {
+        "default_currency" : partial(currency, X['default_currency']),
         "hierarchy": hierarchy,
         "last_updated_datetime" : last_updated_datetime,
         "default_language" : default_language,
@@ -498,70 +650,257 @@ def activity(xml_resource, resource=no_resource, major_version='1', version=None
         "recipient_country_percentages": recipient_country_percentages,
         "recipient_region_percentages": recipient_region_percentages,
         "transactions": transactions,
-        "start_planned": start_planned,
-        "end_planned": end_planned,
-        "start_actual": start_actual,
-        "end_actual": end_actual,
         "sector_percentages": sector_percentages,
         "budgets": budgets,
         "policy_markers": policy_markers,
         "related_activities": related_activities,
-        'activity_status' : activity_status,
-        'collaboration_type' : collaboration_type,
-        'default_finance_type' : default_finance_type,
-        'default_flow_type' : default_flow_type,
-        'default_aid_type' : default_aid_type,
-        'default_tied_status' : default_tied_status,
-        'major_version': lambda *args, **kwargs: major_version,
-        'version': lambda *args, **kwargs: version,
+        'activity_status' : codelist_field('ActivityStatus', 'activity_status'),
+        'collaboration_type' : codelist_field('CollaborationType', 'collaboration_type'),
+        'default_finance_type' : codelist_field('FinanceType', 'default_finance_type'),
+        'default_flow_type' : codelist_field('FlowType', 'default_flow_type'),
+        'default_aid_type' : codelist_field('AidType', 'default_aid_type'),
+        'default_tied_status' : codelist_field('TiedStatus', 'default_tied_status'),
+    }
+    for field, date_type in ACTIVITY_DATE_TYPES[major_version].items():
+        activity_fields[field] = partial(
+            xval_date, "./activity-date[@type='{0}']".format(date_type))
+
+    transaction_fields = {
+        'date' : partial(xpath_date, X['transaction_date']),
+        'flow_type' : codelist_field('FlowType', 'flow_type'),
+        'finance_type' : codelist_field('FinanceType', 'finance_type'),
+        'aid_type' : codelist_field('AidType', 'aid_type'),
+        'tied_status' : codelist_field('TiedStatus', 'tied_status'),
+        'disbursement_channel' : codelist_field('DisbursementChannel', 'disbursement_channel'),
+        'provider_org' : partial(transaction_org, X['provider_org']),
+        'receiver_org' : partial(transaction_org, X['receiver_org']),
+        'type' : codelist_field('TransactionType', 'transaction_type'),
+        'value_currency' : partial(currency, X['value_currency']),
+        'value_date' : partial(xpath_date, X['value_date']),
+        'value_amount' : partial(xpath_decimal, X['value_amount']),
+        "recipient_country_percentages": recipient_country_percentages,
+        "recipient_region_percentages": recipient_region_percentages,
+        "sector_percentages": sector_percentages,
+    }
+
+    sector_fields = {
+        'sector' : partial(from_codelist, cl.Sector, X['code']),
+        'vocabulary' : partial(from_codelist, cl.Vocabulary, X['vocabulary']),
+    }
+
+    budget_fields = {
+        'type' : budget_type,
+        'value_currency' : partial(currency, X['value_currency']),
+        'value_amount' : partial(xpath_decimal, X['value_amount']),
+        'period_start' : partial(xpath_date, X['period_start']),
+        'period_end' : partial(xpath_date, X['period_end']),
+    }
+
+    return {
+        'activity': activity_fields,
+        'transaction': transaction_fields,
+        'sector': sector_fields,
+        'budget': budget_fields,
     }
 
-    for field, function in field_functions.items():
+
+# Compiled XPaths and field extractor tables for each IATI major version,
+# built once at import rather than for every activity or sub-element.
+XPATHS = dict((major_version, _xpaths(major_version)) for major_version in TEXT_ELEMENT)
+FIELDS = dict((major_version, _fields(major_version)) for major_version in TEXT_ELEMENT)
+
+# Profile the field extractors of every document parsed, see profiling()
+PARSE_PROFILE = bool(os.environ.get('IATI_PARSE_PROFILE'))
+
+
+class FieldProfile(object):
+    """
+    Calls and cumulative seconds of each field extractor, by
+    "<table>.<field>" (e.g. "transaction.value_date"). Time spent in
+    fields that parse sub-elements, such as activity.transactions,
+    includes the time of their own fields.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def wrap(self, table, field, function):
+        key = "%s.%s" % (table, field)
+        calls, seconds = self.calls, self.seconds
+
+        def timed(*args):
+            start = time.time()
+            try:
+                return function(*args)
+            finally:
+                seconds[key] += time.time() - start
+                calls[key] += 1
+        return timed
+
+    def ranked(self):
+        "[(key, calls, seconds)], slowest first"
+        return sorted(
+            ((key, calls, self.seconds[key]) for key, calls in self.calls.items()),
+            key=lambda row: -row[2])
+
+    def to_json(self):
+        return json.dumps([
+            {"field": key, "calls": calls, "seconds": round(seconds, 6)}
+            for key, calls, seconds in self.ranked()])
+
+    def report(self, limit=None):
+        lines = ["{0:>9} {1:>9} {2:>9}  {3}".format(
+            "seconds", "calls", "us/call", "field")]
+        for key, calls, seconds in self.ranked()[:limit]:
+            lines.append("{0:9.3f} {1:9d} {2:9.1f}  {3}".format(
+                seconds, calls, seconds * 1e6 / calls, key))
+        return "\n".join(lines)
+
+
+# The FieldProfile of the profiling() block being run, if any
+field_profile = None
+
+
+@contextmanager
+def profiling(enabled=True):
+    """
+    Time every field extractor run in the block with the FieldProfile the
+    block is given, or give it None and time nothing if not `enabled`.
+    Parsing outside a profiling() block is not slowed down: the extractors
+    are only wrapped while it lasts.
+    """
+    global field_profile
+    if not enabled:
+        yield None
+        return
+    profile = FieldProfile()
+    original = dict(FIELDS)
+    for major_version, tables in original.items():
+        FIELDS[major_version] = dict(
+            (table, dict((field, profile.wrap(table, field, function))
+                         for field, function in functions.items()))
+            for table, functions in tables.items())
+    field_profile = profile
+    try:
+        yield profile
+    finally:
+        FIELDS.update(original)
+        field_profile = None
+
+
+class _WarningCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Document(object):
+    """
+    The activities of a document, parsed as they are iterated over, and
+    what was learnt about the document in the same pass: its version, the
+    number of activities parsed, the number of parser warnings logged and
+    the time spent parsing. version is known once the first activity has
+    been returned, the rest once iteration has finished.
+    """
+
+    def __init__(self, xmlfile, resource=no_resource, verdict=None):
+        # the sniff.Verdict the document was accepted with
+        self.verdict = verdict or sniff.accept()
+        self.version = None
+        self.major_version = '1'
+        self.activity_count = 0
+        self.warning_count = 0
+        self.seconds = 0.0
+        self._warnings = _WarningCounter()
+        self._activities = activities(xmlfile, resource, self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        # only count warnings logged while parsing this document
+        log.addHandler(self._warnings)
         try:
-            data[field] = function(xml, resource, major_version)
-        except (MissingValue, InvalidDateError, ValueError, InvalidOperation), exe:
-            data[field] = None
-            log.warn(
-                _(u"Failed to import a valid {0} in activity {1}, error was: {2}".format(
-                    field, data['iati_identifier'], exe),
-                logger='activity_importer', dataset=resource.dataset_id, resource=resource.url),
-                exc_info=exe
-            )
-    return Activity(**data)
+            activity = next(self._activities)
+        finally:
+            log.removeHandler(self._warnings)
+            self.warning_count = self._warnings.count
+            self.seconds += time.time() - start
+        self.activity_count += 1
+        return activity
+
+
+def sniffed(xml_resource):
+    """
+    (xmlfile, verdict) for a resource opened for parsing and the
+    sniff.Verdict on it. Raises RejectedDocument if it isn't worth parsing.
+    """
+    xmlfile = _open_resource(xml_resource)
+    verdict = sniff.sniff_file(xmlfile)
+    if not verdict.accept:
+        raise RejectedDocument(verdict)
+    return xmlfile, verdict
 
 
 def document(xml_resource, resource=no_resource):
-    try:
-        return activities(_open_resource(xml_resource), resource) 
-    except UnicodeDecodeError:
-        return activities(_open_resource(xml_resource, detect_encoding=True), resource) 
+    xmlfile, verdict = sniffed(xml_resource)
+    return Document(xmlfile, resource, verdict)
 
 
-def activities(xmlfile, resource=no_resource):
+def activity_elements(xmlfile, document=None):
+    """
+    Yield (element, major_version, version) for each <iati-activity> in
+    `xmlfile`. An element is cleared and removed from the tree, along with
+    anything before it, once the next one is asked for, so the tree does
+    not grow with the document.
+
+    The version found is also set on `document`, a Document, if given,
+    and the document is parsed in the encoding its verdict overrides.
+    """
     major_version = '1'
     version = None
+    encoding = document.verdict.override if document is not None else None
     try:
-        for event, elem in ET.iterparse(xmlfile, events=('start','end')):
-            if event=='start' and elem.tag == 'iati-activities':
-                version = elem.attrib.get('version')
-                if version and version.startswith('2.'):
-                    major_version = '2'
-            elif event=='end' and elem.tag == 'iati-activity':
-                try:
-                    yield activity(elem, resource=resource, major_version=major_version, version=version)
-                except MissingValue, exe:
-                    log.error(_("Failed to import a valid Activity error was: {0}".format(exe),
-                            logger='failed_activity', dataset=resource.dataset_id, resource=resource.url),
-                            exc_info=exe)
+        for event, elem in ET.iterparse(xmlfile, events=('start','end'),
+                                        encoding=encoding):
+            tag = elem.tag
+            if event=='start':
+                if tag == 'iati-activities':
+                    version = elem.attrib.get('version')
+                    if version and version.startswith('2.'):
+                        major_version = '2'
+                    if document is not None:
+                        document.version = version
+                        document.major_version = major_version
+            elif event=='end' and tag == 'iati-activity':
+                yield elem, major_version, version
                 elem.clear()
+                parent = elem.getparent()
+                if parent is not None:
+                    while elem.getprevious() is not None:
+                        del parent[0]
     except ET.XMLSyntaxError, exe:
         raise XMLError()
 
 
-def document_metadata(xml_resource):
-    version = None
-    for event, elem in ET.iterparse(_open_resource(xml_resource)):
-        if elem.tag == 'iati-activities':
-            version = elem.get('version')
-        elem.clear()
-    return version
+def try_activity(xml, resource=no_resource, major_version='1', version=None):
+    try:
+        return activity(xml, resource=resource, major_version=major_version, version=version)
+    except MissingValue, exe:
+        log.error(_("Failed to import a valid Activity error was: {0}".format(exe),
+                logger='failed_activity', dataset=resource.dataset_id, resource=resource.url),
+                exc_info=exe)
+    return None
+
+
+def activities(xmlfile, resource=no_resource, document=None):
+    for elem, major_version, version in activity_elements(xmlfile, document):
+        parsed = try_activity(elem, resource, major_version, version)
+        if parsed is not None:
+            yield parsed
+
@@ -1,13 +1,21 @@
+import logging
+import os
 import traceback
 
 from flask.ext.script import Manager
 from flask.ext.rq import get_worker as _get_worker, get_queue
 
-from . import db
+from . import db, orgcache
 from .model import Log, Resource
 
+log = logging.getLogger(__name__)
+
 manager = Manager(usage="Background task queue")
 
+# Run jobs in the worker process rather than a fork per job, so pooled
+# HTTP connections (iatilib.sessions) and the org cache outlive a job
+QUEUE_NO_FORK = bool(os.environ.get('IATI_QUEUE_NO_FORK'))
+
 
 def db_log_exception(job, exc_type, exc_value, tb):
     # as this is called when an exception occurs session is probably a mess
@@ -39,6 +47,16 @@ def get_worker():
     worker = _get_worker()
     worker.pop_exc_handler()
     worker.push_exc_handler(db_log_exception)
+    if QUEUE_NO_FORK:
+        def perform_job(job):
+            try:
+                worker.perform_job(job)
+            finally:
+                db.session.remove()
+        worker.fork_and_perform_job = perform_job
+    elif not orgcache.cache.use_redis:
+        log.warn("Organisation ids are only cached within each job: set "
+                 "IATI_ORG_CACHE_REDIS or IATI_QUEUE_NO_FORK to keep them")
     return worker
 
 
@@ -0,0 +1,130 @@
+"""
+Pooled keep-alive HTTP sessions.
+
+Registry calls and document downloads go through one requests.Session per
+process, so connections to a host are kept open and reused rather than
+set up, TLS handshake and all, for every request. The session is made on
+first use, and again after a fork, since the child can't share the
+parent's connections. The rq worker forks for every job unless
+IATI_QUEUE_NO_FORK is set (see iatilib.queue).
+
+Requests without a timeout get HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT,
+and `stats` counts the requests made and connections opened, the rest
+having reused a pooled connection.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool)
+
+# Hosts to keep a pool of connections for
+HTTP_POOL_HOSTS = int(os.environ.get('IATI_HTTP_POOL_HOSTS', 64))
+# Connections kept open to each host, at least IATI_FETCH_PER_HOST
+HTTP_POOL_SIZE = int(os.environ.get('IATI_HTTP_POOL_SIZE', 8))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('IATI_HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.environ.get('IATI_HTTP_READ_TIMEOUT', 120))
+
+
+class Stats(object):
+    "Requests made and connections opened, from any thread"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = self.connections = 0
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+    def connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "reused": max(self.requests - self.connections, 0),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.requests = self.connections = 0
+
+
+stats = Stats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.connection()
+        return HTTPConnectionPool._new_conn(self)
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.connection()
+        return HTTPSConnectionPool._new_conn(self)
+
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, pool_hosts=HTTP_POOL_HOSTS, pool_size=HTTP_POOL_SIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        self.timeout = timeout
+        super(PooledAdapter, self).__init__(
+            pool_connections=pool_hosts, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kw):
+        super(PooledAdapter, self).init_poolmanager(*args, **kw)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kw):
+        if kw.get('timeout') is None:
+            kw['timeout'] = self.timeout
+        stats.request()
+        return super(PooledAdapter, self).send(request, **kw)
+
+
+def new_session(pool_hosts=HTTP_POOL_HOSTS, pool_size=HTTP_POOL_SIZE,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+    session = requests.Session()
+    adapter = PooledAdapter(pool_hosts, pool_size, timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+_session = None
+_pid = None
+_lock = threading.Lock()
+
+
+def session():
+    "This process's pooled session"
+    global _session, _pid
+    with _lock:
+        if _session is None or _pid != os.getpid():
+            _session = new_session()
+            _pid = os.getpid()
+        return _session
+
+
+def get(url, **kw):
+    return session().get(url, **kw)
+
+
+class _Current(object):
+    "Stands for this process's session, for clients that keep one"
+
+    def __getattr__(self, name):
+        return getattr(session(), name)
+
+
+current = _Current()
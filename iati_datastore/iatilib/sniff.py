@@ -0,0 +1,190 @@
+"""
+Decide from the first few KB of a document whether it is worth parsing,
+and in which encoding.
+
+Registry links often lead to HTML error pages, empty files or files that
+are not IATI activities at all. Those are rejected here rather than by
+lxml after the whole document has been read. The encoding is taken from
+the byte order mark or the XML declaration as the parser would take it,
+and only overridden when the start of the document shows that label is
+wrong: undeclared or mislabelled non UTF-8 text, or a document declared
+as UTF-16 that is actually in an ASCII compatible encoding.
+"""
+import codecs
+import os
+import re
+from collections import namedtuple
+
+from requests.packages import chardet
+
+# Bytes from the start of a document looked at
+SNIFF_BYTES = int(os.environ.get('IATI_SNIFF_BYTES', 4096))
+
+# encoding is what the document is in, override what to tell the parser
+# when that differs from what the document says, reason why it was rejected
+Verdict = namedtuple('Verdict', 'accept encoding override reason')
+
+BOMS = [
+    # UTF-32LE first, its BOM starts with the UTF-16LE one
+    (codecs.BOM_UTF32_LE, 'UTF-32LE'),
+    (codecs.BOM_UTF32_BE, 'UTF-32BE'),
+    (codecs.BOM_UTF8, 'UTF-8'),
+    (codecs.BOM_UTF16_LE, 'UTF-16LE'),
+    (codecs.BOM_UTF16_BE, 'UTF-16BE'),
+]
+
+# How '<' or '<?' starts a document without a BOM in encodings that are
+# not ASCII compatible (XML 1.0 appendix F)
+WIDE_STARTS = [
+    ('\x00\x00\x00<', 'UTF-32BE'),
+    ('<\x00\x00\x00', 'UTF-32LE'),
+    ('\x00<\x00?', 'UTF-16BE'),
+    ('<\x00?\x00', 'UTF-16LE'),
+]
+
+XML_DECLARATION = re.compile(
+    r"""<\?xml\s[^>]*?encoding\s*=\s*["']([A-Za-z][A-Za-z0-9._-]*)["']""")
+
+# The prolog: declaration, comments, processing instructions, doctype
+PROLOG = re.compile(r"""\s*(?:
+    <\?.*?\?>
+  | <!--.*?-->
+  | <!DOCTYPE(?:[^\[>]|\[.*?\])*>
+)""", re.S | re.X)
+DOCTYPE_HTML = re.compile(r"\s*<!DOCTYPE\s+html\b", re.I)
+ROOT = re.compile(r"<([^\s/>!?]+)")
+
+ROOTS = ('iati-activities', 'iati-activity')
+
+
+def accept(encoding=None, override=None):
+    return Verdict(True, encoding, override, None)
+
+
+def reject(reason, encoding=None):
+    return Verdict(False, encoding, None, reason)
+
+
+def _family(encoding):
+    "The codec for `encoding` regardless of byte order, None if unknown"
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    if name.startswith('utf-'):
+        return '-'.join(name.split('-')[:2])
+    return name
+
+
+def _valid_utf8(head, complete):
+    # a multibyte character may be cut in two at the end of the head
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, complete)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _guess(head):
+    return chardet.detect(head)['encoding']
+
+
+def _encoding(head, complete):
+    """
+    (encoding, override, text) for the start of a document, or a rejecting
+    Verdict. text is the head decoded well enough to look at its markup.
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            text = head[len(bom):].decode(encoding, 'replace')
+            declared = XML_DECLARATION.match(text)
+            if declared and _family(declared.group(1)) != _family(encoding):
+                # libxml2 gives up on a BOM that contradicts the declaration
+                return encoding, encoding, text
+            return encoding, None, text
+    for start, encoding in WIDE_STARTS:
+        if head.startswith(start):
+            return encoding, None, head.decode(encoding, 'replace')
+
+    text = head.decode('latin-1')
+    declared = XML_DECLARATION.match(text)
+    if declared is None:
+        if _valid_utf8(head, complete):
+            return 'UTF-8', None, text
+        # text in anything but UTF-8 must declare it, guess what it is
+        guess = _guess(head)
+        return guess, guess, text
+    encoding = declared.group(1)
+    family = _family(encoding)
+    if family is None:
+        return reject(u"Unknown encoding %s" % encoding, encoding)
+    if family in ('utf-16', 'utf-32'):
+        # the declaration of a document since converted to a single byte
+        # encoding, without the declaration being changed
+        override = 'UTF-8' if _valid_utf8(head, complete) else _guess(head)
+        return override, override, text
+    if family == 'utf-8' and not _valid_utf8(head, complete):
+        guess = _guess(head)
+        return guess, guess, text
+    return encoding, None, text
+
+
+def sniff(head):
+    """
+    The Verdict on a document starting with `head`, its first SNIFF_BYTES
+    bytes, or all of it if shorter. A document that can't be judged from
+    its head is accepted for the parser to decide.
+    """
+    complete = len(head) < SNIFF_BYTES
+    if isinstance(head, unicode):
+        encoding, override, text = None, None, head
+    else:
+        found = _encoding(head, complete)
+        if isinstance(found, Verdict):
+            return found
+        encoding, override, text = found
+
+    if not text.strip():
+        if complete:
+            return reject(u"Empty document", encoding)
+        return accept(encoding, override)
+    if DOCTYPE_HTML.match(text):
+        return reject(u"HTML document", encoding)
+    pos = 0
+    while True:
+        match = PROLOG.match(text, pos)
+        if match is None:
+            break
+        pos = match.end()
+    rest = text[pos:].lstrip()
+    if not rest:
+        # the prolog runs past the head
+        return accept(encoding, override)
+    if not rest.startswith(u'<'):
+        return reject(u"Not an XML document", encoding)
+    root = ROOT.match(rest)
+    if root is None or (not complete and root.end() == len(rest)):
+        # the root element's name may be cut short at the end of the head
+        return accept(encoding, override)
+    name = root.group(1)
+    if name.lower() == u'html':
+        return reject(u"HTML document", encoding)
+    if name.split(u':')[-1] not in ROOTS:
+        return reject(
+            u"Root element <%s> is not <iati-activities>" % name, encoding)
+    return accept(encoding, override)
+
+
+def sniff_file(xmlfile):
+    """
+    The Verdict on an open file or buffer, which is left where it was.
+    Files that can't seek are accepted unread.
+    """
+    try:
+        pos = xmlfile.tell()
+        xmlfile.seek(pos)
+    except (AttributeError, IOError):
+        return accept()
+    head = xmlfile.read(SNIFF_BYTES)
+    xmlfile.seek(pos)
+    return sniff(head)
@@ -0,0 +1,211 @@
+"""
+Synthetic IATI activity files, for benchmarking the parser.
+
+Activities are built from the codelists in roughly the shape of real
+publisher data: a few participating organisations drawn from a shared
+pool, one to five sectors and recipient countries with percentages adding
+up to 100, a budget per year and a long tail of transactions. The same
+seed gives the same file.
+"""
+import random
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+from iatilib import codelists
+
+VERSIONS = {'1': '1.05', '2': '2.03'}
+
+# Organisations shared between the activities of a file
+ORGANISATIONS = 200
+# Mean number of transactions per activity, most have a few, some hundreds
+MEAN_TRANSACTIONS = 12
+MAX_TRANSACTIONS = 500
+
+WORDS = u"""
+access agriculture basic capacity care children climate community
+development district education emergency energy food governance health
+improved infrastructure livelihoods local management maternal national
+nutrition programme project provision reform regional resilience rural
+sanitation schools services social strengthening support sustainable
+systems training water women youth
+""".split()
+
+SIZE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$", re.I)
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size):
+    "Bytes in a size such as 500KB, 10MB or 1GB"
+    match = SIZE.match(size)
+    if match is None:
+        raise ValueError("Not a size: %s" % size)
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def major_version(version):
+    return '2' if version.startswith('2.') else '1'
+
+
+class Generator(object):
+    def __init__(self, version='2.03', seed=0):
+        self.version = version
+        self.major_version = major_version(version)
+        self.random = random.Random(seed)
+        self.prefix = u"XI-BENCH-%d" % seed
+        cl = codelists.by_major_version[self.major_version]
+
+        def codes(codelist):
+            return sorted(codelist.values())
+
+        self.codes = dict((name, codes(getattr(cl, name))) for name in [
+            'ActivityStatus', 'AidType', 'CollaborationType', 'Country',
+            'FinanceType', 'FlowType', 'OrganisationRole', 'OrganisationType',
+            'PolicyMarker', 'Sector', 'TiedStatus', 'TransactionType'])
+        # the five digit DAC codes, the three digit ones are categories
+        self.codes['Sector'] = [c for c in self.codes['Sector'] if len(c) == 5]
+        self.currencies = [u"EUR", u"GBP", u"USD"]
+        self.organisations = [
+            (u"XI-ORG-%d" % i, self.sentence(2, 5).title(),
+             self.random.choice(self.codes['OrganisationType']))
+            for i in range(ORGANISATIONS)]
+        self.count = 0
+
+    def sentence(self, low, high):
+        return u" ".join(self.random.sample(WORDS, self.random.randint(low, high)))
+
+    def narrative(self, text):
+        if self.major_version == '2':
+            return u"<narrative>%s</narrative>" % escape(text)
+        return escape(text)
+
+    def date(self, year):
+        return u"%d-%02d-%02d" % (year, self.random.randint(1, 12),
+                                  self.random.randint(1, 28))
+
+    def percentages(self, count):
+        "`count` whole percentages adding up to 100"
+        cuts = sorted(self.random.sample(range(1, 100), count - 1))
+        return [b - a for a, b in zip([0] + cuts, cuts + [100])]
+
+    def org(self, tag, organisation, attrs=u""):
+        ref, name, type = organisation
+        return u'<%s ref=%s type="%s"%s>%s</%s>' % (
+            tag, quoteattr(ref), type, attrs, self.narrative(name), tag)
+
+    def activity_date(self, kind, year):
+        types = {'1': ['start-planned', 'start-actual', 'end-planned', 'end-actual'],
+                 '2': ['1', '2', '3', '4']}[self.major_version]
+        return u'<activity-date type="%s" iso-date="%s"/>' % (
+            types[kind], self.date(year))
+
+    def transaction(self, year, currency, identifier):
+        r = self.random
+        provider = r.choice(self.organisations)
+        receiver = r.choice(self.organisations)
+        date = self.date(year)
+        parts = [
+            u'<transaction>',
+            u'<transaction-type code="%s"/>' % r.choice(self.codes['TransactionType']),
+            u'<transaction-date iso-date="%s"/>' % date,
+            u'<value currency="%s" value-date="%s">%d</value>' % (
+                currency, date, r.randint(100, 5000000)),
+            u'<description>%s</description>' % self.narrative(self.sentence(3, 8)),
+            self.org(u'provider-org', provider,
+                     u' provider-activity-id=%s' % quoteattr(identifier)),
+            self.org(u'receiver-org', receiver),
+        ]
+        if r.random() < 0.3:
+            parts.append(u'<flow-type code="%s"/>' % r.choice(self.codes['FlowType']))
+            parts.append(u'<finance-type code="%s"/>' % r.choice(self.codes['FinanceType']))
+            parts.append(u'<aid-type code="%s"/>' % r.choice(self.codes['AidType']))
+            parts.append(u'<tied-status code="%s"/>' % r.choice(self.codes['TiedStatus']))
+        parts.append(u'</transaction>')
+        return u"".join(parts)
+
+    def activity(self):
+        r = self.random
+        self.count += 1
+        identifier = u"%s-%08d" % (self.prefix, self.count)
+        currency = r.choice(self.currencies)
+        start = r.randint(2005, 2018)
+        end = start + r.randint(1, 6)
+        reporting = self.organisations[0]
+        vocabulary = u"DAC" if self.major_version == '1' else u"1"
+        parts = [
+            u'<iati-activity default-currency="%s" hierarchy="%d" '
+            u'last-updated-datetime="%sT12:00:00" xml:lang="en">' % (
+                currency, r.choice([1, 1, 1, 2]), self.date(2020)),
+            u'<iati-identifier>%s</iati-identifier>' % identifier,
+            self.org(u'reporting-org', reporting),
+            u'<title>%s</title>' % self.narrative(self.sentence(3, 8).capitalize()),
+            u'<description>%s</description>' % self.narrative(
+                u". ".join(self.sentence(6, 15).capitalize() for _ in range(r.randint(1, 4)))),
+        ]
+        participants = r.randint(2, 4)
+        for role, organisation in zip(
+                r.sample(self.codes['OrganisationRole'], participants),
+                r.sample(self.organisations, participants)):
+            parts.append(self.org(u'participating-org', organisation,
+                                  u' role="%s"' % role))
+        parts.append(u'<activity-status code="%s"/>' % r.choice(self.codes['ActivityStatus']))
+        parts.append(self.activity_date(0, start))
+        parts.append(self.activity_date(1, start))
+        parts.append(self.activity_date(2, end))
+        countries = r.sample(self.codes['Country'], r.randint(1, 3))
+        for code, percentage in zip(countries, self.percentages(len(countries))):
+            parts.append(u'<recipient-country code="%s" percentage="%d"/>' % (code, percentage))
+        sectors = r.sample(self.codes['Sector'], r.randint(1, 5))
+        for code, percentage in zip(sectors, self.percentages(len(sectors))):
+            parts.append(u'<sector code="%s" vocabulary="%s" percentage="%d"/>' % (
+                code, vocabulary, percentage))
+        for code in r.sample(self.codes['PolicyMarker'], r.randint(0, 3)):
+            parts.append(u'<policy-marker code="%s" significance="1" vocabulary="1"/>' % code)
+        parts.extend([
+            u'<collaboration-type code="%s"/>' % r.choice(self.codes['CollaborationType']),
+            u'<default-flow-type code="%s"/>' % r.choice(self.codes['FlowType']),
+            u'<default-finance-type code="%s"/>' % r.choice(self.codes['FinanceType']),
+            u'<default-aid-type code="%s"/>' % r.choice(self.codes['AidType']),
+            u'<default-tied-status code="%s"/>' % r.choice(self.codes['TiedStatus']),
+        ])
+        for year in range(start, end):
+            parts.append(
+                u'<budget type="1"><period-start iso-date="%d-01-01"/>'
+                u'<period-end iso-date="%d-12-31"/>'
+                u'<value currency="%s" value-date="%d-01-01">%d</value></budget>' % (
+                    year, year, currency, year, r.randint(10000, 10000000)))
+        transactions = min(MAX_TRANSACTIONS,
+                           int(r.expovariate(1.0 / MEAN_TRANSACTIONS)))
+        for _ in range(transactions):
+            parts.append(self.transaction(r.randint(start, end), currency, identifier))
+        if r.random() < 0.2 and self.count > 1:
+            parts.append(u'<related-activity ref="%s-%08d" type="1"/>' % (
+                self.prefix, r.randint(1, self.count - 1)))
+        parts.append(u'</iati-activity>')
+        return u"\n ".join(parts)
+
+    def write(self, f, size=0, count=None):
+        """
+        Write a document of at least `size` bytes, and at least one
+        activity, to the file `f`, or of `count` activities. Returns the
+        number of activities.
+        """
+        start = (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                 u'<iati-activities version="%s" generated-datetime="2020-01-01T00:00:00">\n'
+                 % self.version).encode('utf-8')
+        end = u'</iati-activities>\n'.encode('utf-8')
+        f.write(start)
+        written = len(start) + len(end)
+        activities = 0
+        while (activities < count if count is not None
+               else activities == 0 or written < size):
+            activity = self.activity().encode('utf-8') + '\n'
+            f.write(activity)
+            written += len(activity)
+            activities += 1
+        f.write(end)
+        return activities
+
+
+def write(f, size=0, version='2.03', seed=0, count=None):
+    "Write a synthetic activity file of about `size` bytes, or `count` activities, to `f`"
+    return Generator(version, seed).write(f, size, count)
@@ -7,7 +7,7 @@ from xml.etree import ElementTree as xml_etree
 
 
 from iatilib.frontend import create_app
-from iatilib import db
+from iatilib import db, orgcache
 
 
 def create_db():
@@ -43,6 +43,7 @@ class AppTestCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         db.session._unique_cache = {}
+        orgcache.cache.clear()
 
     def assertXMLEqual(self, x1, x2, msg=None):
         sio = StringIO()
@@ -31,6 +31,32 @@ class TestAboutDatasets(ClientTestCase):
         self.assertEquals(200, resp.status_code)
         self.assertIn("datasets", data)
 
+    def test_about_dataset_parse_stats(self):
+        db.session.add(model.Dataset(name=u"tst", resources=[model.Resource(
+            url=u"http://res", version=u"2.01", activity_count=10,
+            warning_count=2, parse_seconds=0.5)]))
+        db.session.commit()
+        resp = self.client.get('/api/1/about/dataset/tst')
+        resource, = json.loads(resp.data)['resources']
+        self.assertEquals(u"2.01", resource['version'])
+        self.assertEquals(10, resource['num_of_activities_parsed'])
+        self.assertEquals(2, resource['num_of_parser_warnings'])
+        self.assertEquals(0.5, resource['parse_seconds'])
+        self.assertEquals(None, resource['num_of_duplicate_identifiers'])
+        self.assertEquals([], resource['duplicate_identifiers'])
+
+    def test_about_dataset_duplicates(self):
+        db.session.add(model.Dataset(name=u"tst", resources=[model.Resource(
+            url=u"http://res", duplicate_count=1, duplicates=json.dumps([
+                {"iati_identifier": "a", "resource_url": "http://other",
+                 "kept": "stored"}]))]))
+        db.session.commit()
+        resp = self.client.get('/api/1/about/dataset/tst')
+        resource, = json.loads(resp.data)['resources']
+        self.assertEquals(1, resource['num_of_duplicate_identifiers'])
+        self.assertEquals(u"http://other",
+                          resource['duplicate_identifiers'][0]['resource_url'])
+
 class TestDeletedActivitiesView(ClientTestCase):
     def test_deleted_activities(self):
         db.session.add(model.DeletedActivity(
@@ -45,6 +71,41 @@ class TestDeletedActivitiesView(ClientTestCase):
         self.assertEquals("2000-01-01", deleted_activities[0]['deletion_date'])
 
 
+class TestErrorViews(ClientTestCase):
+    def setUp(self):
+        super(TestErrorViews, self).setUp()
+        db.session.add(model.Log(
+            dataset=u"tst", resource=u"http://res", logger=u"activity_importer",
+            level=u"WARNING", msg=u"Failed to import a valid sector in activity AAA-1",
+            trace=u"Traceback", created_at=datetime(2000, 1, 1),
+            occurrences=3, sample_ids=u"AAA-1\nAAA-2\nAAA-3"))
+        db.session.commit()
+
+    def test_resource_errors(self):
+        resp = self.client.get('/api/1/error/resource?url=http://res')
+        errors = json.loads(resp.data)['errors']
+        self.assertEquals(3, errors[0]['count'])
+        self.assertEquals(
+            [u"AAA-1", u"AAA-2", u"AAA-3"], errors[0]['sample_identifiers'])
+
+    def test_dataset_errors(self):
+        resp = self.client.get('/api/1/error/dataset/tst')
+        errors = json.loads(resp.data)['errors']
+        self.assertEquals(u"http://res", errors[0]['resource_url'])
+        self.assertEquals(3, errors[0]['count'])
+
+    def test_errored_datasets(self):
+        resp = self.client.get('/api/1/error/dataset/')
+        self.assertEquals(
+            [{u"dataset": u"tst", u"logger": u"activity_importer"}],
+            json.loads(resp.data)['errored_datasets'])
+
+    def test_dataset_log(self):
+        resp = self.client.get('/api/1/error/dataset.log/tst')
+        self.assertEquals(200, resp.status_code)
+        self.assertIn("(3 times)", resp.data)
+
+
 class TestEmptyDb_JSON(ClientTestCase):
     url = '/api/1/access/activity'
 
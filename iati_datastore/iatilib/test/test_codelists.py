@@ -0,0 +1,108 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from . import AppTestCase
+
+from iatilib import db, codelists as cl
+from iatilib.codelists import enum
+from iatilib.model import Transaction
+from iatilib.test import factories as fac
+
+
+class TestEnumSymbol(TestCase):
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, cl.Sector.from_string(u"11220"),
+                          "extra", 1)
+
+    def test_known_pickles_to_class_attribute(self):
+        sym = cl.Sector.from_string(u"11220")
+        self.assertIs(sym, pickle.loads(pickle.dumps(sym)))
+
+    def test_unknown_pickles(self):
+        sym = cl.Sector.from_string(u"notacode")
+        self.assertEquals(sym, pickle.loads(pickle.dumps(sym)))
+
+
+class TestFromString(TestCase):
+    def test_known(self):
+        self.assertIs(cl.Currency.us_dollar, cl.Currency.from_string(u"USD"))
+
+    def test_case_insensitive(self):
+        self.assertIs(cl.Currency.us_dollar, cl.Currency.from_string(u"usd"))
+
+    def test_unknown_interned(self):
+        sym = cl.Currency.from_string(u"XXY")
+        self.assertIs(sym, cl.Currency.from_string(u"XXY"))
+        self.assertEquals(u"XXY", sym.value)
+        self.assertEquals(None, sym.name)
+
+    def test_unknown_per_codelist(self):
+        self.assertIsNot(cl.Currency.from_string(u"ZZ"),
+                         cl.Country.from_string(u"ZZ"))
+
+    def test_unknown_bounded(self):
+        for i in range(enum.UNKNOWN_CACHE_SIZE + 1):
+            cl.Language.from_string(u"unknown-%d" % i)
+        self.assertLessEqual(len(cl.Language._unknown), enum.UNKNOWN_CACHE_SIZE)
+
+    def test_none(self):
+        self.assertEquals(None, cl.Currency.from_string(None).value)
+
+    def test_values_keep_case(self):
+        self.assertIn(u"USD", cl.Currency.values())
+
+
+class TestDeclEnumType(AppTestCase):
+    def test_load(self):
+        fac.TransactionFactory.create(
+            value_currency=cl.Currency.us_dollar,
+            type=cl.TransactionType.from_string(u"notacode"))
+        db.session.expunge_all()
+        trans = Transaction.query.one()
+        self.assertIs(cl.Currency.us_dollar, trans.value_currency)
+        self.assertEquals(u"notacode", trans.type.value)
+
+    def test_load_strips(self):
+        fac.TransactionFactory.create()
+        db.session.execute(Transaction.__table__.update().values(
+            value_currency=u" USD "))
+        db.session.expunge_all()
+        self.assertIs(cl.Currency.us_dollar, Transaction.query.one().value_currency)
+
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "codelists.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        cl.build_cache(self.filename)
+        cached = cl.read_cache(self.filename)
+        self.assertEquals(cl.read_csv('2', 'Sector'), cached['2']['Sector'])
+        self.assertEquals(set(cl.urls['1']), set(cached['1']))
+
+    def test_missing(self):
+        self.assertEquals(None, cl.read_cache(self.filename))
+
+    def test_corrupt(self):
+        with open(self.filename, "wb") as f:
+            f.write("not a cache")
+        self.assertEquals(None, cl.read_cache(self.filename))
+
+    def test_stale(self):
+        cl.build_cache(self.filename)
+        with mock.patch.object(cl, "fingerprint", return_value=[]):
+            self.assertEquals(None, cl.read_cache(self.filename))
+
+    def test_old_version(self):
+        cl.build_cache(self.filename)
+        with mock.patch.object(cl, "CACHE_VERSION", cl.CACHE_VERSION + 1):
+            self.assertEquals(None, cl.read_cache(self.filename))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import TestCase
+
+import mock
+import sqlalchemy as sa
+
+from . import AppTestCase
+from . import factories as fac
+
+from iatilib import compression, db, ingest, parse
+from iatilib.compression import ZLIB, compress, decompress
+from iatilib.model import Activity, Resource
+
+RAW_XML = u"<iati-activity><iati-identifier>x</iati-identifier>%s</iati-activity>" % (
+    u"<title>caf\xe9 – water</title>" * 20)
+
+
+def stored(column, key):
+    "The bytes stored in `column` for the row with primary key `key`"
+    table = column.table
+    return str(db.session.execute(
+        sa.select([sa.type_coerce(column, sa.LargeBinary)]).where(
+            table.primary_key.columns.values()[0] == key)).scalar())
+
+
+class TestCodec(TestCase):
+    def test_round_trip(self):
+        data = RAW_XML.encode('utf-8')
+        value = compress(data)
+        self.assertTrue(value.startswith(ZLIB))
+        self.assertLess(len(value), len(data) / 4)
+        self.assertEquals(data, decompress(value))
+
+    def test_small_left_alone(self):
+        self.assertEquals("<a/>", compress("<a/>"))
+        self.assertEquals("<a/>", decompress("<a/>"))
+
+    def test_level_zero(self):
+        data = RAW_XML.encode('utf-8')
+        self.assertEquals(data, compress(data, 0))
+        with mock.patch.object(compression, "COMPRESS_LEVEL", 0):
+            self.assertEquals(data, compress(data))
+
+    def test_compressed_not_compressed_again(self):
+        value = compress(RAW_XML.encode('utf-8'))
+        self.assertEquals(value, compress(value))
+
+    def test_marker_without_zlib_read_as_is(self):
+        # no zlib header after the marker, a header but no zlib stream
+        for data in [ZLIB + "<a/>" * 20, ZLIB + "x\x9c" + "<a/>" * 20, ZLIB]:
+            self.assertEquals(data, decompress(data))
+            self.assertEquals(data, decompress(compress(data)))
+
+    def test_utf16(self):
+        data = RAW_XML.encode('utf-16-be')
+        self.assertTrue(data.startswith('\x00'))
+        self.assertEquals(data, decompress(compress(data)))
+
+
+class TestColumns(AppTestCase):
+    def test_raw_xml(self):
+        fac.ActivityFactory.create(iati_identifier=u"x", raw_xml=RAW_XML)
+        db.session.expunge_all()
+        self.assertTrue(compression.is_compressed(stored(Activity.raw_xml, u"x")))
+        self.assertEquals(RAW_XML, Activity.query.get(u"x").raw_xml)
+
+    def test_raw_xml_deferred(self):
+        fac.ActivityFactory.create(iati_identifier=u"x", raw_xml=RAW_XML)
+        db.session.expunge_all()
+        activity = Activity.query.get(u"x")
+        self.assertNotIn("raw_xml", activity.__dict__)
+        self.assertEquals(RAW_XML, activity.raw_xml)
+
+    def test_document(self):
+        document = RAW_XML.encode('utf-8')
+        fac.ResourceFactory.create(url=u"http://foo", document=document)
+        db.session.expunge_all()
+        self.assertTrue(compression.is_compressed(stored(Resource.document, u"http://foo")))
+        self.assertEquals(document, Resource.query.get(u"http://foo").document)
+
+    def test_uncompressed_rows_read(self):
+        fac.ActivityFactory.create(iati_identifier=u"x")
+        db.session.execute(
+            Activity.__table__.update().values(
+                raw_xml=sa.bindparam('raw', type_=sa.LargeBinary)),
+            {"raw": RAW_XML.encode('utf-8')})
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEquals(RAW_XML, Activity.query.get(u"x").raw_xml)
+
+    def test_bulk_writer(self):
+        # bytes, so the test doesn't depend on the locale's encoding
+        activity = parse.activity(RAW_XML.encode('utf-8'))
+        writer = ingest.BulkWriter()
+        writer.add(activity)
+        writer.flush()
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertTrue(compression.is_compressed(stored(Activity.raw_xml, u"x")))
+        self.assertEquals(RAW_XML, Activity.query.get(u"x").raw_xml)
+
+
+class TestRecompress(AppTestCase):
+    def setUp(self):
+        super(TestRecompress, self).setUp()
+        for i in range(5):
+            fac.ActivityFactory.create(iati_identifier=u"a%d" % i, raw_xml=RAW_XML)
+        fac.ActivityFactory.create(iati_identifier=u"small", raw_xml=u"<a/>")
+
+    def test_recompress(self):
+        table = Activity.__table__
+        args = (table, table.c.iati_identifier, table.c.raw_xml)
+        rewritten, before, after = compression.recompress_column(
+            *args, level=0, batch=2)
+        self.assertEquals(5, rewritten)
+        self.assertLess(before, after)
+        self.assertEquals(RAW_XML.encode('utf-8'), stored(Activity.raw_xml, u"a3"))
+        self.assertEquals(RAW_XML, Activity.query.get(u"a3").raw_xml)
+
+        rewritten, before, after = compression.recompress_column(
+            *args, level=9, batch=4)
+        self.assertEquals(5, rewritten)
+        self.assertTrue(compression.is_compressed(stored(Activity.raw_xml, u"a3")))
+        self.assertEquals((0, after), compression.recompress_column(
+            *args, level=9)[::2])
+
+    def test_compressed_columns(self):
+        self.assertEquals(
+            set([("activity", "raw_xml"), ("resource", "document")]),
+            set((t.name, c.name) for t, _, c in compression.compressed_columns()))
+
+
+class TestSerializers(AppTestCase):
+    def setUp(self):
+        super(TestSerializers, self).setUp()
+        fac.ActivityFactory.create(iati_identifier=u"x", raw_xml=RAW_XML)
+        db.session.expunge_all()
+        self.client = self.app.test_client()
+
+    def test_xml(self):
+        resp = self.client.get("/api/1/access/activity.xml")
+        self.assertIn(u"caf\xe9 – water", resp.data.decode('utf-8'))
+
+    def test_json(self):
+        resp = self.client.get("/api/1/access/activity")
+        activity, = json.loads(resp.data)["iati-activities"]
+        self.assertEquals(u"x", activity["iati-activity"]["iati-identifier"])
+
+    def test_report(self):
+        compression.report(repeat=1)
@@ -1,4 +1,5 @@
 import datetime
+import json
 from unittest import TestCase
 
 import mock
@@ -7,7 +8,7 @@ from . import AppTestCase, fixture_filename
 from . import factories as fac
 
 from iatilib import crawler, db, parse
-from iatilib.model import Dataset, Resource, Activity, DeletedActivity
+from iatilib.model import Dataset, Resource, Activity, DeletedActivity, Log
 
 
 class TestCrawler(AppTestCase):
@@ -128,18 +129,53 @@ class TestCrawler(AppTestCase):
         db.session.commit()
         self.assertEquals(3, Resource.query.count())
 
-    @mock.patch('iatilib.crawler.requests')
+    @mock.patch('iatilib.crawler.sessions.get')
     def test_fetch_resource_succ(self, mock):
-        mock.get.return_value.content = "test"
-        mock.get.return_value.status_code = 200
+        mock.return_value.content = "test"
+        mock.return_value.status_code = 200
         resource = crawler.fetch_resource(Resource(url="http://foo"))
         self.assertEquals("test", resource.document)
         self.assertEquals(None, resource.last_parsed)
         self.assertEquals(None, resource.last_parse_error)
 
-    @mock.patch('iatilib.crawler.requests')
+    @mock.patch('iatilib.crawler.sessions.get')
+    def test_fetch_resource_unchanged(self, mock):
+        mock.return_value.content = "test"
+        mock.return_value.status_code = 200
+        resource = crawler.fetch_resource(Resource(url=u"http://foo"))
+        parsed = datetime.datetime(2000, 1, 1)
+        resource.last_parsed = parsed
+        resource = crawler.fetch_resource(resource)
+        self.assertEquals(parsed, resource.last_parsed)
+        self.assertEquals(1, resource.skipped_parses)
+
+    @mock.patch('iatilib.crawler.sessions.get')
+    def test_fetch_resource_changed(self, mock):
+        mock.return_value.content = "test"
+        mock.return_value.status_code = 200
+        resource = crawler.fetch_resource(Resource(url=u"http://foo"))
+        resource.last_parsed = datetime.datetime(2000, 1, 1)
+        mock.return_value.content = "changed"
+        resource = crawler.fetch_resource(resource)
+        self.assertEquals("changed", resource.document)
+        self.assertEquals(None, resource.last_parsed)
+
+    @mock.patch('iatilib.crawler.get_queue')
+    @mock.patch('iatilib.crawler.sessions.get')
+    def test_update_resource_unchanged_not_enqueued(self, mock, get_queue):
+        mock.return_value.content = "test"
+        mock.return_value.status_code = 200
+        fac.ResourceFactory.create(url=u"http://foo")
+        crawler.update_resource(u"http://foo")
+        self.assertEquals(1, get_queue.return_value.enqueue.call_count)
+        Resource.query.get(u"http://foo").last_parsed = datetime.datetime.utcnow()
+        db.session.commit()
+        crawler.update_resource(u"http://foo")
+        self.assertEquals(1, get_queue.return_value.enqueue.call_count)
+
+    @mock.patch('iatilib.crawler.sessions.get')
     def test_fetch_resource_perm_fail(self, mock):
-        mock.get.return_value.status_code = 404
+        mock.return_value.status_code = 404
         resource = crawler.fetch_resource(Resource(
             url="http://foo",
             document=u"stillhere"
@@ -165,11 +201,12 @@ class TestCrawler(AppTestCase):
             url=u"http://test",
             activities=[act]
         )
+        iati_identifier = act.iati_identifier
         # the updated resource (will remove the activities)
         resource.document="<iati-activities />"
         resource = crawler.parse_resource(resource)
         db.session.commit()
-        self.assertEquals(None, Activity.query.get(act.iati_identifier))
+        self.assertEquals(None, Activity.query.get(iati_identifier))
         self.assertIn(
             "deleted_activity",
             [da.iati_identifier for da in DeletedActivity.query.all()]
@@ -233,6 +270,71 @@ class TestCrawler(AppTestCase):
 
 
 
+    def test_reparse_skips_unchanged_activities(self):
+        resource = fac.ResourceFactory.create(
+            url=u"http://test",
+            document="""
+                <iati-activities>
+                  <iati-activity>
+                    <iati-identifier>same</iati-identifier>
+                    <title>same</title>
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>changed</iati-identifier>
+                    <title>before</title>
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>removed</iati-identifier>
+                  </iati-activity>
+                </iati-activities>
+            """
+        )
+        crawler.parse_resource(resource)
+        db.session.commit()
+        db.session.query(Activity).update(
+            values={'title': u"stored"}, synchronize_session=False)
+        db.session.commit()
+        resource.document = """
+                <iati-activities>
+                  <iati-activity>
+                    <iati-identifier>same</iati-identifier>
+                    <title>same</title>
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>changed</iati-identifier>
+                    <title>after</title>
+                  </iati-activity>
+                </iati-activities>
+            """
+        crawler.parse_resource(resource)
+        db.session.commit()
+        # an unchanged activity is not rewritten
+        self.assertEquals(u"stored", Activity.query.get(u"same").title)
+        self.assertEquals(u"after", Activity.query.get(u"changed").title)
+        self.assertEquals(None, Activity.query.get(u"removed"))
+        self.assertEquals(
+            [u"removed"],
+            [da.iati_identifier for da in DeletedActivity.query.all()])
+
+    def test_reparse_version_change(self):
+        document = """
+                <iati-activities version="{0}">
+                  <iati-activity>
+                    <iati-identifier>same</iati-identifier>
+                    <title>same</title>
+                  </iati-activity>
+                </iati-activities>
+            """
+        resource = fac.ResourceFactory.create(
+            url=u"http://test", document=document.format("1.03"))
+        crawler.parse_resource(resource)
+        db.session.commit()
+        resource.document = document.format("1.04")
+        crawler.parse_resource(resource)
+        db.session.commit()
+        # only the document version changed, which the raw xml leaves out
+        self.assertEquals(u"1.04", Activity.query.get(u"same").version)
+
     def test_parse_resource_fail(self):
         resource = Resource(document="")
         with self.assertRaises(parse.ParserError):
@@ -270,6 +372,9 @@ class TestCrawler(AppTestCase):
         result = crawler.parse_resource(res)
         
         self.assertEquals("1.00", result.version)
+        self.assertEquals(result.activities.count(), result.activity_count)
+        self.assertEquals(0, result.warning_count)
+        self.assertGreater(result.parse_seconds, 0)
 
 
 class TestResourceUpdate(AppTestCase):
@@ -305,6 +410,83 @@ class TestResourceUpdate(AppTestCase):
         )
 
 
+    def test_warnings_aggregated(self):
+        fac.ResourceFactory.create(
+            url=u"http://res",
+            document="""
+                <iati-activities>
+                  <iati-activity>
+                    <iati-identifier>AAA-1</iati-identifier>
+                    <activity-date type="start-planned" iso-date="2012-13-45" />
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>AAA-2</iati-identifier>
+                    <activity-date type="start-planned" iso-date="2012-13-45" />
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>AAA-3</iati-identifier>
+                    <activity-date type="start-planned" iso-date="2012-13-45" />
+                    <activity-date type="end-planned" iso-date="2012-13-46" />
+                  </iati-activity>
+                </iati-activities>
+            """
+        )
+        crawler.update_activities(u"http://res")
+        logs = Log.query.filter_by(resource=u"http://res").order_by(Log.occurrences).all()
+        self.assertEquals([1, 3], [log.occurrences for log in logs])
+        self.assertIn(u"AAA-3", logs[0].msg)
+        self.assertEquals(u"AAA-1\nAAA-2\nAAA-3", logs[1].sample_ids)
+        self.assertTrue(logs[1].trace)
+        self.assertEquals(3, Activity.query.count())
+
+    def test_profile_stored(self):
+        fac.ResourceFactory.create(
+            url=u"http://res",
+            document=open(fixture_filename("complex_example_dfid.xml")).read())
+        crawler.update_activities(u"http://res", profile=True)
+        profile = json.loads(Resource.query.get(u"http://res").parse_profile)
+        fields = [row["field"] for row in profile]
+        self.assertIn("activity.transactions", fields)
+        self.assertEquals(sorted(profile, key=lambda row: -row["seconds"]), profile)
+
+    def test_not_profiled(self):
+        fac.ResourceFactory.create(
+            url=u"http://res",
+            document=open(fixture_filename("complex_example_dfid.xml")).read())
+        crawler.update_activities(u"http://res")
+        self.assertEquals(None, Resource.query.get(u"http://res").parse_profile)
+
+    def test_rejected_without_parsing(self):
+        fac.ResourceFactory.create(
+            url=u"http://res",
+            activities=[fac.ActivityFactory.build(iati_identifier=u"AAA-1")],
+            document="<!DOCTYPE html><html><body>Not Found</body></html>")
+        with mock.patch.object(parse, "activities") as activities:
+            crawler.update_activities(u"http://res")
+        self.assertFalse(activities.called)
+        resource = Resource.query.get(u"http://res")
+        self.assertEquals(u"HTML document", resource.document_rejected)
+        self.assertEquals(u"HTML document", resource.last_parse_error)
+        self.assertEquals(None, resource.last_parsed)
+        self.assertEquals([u"xml_parser"],
+                          [l.logger for l in Log.query.filter_by(resource=u"http://res")])
+        self.assertEquals(1, Activity.query.count())
+
+    def test_verdict_recorded(self):
+        fac.ResourceFactory.create(
+            url=u"http://res",
+            document=u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+                <iati-activities>
+                  <iati-activity><iati-identifier>AAA-1</iati-identifier></iati-activity>
+                </iati-activities>""".encode("iso-8859-1"),
+            document_rejected=u"Empty document")
+        crawler.update_activities(u"http://res")
+        resource = Resource.query.get(u"http://res")
+        self.assertEquals(u"ISO-8859-1", resource.document_encoding)
+        self.assertEquals(None, resource.document_rejected)
+        self.assertEquals(1, Activity.query.count())
+
+
 class TestDate(TestCase):
     def test_date(self):
         # I'm not installing pytz for a single unit test
@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from . import AppTestCase, fixture_filename
+from . import factories as fac
+
+from iatilib import crawler, db, docstore, download, parse
+from iatilib.model import Activity, Resource
+
+
+def read_fixture(name):
+    with open(fixture_filename(name)) as f:
+        return f.read()
+
+
+def files(directory):
+    return sorted(
+        name for _, _, names in os.walk(directory) for name in names)
+
+
+class TestFileStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.data = read_fixture("2.01-example-annotated.xml")
+        self.key = hashlib.md5(self.data).hexdigest()
+
+    def test_compressed(self):
+        store = docstore.FileStore(self.dir, compress=6)
+        self.assertEquals((self.key, True), store.put(self.data))
+        self.assertEquals([self.key + ".xml.gz"], files(self.dir))
+        self.assertLess(store.size(self.key), len(self.data) / 3)
+        self.assertEquals(self.data, store.read(self.key))
+        self.assertIsInstance(store.open(self.key), gzip.GzipFile)
+
+    def test_uncompressed_mmap(self):
+        store = docstore.FileStore(self.dir, compress=0)
+        store.put(self.data)
+        self.assertEquals([self.key + ".xml"], files(self.dir))
+        document = store.open(self.key)
+        self.assertIsInstance(document, mmap.mmap)
+        self.assertEquals(self.data, document[:])
+
+    def test_deduplicates(self):
+        store = docstore.FileStore(self.dir)
+        store.put(self.data)
+        self.assertEquals((self.key, False), store.put(self.data, self.key))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            self.assertEquals((self.key, False), store.put_file(f.name, self.key))
+        self.assertEquals(1, len(files(self.dir)))
+
+    def test_stored_again_touched(self):
+        store = docstore.FileStore(self.dir)
+        store.put(self.data)
+        path = os.path.join(self.dir, self.key[:2], self.key + ".xml.gz")
+        os.utime(path, (0, 0))
+        store.put(self.data)
+        self.assertGreater(store.stored_at(self.key), 0)
+        os.utime(path, (0, 0))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            store.put_file(f.name, self.key)
+        self.assertGreater(store.stored_at(self.key), 0)
+
+    def test_put_file(self):
+        store = docstore.FileStore(self.dir)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.data)
+            f.flush()
+            self.assertEquals((self.key, True), store.put_file(f.name, self.key))
+        self.assertEquals(self.data, store.read(self.key))
+
+    def test_level_changed(self):
+        docstore.FileStore(self.dir, compress=9).put(self.data)
+        store = docstore.FileStore(self.dir, compress=0)
+        self.assertTrue(store.has(self.key))
+        self.assertEquals(self.data, store.read(self.key))
+        self.assertEquals((self.key, False), store.put(self.data))
+
+    def test_keys_remove(self):
+        store = docstore.FileStore(self.dir)
+        store.put(self.data)
+        store.put("<iati-activities/>")
+        self.assertEquals(2, len(list(store.keys())))
+        store.remove(self.key)
+        self.assertEquals(
+            [hashlib.md5("<iati-activities/>").hexdigest()], list(store.keys()))
+        self.assertRaises(IOError, store.open, self.key)
+
+    def test_empty(self):
+        store = docstore.FileStore(self.dir, compress=0)
+        key, _ = store.put("")
+        self.assertEquals("", store.open(key).read())
+
+    def test_get_store(self):
+        self.assertEquals(None, docstore.get_store(None))
+        store = docstore.get_store("file://" + self.dir)
+        self.assertIsInstance(store, docstore.FileStore)
+        self.assertEquals(self.dir, store.root)
+        self.assertEquals(self.dir, docstore.get_store(self.dir).root)
+        self.assertRaises(ValueError, docstore.get_store, "s3://bucket")
+
+
+class StoreMixin(object):
+    compress = 6
+
+    def setUp(self):
+        super(StoreMixin, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name, value in [("DOCUMENT_STORE", self.dir),
+                            ("DOCUMENT_STORE_COMPRESS", self.compress)]:
+            patcher = mock.patch.object(docstore, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = docstore.get_store()
+
+
+class TestParseStored(StoreMixin, AppTestCase):
+    def test_parsers_read_store(self):
+        data = read_fixture("2.01-example-annotated.xml")
+        expected = [a.iati_identifier for a in parse.document(data)]
+        for compress in [6, 0]:
+            self.store.compress = compress
+            key, _ = self.store.put(data)
+            resource = Resource(url=u"http://foo", document_hash=key)
+            self.assertEquals(expected, [
+                a.iati_identifier for a in parse.document(download.document(resource))])
+            self.store.remove(key)
+
+
+class TestStoredResources(StoreMixin, AppTestCase):
+    def setUp(self):
+        super(TestStoredResources, self).setUp()
+        self.data = read_fixture("single_activity.xml")
+        self.key = hashlib.md5(self.data).hexdigest()
+        for url in [u"http://a", u"http://b"]:
+            fac.ResourceFactory.create(url=url, document=None)
+
+    @mock.patch('iatilib.crawler.sessions.get')
+    def test_fetch_and_parse(self, get):
+        get.return_value.status_code = 200
+        get.return_value.content = self.data
+        for url in [u"http://a", u"http://b"]:
+            crawler.fetch_resource(Resource.query.get(url))
+        db.session.commit()
+        self.assertEquals([self.key + ".xml.gz"], files(self.dir))
+        resource = Resource.query.get(u"http://a")
+        self.assertEquals(None, resource.document)
+        self.assertEquals(self.key, resource.document_hash)
+        crawler.update_activities(u"http://a")
+        self.assertEquals(1, Resource.query.get(u"http://a").activities.count())
+
+    def test_streamed(self):
+        from .test_fetcher import PublisherServer
+        server = PublisherServer()
+        self.addCleanup(server.stop)
+        server.documents["/doc"] = self.data
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool)
+        fac.ResourceFactory.create(url=server.url("127.0.0.1", "doc"), document=None)
+        with mock.patch.object(download, "DOWNLOAD_DIR", spool):
+            results = list(crawler.fetch_resources(Resource.query.all()))
+            self.assertEquals([], os.listdir(spool))
+        self.assertEquals(1, len([error for _, error in results if error is None]))
+        self.assertEquals([self.key + ".xml.gz"], files(self.dir))
+
+    def test_migrate(self):
+        for url in [u"http://a", u"http://b"]:
+            Resource.query.get(url).document = self.data
+        fac.ResourceFactory.create(url=u"http://c", document="<iati-activities/>")
+        db.session.commit()
+        docstore.migrate(batch=2)
+        self.assertEquals(0, Resource.query.filter(Resource.document != None).count())
+        self.assertEquals(2, len(files(self.dir)))
+        self.assertEquals(self.key, Resource.query.get(u"http://b").document_hash)
+        crawler.update_activities(u"http://b")
+        self.assertEquals(1, Activity.query.count())
+
+    def test_migrate_downloads(self):
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool)
+        with mock.patch.object(download, "DOWNLOAD_DIR", spool):
+            with open(download.path(u"http://a"), "wb") as f:
+                f.write(self.data)
+            Resource.query.get(u"http://a").document_hash = self.key
+            db.session.commit()
+            docstore.migrate()
+            self.assertEquals([], os.listdir(spool))
+        self.assertEquals(self.data, self.store.read(self.key))
+
+    def test_gc(self):
+        self.store.put(self.data)
+        Resource.query.get(u"http://a").document_hash = self.key
+        old, _ = self.store.put("<iati-activities/>")
+        db.session.commit()
+        docstore.gc()
+        self.assertEquals(2, len(list(self.store.keys())))
+        docstore.gc(grace=-1)
+        self.assertEquals([self.key], list(self.store.keys()))
+
+    def test_gc_keeps_stored_again(self):
+        old, _ = self.store.put(self.data)
+        path = os.path.join(self.dir, old[:2], old + ".xml.gz")
+        os.utime(path, (0, 0))
+        # fetched again, its resource not yet committed
+        self.store.put(self.data)
+        docstore.gc()
+        self.assertEquals([old], list(self.store.keys()))
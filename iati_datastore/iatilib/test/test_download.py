@@ -0,0 +1,180 @@
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from . import AppTestCase, fixture_filename
+from . import factories as fac
+from .test_fetcher import PublisherServer
+
+from iatilib import crawler, db, download, parse
+from iatilib.model import Activity, Dataset, Resource
+
+
+class DownloadDirMixin(object):
+    def setUp(self):
+        super(DownloadDirMixin, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patcher = mock.patch.object(download, "DOWNLOAD_DIR", self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = PublisherServer()
+        self.addCleanup(self.server.stop)
+
+    def files(self):
+        return os.listdir(self.dir)
+
+
+class TestDownload(DownloadDirMixin, TestCase):
+    body = "<iati-activities>%s</iati-activities>" % ("x" * 200000)
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.server.documents["/doc"] = self.body
+        self.url = self.server.url("127.0.0.1", "doc")
+
+    def test_spools(self):
+        resp = download.get(self.url)
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals(len(self.body), resp.size)
+        self.assertEquals(hashlib.md5(self.body).hexdigest(), resp.md5)
+        with open(resp.path) as f:
+            self.assertEquals(self.body, f.read())
+        download.keep(self.url, resp)
+        self.assertEquals([os.path.basename(download.path(self.url))], self.files())
+
+    def test_content_length_over_limit(self):
+        resp = download.get(self.url, max_bytes=1000)
+        self.assertIn("Content-Length", resp.too_large)
+        self.assertEquals(None, resp.path)
+        self.assertEquals([], self.files())
+
+    def test_body_over_limit(self):
+        self.server.content_length = False
+        resp = download.get(self.url, max_bytes=100000)
+        self.assertIn("100000 bytes", resp.too_large)
+        self.assertEquals(None, resp.path)
+        self.assertEquals([], self.files())
+
+    def test_not_modified(self):
+        resp = download.get(self.url, headers={"If-None-Match": '"/doc"'})
+        self.assertEquals(304, resp.status_code)
+        self.assertEquals(None, resp.path)
+        self.assertEquals([], self.files())
+
+    def test_document_mmap(self):
+        download.keep(self.url, download.get(self.url))
+        document = download.document(Resource(url=self.url))
+        self.assertIsInstance(document, mmap.mmap)
+        self.assertEquals(self.body, document[:])
+
+    def test_document_empty(self):
+        self.server.documents["/doc"] = ""
+        download.keep(self.url, download.get(self.url))
+        self.assertEquals("", download.document(Resource(url=self.url)).read())
+
+    def test_document_not_streamed(self):
+        resource = Resource(url=self.url, document="<iati-activities/>")
+        self.assertEquals("<iati-activities/>", download.document(resource))
+
+
+class TestParseMmap(DownloadDirMixin, AppTestCase):
+    def test_parsers_read_mmap(self):
+        with open(fixture_filename("2.01-example-annotated.xml")) as f:
+            self.server.documents["/doc"] = f.read()
+        url = self.server.url("127.0.0.1", "doc")
+        download.keep(url, download.get(url))
+        resource = Resource(url=url)
+        expected = [a.iati_identifier for a in parse.document(
+            fixture_filename("2.01-example-annotated.xml"))]
+        self.assertTrue(expected)
+        self.assertEquals(expected, [
+            a.iati_identifier for a in parse.document(download.document(resource))])
+
+
+class TestStreamedResources(DownloadDirMixin, AppTestCase):
+    def setUp(self):
+        super(TestStreamedResources, self).setUp()
+        with open(fixture_filename("single_activity.xml")) as f:
+            self.body = f.read()
+        self.server.documents["/doc"] = self.body
+        self.url = self.server.url("127.0.0.1", "doc")
+        fac.DatasetFactory.create(name=u"tst", resources=[
+            fac.ResourceFactory.create(url=self.url, document=None)])
+
+    def fetch(self):
+        resource = Resource.query.get(self.url)
+        # the server answers If-None-Match, not If-Modified-Since
+        resource.etag = None
+        crawler.fetch_resource(resource)
+        db.session.commit()
+
+    def test_fetch_and_parse(self):
+        crawler.fetch_resource(Resource.query.get(self.url))
+        db.session.commit()
+        resource = Resource.query.get(self.url)
+        self.assertEquals(None, resource.document)
+        self.assertEquals(hashlib.md5(self.body).hexdigest(), resource.document_hash)
+        self.assertEquals([os.path.basename(download.path(self.url))], self.files())
+
+        crawler.update_activities(self.url)
+        self.assertEquals(1, Activity.query.count())
+        self.assertTrue(Resource.query.get(self.url).last_parsed)
+
+    def test_unchanged_discarded(self):
+        self.fetch()
+        crawler.update_activities(self.url)
+        self.fetch()
+        self.assertEquals(1, Resource.query.get(self.url).skipped_parses)
+        self.assertEquals(1, len(self.files()))
+
+    def test_too_large(self):
+        crawler.fetch_resource(Resource.query.get(self.url))
+        db.session.commit()
+        self.server.documents["/doc"] = "<iati-activities/>" * 1000
+        with mock.patch.object(download, "DOWNLOAD_MAX_BYTES", 1000):
+            self.fetch()
+        resource = Resource.query.get(self.url)
+        self.assertIn("1000 bytes", resource.document_rejected)
+        self.assertEquals(hashlib.md5(self.body).hexdigest(), resource.document_hash)
+        with open(download.path(self.url)) as f:
+            self.assertEquals(self.body, f.read())
+
+    @mock.patch('iatilib.crawler.get_queue')
+    def test_too_large_not_parsed(self, get_queue):
+        self.server.documents["/doc"] = "<iati-activities/>" * 1000
+        with mock.patch.object(download, "DOWNLOAD_MAX_BYTES", 1000):
+            crawler.update_resource(self.url)
+        self.assertFalse(get_queue.return_value.enqueue.called)
+        # nothing to parse if it's run anyway
+        crawler.update_activities(self.url)
+        resource = Resource.query.get(self.url)
+        self.assertIn("No document", resource.last_parse_error)
+        self.assertEquals(None, resource.last_parsed)
+
+    def test_fetch_resources(self):
+        results = list(crawler.fetch_resources(Resource.query.all(), threads=2))
+        self.assertEquals([None], [error for _, error in results])
+        self.assertEquals(None, Resource.query.get(self.url).document)
+        self.assertTrue(os.path.exists(download.path(self.url)))
+
+    def test_stored_document_replaces_file(self):
+        crawler.fetch_resource(Resource.query.get(self.url))
+        db.session.commit()
+        with mock.patch.object(download, "streaming", return_value=False):
+            self.server.documents["/doc"] = "<iati-activities/>"
+            self.fetch()
+        self.assertEquals("<iati-activities/>", Resource.query.get(self.url).document)
+        self.assertEquals([], self.files())
+
+    def test_deleted_dataset_removes_file(self):
+        crawler.fetch_resource(Resource.query.get(self.url))
+        db.session.commit()
+        crawler.delete_datasets([u"tst"])
+        self.assertEquals(0, Dataset.query.count())
+        self.assertEquals([], self.files())
@@ -0,0 +1,131 @@
+import datetime
+import json
+
+import mock
+
+from . import AppTestCase
+from . import factories as fac
+
+from iatilib import crawler, db, ingest, parse
+from iatilib.duplicates import Duplicates
+from iatilib.model import Activity, Resource, Transaction
+
+DOCUMENT = """<iati-activities version="1.05">
+  <iati-activity last-updated-datetime="2015-01-01T00:00:00">
+    <iati-identifier>shared</iati-identifier>
+    <title>new</title>
+    <transaction><transaction-type code="D" /><value>20</value></transaction>
+  </iati-activity>
+  <iati-activity>
+    <iati-identifier>own</iati-identifier>
+  </iati-activity>
+</iati-activities>"""
+
+
+class TestDuplicates(AppTestCase):
+    def setUp(self):
+        super(TestDuplicates, self).setUp()
+        fac.ResourceFactory.create(
+            url=u"http://res1",
+            activities=[fac.ActivityFactory.build(
+                iati_identifier=u"shared", title=u"stored",
+                last_updated_datetime=datetime.datetime(2014, 1, 1),
+                transactions=[fac.TransactionFactory.build(
+                    activity=None, value_amount=10)])])
+        fac.ResourceFactory.create(url=u"http://res2", document=DOCUMENT)
+
+    def update(self, policy, **kw):
+        crawler.update_activities(u"http://res2", duplicate_policy=policy, **kw)
+        return Resource.query.get(u"http://res2")
+
+    def test_first_wins(self):
+        for kw in [{}, {"bulk": True}, {"swap": True}]:
+            resource = self.update("first-wins", **kw)
+            self.assertEquals(u"stored", Activity.query.get(u"shared").title)
+            self.assertEquals([u"own"], [a.iati_identifier for a in resource.activities])
+            self.assertEquals(1, resource.duplicate_count)
+            self.assertEquals(
+                [{"iati_identifier": "shared", "resource_url": "http://res1",
+                  "kept": "stored"}],
+                json.loads(resource.duplicates))
+            Activity.query.filter_by(iati_identifier=u"own").delete()
+            db.session.commit()
+
+    def test_newest_wins(self):
+        self.assertEquals([10], [int(t.value_amount) for t in Transaction.query])
+        resource = self.update("newest-wins")
+        shared = Activity.query.get(u"shared")
+        self.assertEquals(u"new", shared.title)
+        self.assertEquals(u"http://res2", shared.resource_url)
+        self.assertEquals([20], [int(t.value_amount) for t in Transaction.query])
+        self.assertEquals(
+            [{"iati_identifier": "shared", "resource_url": "http://res1",
+              "kept": "new"}],
+            json.loads(resource.duplicates))
+
+    def test_newest_wins_swap(self):
+        swap = ingest.StagingWriter.swap
+
+        def check_then_swap(writer):
+            # the replaced activity is left as it is until the swap
+            self.assertEquals(u"http://res1", db.session.query(
+                Activity.resource_url).filter_by(iati_identifier=u"shared").scalar())
+            self.assertEquals([u"shared"], writer.replaced)
+            return swap(writer)
+
+        with mock.patch.object(ingest.StagingWriter, "swap", check_then_swap):
+            resource = self.update("newest-wins", swap=True)
+        shared = Activity.query.get(u"shared")
+        self.assertEquals(u"new", shared.title)
+        self.assertEquals(u"http://res2", shared.resource_url)
+        self.assertEquals([20], [int(t.value_amount) for t in Transaction.query])
+        self.assertEquals("new", json.loads(resource.duplicates)[0]["kept"])
+
+    def test_newest_wins_keeps_newer_stored(self):
+        Activity.query.get(u"shared").last_updated_datetime = \
+            datetime.datetime(2016, 1, 1)
+        db.session.commit()
+        resource = self.update("newest-wins")
+        self.assertEquals(u"stored", Activity.query.get(u"shared").title)
+        self.assertEquals("stored", json.loads(resource.duplicates)[0]["kept"])
+
+    def test_reject(self):
+        resource = self.update("reject")
+        self.assertEquals(u"stored", Activity.query.get(u"shared").title)
+        self.assertEquals(0, resource.activities.count())
+        self.assertEquals(None, resource.last_parsed)
+        self.assertIn("shared", resource.last_parse_error)
+        self.assertEquals(1, resource.duplicate_count)
+
+    def test_reject_chunked(self):
+        document = "<iati-activities version=\"1.05\">%s</iati-activities>" % "".join(
+            "<iati-activity><iati-identifier>%s</iati-identifier></iati-activity>" % i
+            for i in ["a%d" % n for n in range(6)] + ["shared", "own"])
+        Resource.query.get(u"http://res2").document = document
+        db.session.commit()
+        for kw in [{}, {"bulk": True}]:
+            with mock.patch.object(ingest, "BATCH_SIZE", 2):
+                resource = self.update("reject", chunk_size=2, **kw)
+            self.assertEquals(0, resource.activities.count())
+            self.assertEquals(None, resource.last_parsed)
+            self.assertEquals(1, resource.duplicate_count)
+
+    def test_no_conflicts(self):
+        Activity.query.delete()
+        db.session.commit()
+        resource = self.update("reject")
+        self.assertEquals(2, resource.activities.count())
+        self.assertEquals(0, resource.duplicate_count)
+        self.assertEquals(None, resource.duplicates)
+
+    def test_one_query_per_batch(self):
+        activities = [parse.activity(
+            u"<iati-activity><iati-identifier>%d</iati-identifier></iati-activity>" % i)
+            for i in range(50)]
+        with mock.patch.object(db.session, "query", wraps=db.session.query) as query:
+            kept = Duplicates(u"http://res2").filter(activities)
+        self.assertEquals(50, len(kept))
+        self.assertEquals(1, query.call_count)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, Duplicates, u"http://res2", "last-wins")
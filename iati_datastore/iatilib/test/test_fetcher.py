@@ -0,0 +1,176 @@
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from SocketServer import ThreadingMixIn
+from unittest import TestCase
+
+import requests
+
+from . import AppTestCase
+from . import factories as fac
+
+from iatilib import crawler, db, fetcher
+from iatilib.model import Resource
+
+
+class PublisherServer(ThreadingMixIn, HTTPServer):
+    """
+    Stands in for publishers' web servers on 127.0.0.x, serving a small
+    document at every path after `delay` seconds, with an ETag, or the
+    body set for the path in `documents`. With `keep_alive` connections
+    are kept open for further requests, without `content_length` bodies
+    are sent with no Content-Length.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, delay=0, keep_alive=False):
+        HTTPServer.__init__(self, ('0.0.0.0', 0),
+                            KeepAliveHandler if keep_alive else PublisherHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = defaultdict(int)
+        self.most = defaultdict(int)
+        self.headers = {}
+        self.documents = {}
+        self.content_length = True
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, host, path):
+        return u"http://%s:%d/%s" % (host, self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class PublisherHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        server = self.server
+        host = self.headers.get("Host").split(":")[0]
+        with server.lock:
+            server.headers[self.path] = dict(self.headers)
+            server.active[host] += 1
+            server.most[host] = max(server.most[host], server.active[host])
+        try:
+            time.sleep(server.delay)
+        finally:
+            # before responding, when the client may start its next request
+            with server.lock:
+                server.active[host] -= 1
+        etag = '"%s"' % self.path
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.documents.get(
+            self.path, "<iati-activities><!-- %s --></iati-activities>" % self.path)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if server.content_length:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveHandler(PublisherHandler):
+    protocol_version = "HTTP/1.1"
+
+
+def hosts(count):
+    return ["127.0.0.%d" % (i + 1) for i in range(count)]
+
+
+class TestFetcher(TestCase):
+    def setUp(self):
+        self.server = PublisherServer(delay=0.02)
+        self.addCleanup(self.server.stop)
+
+    def requests(self, count, host_count):
+        return [
+            (i, self.server.url(host, i), {})
+            for i, host in enumerate(hosts(host_count) * (count // host_count))]
+
+    def test_fetches_all(self):
+        results = list(fetcher.Fetcher(threads=8).fetch(self.requests(40, 4)))
+        self.assertEquals(range(40), sorted(r.key for r in results))
+        self.assertTrue(all(r.response.status_code == 200 for r in results))
+
+    def test_per_host_limit(self):
+        list(fetcher.Fetcher(threads=16, per_host=3).fetch(self.requests(120, 4)))
+        self.assertEquals(hosts(4), sorted(self.server.most))
+        for host in hosts(4):
+            self.assertLessEqual(self.server.most[host], 3)
+            self.assertGreater(self.server.most[host], 1)
+
+    def test_hosts_not_held_up(self):
+        # a host with many documents does not hold up the others
+        requests = [(i, self.server.url("127.0.0.1", i), {}) for i in range(40)]
+        requests.append(("other", self.server.url("127.0.0.2", "other"), {}))
+        keys = [r.key for r in fetcher.Fetcher(threads=4, per_host=2).fetch(requests)]
+        self.assertLess(keys.index("other"), 10)
+
+    def test_errors_returned(self):
+        closed = PublisherServer()
+        url = closed.url("127.0.0.1", "gone")
+        closed.stop()
+        result, = fetcher.Fetcher().fetch([("gone", url, {})])
+        self.assertEquals(None, result.response)
+        self.assertIsInstance(result.error, requests.ConnectionError)
+
+    def test_faster_than_serial(self):
+        pending = self.requests(1000, 8)
+        start = time.time()
+        for key, url, headers in pending[:100]:
+            requests.get(url, headers=headers)
+        serial = (time.time() - start) * 10
+        start = time.time()
+        results = list(fetcher.Fetcher(threads=32, per_host=4).fetch(pending))
+        concurrent = time.time() - start
+        self.assertEquals(1000, len(results))
+        self.assertLess(concurrent, serial / 4)
+
+
+class TestFetchResources(AppTestCase):
+    def setUp(self):
+        super(TestFetchResources, self).setUp()
+        self.server = PublisherServer()
+        self.addCleanup(self.server.stop)
+
+    def test_conditional_get(self):
+        for host in hosts(3):
+            for i in range(5):
+                fac.ResourceFactory.create(url=self.server.url(host, i))
+        resources = Resource.query.all()
+        results = list(crawler.fetch_resources(resources, threads=4, per_host=2))
+        self.assertEquals(15, len(results))
+        self.assertEquals(set([None]), set(error for _, error in results))
+        db.session.expire_all()
+        for resource in Resource.query:
+            self.assertEquals(200, resource.last_status_code)
+            self.assertTrue(resource.document.startswith("<iati-activities>"))
+            self.assertEquals(u'"/%s"' % resource.url.rsplit("/")[-1], resource.etag)
+
+        list(crawler.fetch_resources(Resource.query.all()))
+        db.session.expire_all()
+        for resource in Resource.query:
+            self.assertEquals(304, resource.last_status_code)
+            self.assertTrue(resource.document)
+            headers = self.server.headers["/" + resource.url.rsplit("/")[-1]]
+            self.assertEquals(resource.etag, headers["if-none-match"])
+            self.assertIn("if-modified-since", headers)
+
+    def test_documents_command(self):
+        fac.DatasetFactory.create(name=u"tst", resources=[
+            fac.ResourceFactory.create(url=self.server.url("127.0.0.1", "a"))])
+        crawler.documents(threads=2)
+        self.assertEquals(200, Resource.query.get(
+            self.server.url("127.0.0.1", "a")).last_status_code)
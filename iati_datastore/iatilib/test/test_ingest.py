@@ -0,0 +1,298 @@
+import os
+import resource
+import shutil
+import tempfile
+
+from lxml import etree as ET
+
+from . import AppTestCase, fixture_filename
+from . import factories as fac
+
+from iatilib import crawler, db, ingest, parse
+from iatilib.model import (
+    Activity, Transaction, SectorPercentage, CountryPercentage,
+    Participation, Budget, Organisation)
+
+
+class TestBulkWriter(AppTestCase):
+    filename = fixture_filename("complex_example_dfid.xml")
+
+    def test_same_rows_as_orm(self):
+        xml = ET.parse(self.filename)
+        ingest.BulkWriter().add_all(parse.document(self.filename))
+        db.session.commit()
+        self.assertEquals(
+            len(xml.xpath("//iati-activity")), Activity.query.count())
+        self.assertEquals(
+            len(xml.xpath("//iati-activity/transaction")),
+            Transaction.query.count())
+        self.assertEquals(
+            len(xml.xpath("//iati-activity/budget")), Budget.query.count())
+
+    def test_foreign_keys(self):
+        ingest.BulkWriter().add_all(parse.document(self.filename))
+        db.session.commit()
+        act = Activity.query.get(u"GB-CHC-285776-DRC173")
+        self.assertEquals(u"GB-CHC-285776", act.reporting_org.ref)
+        self.assertTrue(act.participating_orgs)
+        self.assertTrue(all(
+            p.organisation is not None for p in Participation.query))
+        self.assertTrue(act.transactions)
+        for trans in act.transactions:
+            self.assertEquals(act, trans.activity)
+        orgs = [(o.ref, o.name, o.type) for o in Organisation.query]
+        self.assertEquals(len(set(orgs)), len(orgs))
+
+    def test_transaction_percentages(self):
+        ingest.BulkWriter().add_all([parse.activity(u'''<iati-activity>
+              <iati-identifier>AAA-AA</iati-identifier>
+              <transaction>
+                <transaction-type code="D" />
+                <value>10</value>
+                <sector code="11110" percentage="100" />
+                <recipient-country code="AF" />
+              </transaction>
+              <transaction>
+                <transaction-type code="C" />
+                <value>20</value>
+                <sector code="11120" percentage="100" />
+              </transaction>
+            </iati-activity>''')])
+        db.session.commit()
+        by_value = dict(
+            (int(t.value_amount), t) for t in Transaction.query)
+        self.assertEquals(
+            [u"11110"], [s.sector.value for s in by_value[10].sector_percentages])
+        self.assertEquals(
+            [u"11120"], [s.sector.value for s in by_value[20].sector_percentages])
+        self.assertEquals(
+            [u"AF"],
+            [c.country.value for c in by_value[10].recipient_country_percentages])
+        self.assertEquals(
+            0, SectorPercentage.query.filter_by(activity_id=u"AAA-AA").count())
+
+    def test_defaults(self):
+        ingest.BulkWriter().add_all([parse.activity(u'''<iati-activity>
+              <iati-identifier>AAA-AA</iati-identifier>
+            </iati-activity>''')])
+        db.session.commit()
+        act = Activity.query.get(u"AAA-AA")
+        self.assertEquals(u"", act.title)
+        self.assertNotEqual(None, act.created)
+
+    def test_skip_existing(self):
+        fac.ActivityFactory.create(iati_identifier=u"AAA-AA", title=u"orig")
+        ingest.BulkWriter(skip_existing=True).add_all([
+            parse.activity(u'''<iati-activity>
+              <iati-identifier>AAA-AA</iati-identifier>
+              <title>new</title>
+            </iati-activity>''')])
+        db.session.commit()
+        self.assertEquals(u"orig", Activity.query.get(u"AAA-AA").title)
+
+
+class TestBulkParseResource(AppTestCase):
+    def test_parse_resource_bulk(self):
+        resource = fac.ResourceFactory.create(
+            url=u"http://test",
+            document=open(fixture_filename("complex_example_dfid.xml")).read())
+        resource = crawler.parse_resource(resource, bulk=True)
+        db.session.commit()
+        self.assertTrue(resource.activities.count())
+        self.assertEquals(
+            set([u"http://test"]),
+            set(a.resource_url for a in Activity.query))
+        self.assertTrue(CountryPercentage.query.count())
+
+
+class TestStagingSwap(AppTestCase):
+    BEFORE = """<iati-activities>
+      <iati-activity>
+        <iati-identifier>same</iati-identifier>
+        <title>same</title>
+      </iati-activity>
+      <iati-activity>
+        <iati-identifier>changed</iati-identifier>
+        <title>before</title>
+        <transaction>
+          <transaction-type code="D" /><value>10</value>
+          <sector code="11110" percentage="100" />
+        </transaction>
+        <transaction>
+          <transaction-type code="C" /><value>20</value>
+        </transaction>
+        <budget><value>5</value></budget>
+      </iati-activity>
+      <iati-activity>
+        <iati-identifier>removed</iati-identifier>
+        <transaction><transaction-type code="D" /><value>30</value></transaction>
+      </iati-activity>
+    </iati-activities>"""
+
+    AFTER = """<iati-activities>
+      <iati-activity>
+        <iati-identifier>same</iati-identifier>
+        <title>same</title>
+      </iati-activity>
+      <iati-activity>
+        <iati-identifier>changed</iati-identifier>
+        <title>after</title>
+        <transaction>
+          <transaction-type code="D" /><value>40</value>
+          <sector code="11120" percentage="100" />
+        </transaction>
+      </iati-activity>
+    </iati-activities>"""
+
+    def parse(self, resource, document):
+        resource.document = document
+        crawler.parse_resource(resource, swap=True)
+        db.session.commit()
+
+    def test_activity_tables(self):
+        names = [t.name for t in ingest.activity_tables()]
+        self.assertEquals("activity", names[0])
+        self.assertLess(names.index("transaction"),
+                        names.index("sector_percentage"))
+        self.assertIn("budget", names)
+        self.assertNotIn("organisation", names)
+        self.assertNotIn("resource", names)
+
+    def test_parse_resource_swap(self):
+        resource = fac.ResourceFactory.create(url=u"http://test")
+        self.parse(resource, open(fixture_filename("complex_example_dfid.xml")).read())
+        xml = ET.parse(fixture_filename("complex_example_dfid.xml"))
+        self.assertEquals(
+            len(xml.xpath("//iati-activity")), resource.activities.count())
+        self.assertEquals(
+            len(xml.xpath("//iati-activity/transaction")),
+            Transaction.query.count())
+        self.assertTrue(CountryPercentage.query.count())
+        act = Activity.query.get(u"GB-CHC-285776-DRC173")
+        self.assertEquals(u"GB-CHC-285776", act.reporting_org.ref)
+
+    def test_swap_replaces(self):
+        resource = fac.ResourceFactory.create(url=u"http://test")
+        self.parse(resource, self.BEFORE)
+        db.session.query(Activity).update(
+            values={'title': u"stored"}, synchronize_session=False)
+        db.session.commit()
+        self.parse(resource, self.AFTER)
+        # unchanged activities are not rewritten
+        self.assertEquals(u"stored", Activity.query.get(u"same").title)
+        self.assertEquals(u"after", Activity.query.get(u"changed").title)
+        self.assertEquals(None, Activity.query.get(u"removed"))
+        self.assertEquals(
+            [40], [int(t.value_amount) for t in Transaction.query])
+        self.assertEquals(0, Budget.query.count())
+        self.assertEquals(
+            [u"11120"], [s.sector.value for s in SectorPercentage.query])
+
+    def test_swap_twice(self):
+        resource = fac.ResourceFactory.create(url=u"http://test")
+        self.parse(resource, self.BEFORE)
+        self.parse(resource, self.AFTER)
+        self.parse(resource, self.BEFORE)
+        self.assertEquals(3, Activity.query.count())
+        self.assertEquals(
+            [10, 20, 30],
+            sorted(int(t.value_amount) for t in Transaction.query))
+        self.assertEquals(1, SectorPercentage.query.count())
+
+    def test_other_resources_untouched(self):
+        fac.ResourceFactory.create(
+            url=u"http://other",
+            activities=[
+                fac.ActivityFactory.build(iati_identifier=u"changed", title=u"orig"),
+                fac.ActivityFactory.build(iati_identifier=u"elsewhere"),
+            ])
+        resource = fac.ResourceFactory.create(url=u"http://test")
+        self.parse(resource, self.BEFORE)
+        self.parse(resource, self.AFTER)
+        self.assertEquals(u"orig", Activity.query.get(u"changed").title)
+        self.assertEquals(u"http://other", Activity.query.get(u"changed").resource_url)
+        self.assertTrue(Activity.query.get(u"elsewhere"))
+        self.assertEquals([u"same"], [a.iati_identifier for a in resource.activities])
+
+
+STREAM_ACTIVITY = (
+    '<iati-activity><iati-identifier>GB-1-{0}</iati-identifier>'
+    '<title>Activity {0}</title><description>{1}</description>'
+    '<transaction><transaction-type code="D"/><value>10</value>'
+    '<transaction-date iso-date="2012-01-01"/></transaction>'
+    '</iati-activity>\n')
+
+
+def write_activities(path, count=None, size=None):
+    """Write a 1.03 document of `count` activities, or of `size` bytes"""
+    padding = 'x' * 200
+    written = 0
+    with open(path, 'wb') as f:
+        f.write('<iati-activities version="1.03">\n')
+        while (count is None or written < count) and \
+                (size is None or f.tell() < size):
+            f.write(STREAM_ACTIVITY.format(written, padding))
+            written += 1
+        f.write('</iati-activities>\n')
+    return written
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+class TestStreaming(AppTestCase):
+    # IATI_MEMORY_TEST_MB=500 for the full size check
+    size_mb = int(os.environ.get('IATI_MEMORY_TEST_MB', 50))
+
+    def setUp(self):
+        super(TestStreaming, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "stream.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestStreaming, self).tearDown()
+
+    def test_activity_elements_flat_memory(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("needs /proc to measure rss")
+        count = write_activities(self.path, size=self.size_mb * 1024 * 1024)
+        start = peak = rss()
+        seen = 0
+        with open(self.path, 'rb') as f:
+            for elem, major_version, version in parse.activity_elements(f):
+                seen += 1
+                if seen % 1000 == 0:
+                    peak = max(peak, rss())
+        self.assertEquals(count, seen)
+        # keeping the cleared elements costs ~15MB per 50MB of document
+        self.assertLess(peak - start, 8 * 1024 * 1024)
+
+    def test_processed_activities_removed_from_tree(self):
+        write_activities(self.path, count=10)
+        with open(self.path, 'rb') as f:
+            for elem, major_version, version in parse.activity_elements(f):
+                # only the previous, cleared, activity is left before it
+                self.assertLessEqual(elem.getparent().index(elem), 1)
+
+    def test_store_chunks(self):
+        write_activities(self.path, count=25)
+        sizes = []
+
+        def activities():
+            for activity in parse.document(open(self.path, 'rb')):
+                sizes.append(len(db.session.identity_map) + len(db.session.new))
+                yield activity
+
+        ingest.store(activities(), chunk_size=10)
+        self.assertEquals(25, Activity.query.count())
+        self.assertLess(max(sizes), 40)
+
+    def test_store_chunks_bulk(self):
+        write_activities(self.path, count=25)
+        ingest.store(
+            parse.document(open(self.path, 'rb')), bulk=True, chunk_size=10)
+        self.assertEquals(25, Activity.query.count())
+        self.assertEquals(25, Transaction.query.count())
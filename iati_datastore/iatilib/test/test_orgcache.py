@@ -0,0 +1,149 @@
+import mock
+from redis.exceptions import ConnectionError
+
+from . import AppTestCase
+
+from iatilib import db, orgcache, codelists as cl
+from iatilib.model import Organisation
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key] = str(value)
+
+
+class TestLRU(AppTestCase):
+    def test_evicts_least_recently_used(self):
+        lru = orgcache.LRU(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEquals(None, lru.get("b"))
+        self.assertEquals(1, lru.get("a"))
+        self.assertEquals(3, lru.get("c"))
+        self.assertEquals(2, len(lru))
+
+
+class TestOrganisationIdCache(AppTestCase):
+    def setUp(self):
+        super(TestOrganisationIdCache, self).setUp()
+        self.cache = orgcache.OrganisationIdCache(size=100, use_redis=False)
+
+    def org(self, ref=u"GB-1", name=u"DFID", type=cl.OrganisationType.government):
+        return self.cache.organisation(db.session, ref=ref, name=name, type=type)
+
+    def test_inserts(self):
+        org = self.org()
+        db.session.commit()
+        self.assertEquals(
+            [(org.id, u"GB-1", u"DFID", cl.OrganisationType.government)],
+            [(o.id, o.ref, o.name, o.type) for o in Organisation.query.all()])
+
+    def test_finds_existing(self):
+        existing = Organisation(ref=u"GB-1", name=u"DFID",
+                                type=cl.OrganisationType.government)
+        db.session.add(existing)
+        db.session.commit()
+        self.assertEquals(existing.id, self.org().id)
+        self.assertEquals(1, Organisation.query.count())
+
+    def test_cached_across_sessions(self):
+        id = self.org().id
+        db.session.commit()
+        db.session.remove()
+        with mock.patch.object(orgcache, "_select_id") as select:
+            self.assertEquals(id, self.org().id)
+        self.assertFalse(select.called)
+        self.assertEquals({"hits": 1, "redis_hits": 0, "misses": 1, "size": 1},
+                          self.cache.stats())
+
+    def test_same_transaction(self):
+        self.assertIs(self.org(), self.org())
+        db.session.commit()
+        self.assertEquals(1, Organisation.query.count())
+
+    def test_rollback_not_cached(self):
+        self.org()
+        db.session.rollback()
+        self.assertEquals(0, len(self.cache.lru))
+        self.org()
+        db.session.commit()
+        self.assertEquals(1, Organisation.query.count())
+
+    def test_distinct_keys(self):
+        self.org()
+        self.org(type=None)
+        self.org(name=u"Department for International Development")
+        db.session.commit()
+        self.assertEquals(3, Organisation.query.count())
+
+    def test_insert_conflict(self):
+        db.session.add(Organisation(ref=u"GB-1", name=u"DFID",
+                                    type=cl.OrganisationType.government))
+        db.session.commit()
+        self.assertEquals(None, orgcache._insert(
+            db.session, (u"GB-1", u"DFID", cl.OrganisationType.government.value)))
+
+    def test_concurrent_insert(self):
+        # another worker inserts the organisation between the select and insert
+        other = Organisation(ref=u"GB-1", name=u"DFID",
+                             type=cl.OrganisationType.government)
+        db.session.add(other)
+        db.session.commit()
+        with mock.patch.object(orgcache, "_select_id",
+                               side_effect=[None, other.id]):
+            self.assertEquals(other.id, self.org().id)
+        self.assertEquals(1, Organisation.query.count())
+
+    def test_attached_to_session(self):
+        id = self.org().id
+        db.session.commit()
+        db.session.remove()
+        org = self.org()
+        self.assertIn(org, db.session)
+        self.assertFalse(db.session.dirty)
+        self.assertEquals(id, org.id)
+
+    def test_expired_not_reloaded(self):
+        org = self.org()
+        db.session.commit()
+        self.assertIs(org, self.org())
+        # loading any of them would be a SELECT per organisation
+        self.assertEquals(
+            (u"GB-1", u"DFID", cl.OrganisationType.government),
+            tuple(org.__dict__.get(k) for k in ("ref", "name", "type")))
+
+
+class TestRedisLayer(AppTestCase):
+    def setUp(self):
+        super(TestRedisLayer, self).setUp()
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(orgcache, "redis", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def org(self, cache):
+        return cache.organisation(db.session, ref=u"GB-1", name=u"DFID")
+
+    def test_shared_between_workers(self):
+        id = self.org(orgcache.OrganisationIdCache(use_redis=True)).id
+        db.session.commit()
+        other = orgcache.OrganisationIdCache(use_redis=True)
+        self.assertEquals(id, self.org(other).id)
+        self.assertEquals(1, other.redis_hits)
+        self.assertEquals(0, other.misses)
+
+    def test_redis_down(self):
+        cache = orgcache.OrganisationIdCache(use_redis=True)
+        self.redis.hget = self.redis.hset = mock.Mock(side_effect=ConnectionError)
+        org = self.org(cache)
+        db.session.commit()
+        self.assertEquals(1, cache.misses)
+        self.assertEquals(org.id, Organisation.query.one().id)
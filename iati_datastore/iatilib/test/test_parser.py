@@ -1,15 +1,20 @@
 import os
 import codecs
 import datetime
+import hashlib
+import json
 from decimal import Decimal
+from StringIO import StringIO
 from unittest import TestCase, skip
 
 import mock
+from dateutil.parser import parse as parse_date
 from lxml import etree as ET
 
 from iatilib.test import db, AppTestCase, fixture_filename
 from iatilib import parse, codelists as cl
 from iatilib import model
+from iatilib.loghandlers import DatasetMessage as _
 cl2 = cl.by_major_version['2']
 
 
@@ -255,6 +260,11 @@ class TestParse2xxActivity(AppTestCase):
         norm_xml = ET.tostring(ET.parse(fixture_filename("2.01-example-annotated.xml")).find('iati-activity'), encoding=unicode).strip(u'\n ')
         self.assertEquals(norm_xml, self.act.raw_xml)
 
+    def test_raw_xml_hash(self):
+        self.assertEquals(
+            hashlib.md5(self.act.raw_xml.encode('utf-8')).hexdigest(),
+            self.act.raw_xml_hash)
+
 
     def test_budget(self):
         self.assertEquals(1, len(self.act.budgets))
@@ -513,6 +523,180 @@ class TestParseActivity(AppTestCase):
 
 
 
+class TestRawXml(AppTestCase):
+    ACTIVITY = """<iati-activity default-currency='GBP'
+    ><iati-identifier>A</iati-identifier><title></title></iati-activity>"""
+
+    def test_serialized(self):
+        act, = parse.document(
+            "<iati-activities>%s</iati-activities>" % self.ACTIVITY)
+        self.assertEquals(
+            u'<iati-activity default-currency="GBP"><iati-identifier>A'
+            u'</iati-identifier><title/></iati-activity>', act.raw_xml)
+        self.assertEquals(parse.raw_xml_hash(act.raw_xml), act.raw_xml_hash)
+
+    def test_independent_of_document(self):
+        # change detection compares the hash across reparses, so it mustn't
+        # depend on the activities around it or how the document is read
+        big = "<iati-activity><iati-identifier>%s</iati-identifier></iati-activity>" % ("B" * 2000)
+        docs = [
+            "<iati-activities>%s</iati-activities>" % self.ACTIVITY,
+            "<iati-activities>%s%s</iati-activities>" % (big, self.ACTIVITY),
+            "<iati-activities>\n<!-- x -->%s\n%s</iati-activities>" % (self.ACTIVITY, big),
+            """<!DOCTYPE iati-activities [<!ENTITY org "DFID">]>
+<iati-activities><iati-activity><title>&org;</title></iati-activity>%s</iati-activities>""" % self.ACTIVITY,
+        ]
+        hashes = set()
+        for doc in docs:
+            for source in [doc, StringIO(doc)]:
+                for act in parse.document(source):
+                    if act.iati_identifier == u"A":
+                        hashes.add(act.raw_xml_hash)
+        self.assertEquals(1, len(hashes))
+
+    def test_inherited_namespaces(self):
+        doc = """<iati-activities xmlns:foo="http://foo">
+  <iati-activity foo:x="1"><iati-identifier>A</iati-identifier></iati-activity>
+</iati-activities>"""
+        act, = parse.document(doc)
+        self.assertEquals("1", ET.fromstring(act.raw_xml).get("{http://foo}x"))
+
+    def test_utf16(self):
+        doc = u"""<?xml version="1.0" encoding="UTF-16"?>
+<iati-activities><iati-activity><iati-identifier>A</iati-identifier></iati-activity></iati-activities>"""
+        act, = parse.document(doc.encode("utf-16"))
+        self.assertEquals(
+            u"<iati-activity><iati-identifier>A</iati-identifier></iati-activity>",
+            act.raw_xml)
+
+    def test_internal_dtd(self):
+        doc = """<?xml version="1.0"?>
+<!DOCTYPE iati-activities [<!ENTITY org "DFID &amp; Co">]>
+<iati-activities>
+  <iati-activity><iati-identifier>A</iati-identifier><title>&org;</title></iati-activity>
+</iati-activities>"""
+        act, = parse.document(doc)
+        self.assertEquals(u"DFID & Co", ET.fromstring(act.raw_xml).findtext("title"))
+
+
+class TestDocument(AppTestCase):
+    def test_version(self):
+        doc = parse.document(fixture_filename("2.01-example-annotated.xml"))
+        list(doc)
+        self.assertEquals("2.01", doc.version)
+        self.assertEquals("2", doc.major_version)
+
+    def test_no_version(self):
+        doc = parse.document("<iati-activities />")
+        self.assertEquals([], list(doc))
+        self.assertEquals(None, doc.version)
+        self.assertEquals("1", doc.major_version)
+
+    def test_counts(self):
+        doc = parse.document("""<iati-activities version="1.03">
+  <iati-activity>
+    <iati-identifier>AAA-AA</iati-identifier>
+    <activity-date type="start-planned" iso-date="2012-13-45" />
+  </iati-activity>
+  <iati-activity />
+  <iati-activity><iati-identifier>BBB-BB</iati-identifier></iati-activity>
+</iati-activities>""")
+        self.assertEquals(
+            [u"AAA-AA", u"BBB-BB"], [a.iati_identifier for a in doc])
+        self.assertEquals(2, doc.activity_count)
+        # the bad date and the activity without an identifier
+        self.assertEquals(2, doc.warning_count)
+        self.assertGreater(doc.seconds, 0)
+
+    def test_warnings_outside_parsing_not_counted(self):
+        doc = parse.document(fixture_filename("default_currency.xml"))
+        for act in doc:
+            parse.log.warn(_(u"not the parser's", logger="test"))
+        self.assertEquals(0, doc.warning_count)
+        self.assertNotIn(doc._warnings, parse.log.handlers)
+
+
+class TestSniffedDocument(AppTestCase):
+    def test_rejected(self):
+        self.assertRaises(parse.RejectedDocument, parse.document,
+                          "<html><body>Server Error</body></html>")
+
+    def test_rejected_before_parsing(self):
+        with mock.patch.object(parse, "Document") as document:
+            self.assertRaises(parse.RejectedDocument, parse.document, "")
+        self.assertFalse(document.called)
+
+    def test_mislabelled_utf16(self):
+        act, = parse.document(u"""<?xml version="1.0" encoding="UTF-16"?>
+<iati-activities><iati-activity>
+  <iati-identifier>A</iati-identifier><title>Caf\xe9</title>
+</iati-activity></iati-activities>""".encode("utf-8"))
+        self.assertEquals(u"Caf\xe9", act.title)
+        self.assertIn(u"<title>Caf\xe9</title>", act.raw_xml)
+
+    def test_undeclared_single_byte(self):
+        act, = parse.document(u"""<iati-activities><iati-activity>
+  <iati-identifier>A</iati-identifier>
+  <title>Programme d'appui \xe0 la soci\xe9t\xe9 civile et \xe0 la
+  d\xe9centralisation, r\xe9gion de S\xe9gou</title>
+</iati-activity></iati-activities>""".encode("iso-8859-1"))
+        self.assertIn(u"d\xe9centralisation", act.title)
+        self.assertIn(u"d\xe9centralisation", act.raw_xml)
+
+    def test_verdict_on_document(self):
+        doc = parse.document(u"""<?xml version="1.0" encoding="ISO-8859-1"?>
+<iati-activities/>""".encode("iso-8859-1"))
+        self.assertEquals("ISO-8859-1", doc.verdict.encoding)
+        self.assertEquals(None, doc.verdict.override)
+
+
+class TestProfiling(AppTestCase):
+    DOC = """<iati-activities>
+  <iati-activity>
+    <iati-identifier>A</iati-identifier>
+    <transaction><value>1</value></transaction>
+    <transaction><value>2</value></transaction>
+  </iati-activity>
+  <iati-activity>
+    <iati-identifier>B</iati-identifier>
+    <transaction><value>3</value></transaction>
+  </iati-activity>
+</iati-activities>"""
+
+    def test_counts_calls(self):
+        with parse.profiling() as profile:
+            list(parse.document(self.DOC))
+        self.assertEquals(2, profile.calls["activity.transactions"])
+        self.assertEquals(3, profile.calls["transaction.value_amount"])
+        self.assertGreater(profile.seconds["activity.transactions"],
+                           profile.seconds["transaction.value_amount"])
+
+    def test_unwrapped_after(self):
+        functions = parse.FIELDS['1']['activity'].copy()
+        with parse.profiling():
+            self.assertNotEqual(functions, parse.FIELDS['1']['activity'])
+        self.assertEquals(functions, parse.FIELDS['1']['activity'])
+        self.assertEquals(None, parse.field_profile)
+
+    def test_disabled(self):
+        functions = parse.FIELDS['1']['activity'].copy()
+        with parse.profiling(False) as profile:
+            self.assertEquals(functions, parse.FIELDS['1']['activity'])
+        self.assertEquals(None, profile)
+
+    def test_report_ranked(self):
+        profile = parse.FieldProfile()
+        for key, seconds in [("activity.budgets", 0.5), ("activity.transactions", 1.5)]:
+            profile.calls[key], profile.seconds[key] = 2, seconds
+        lines = profile.report().splitlines()
+        self.assertIn("activity.transactions", lines[1])
+        self.assertIn("activity.budgets", lines[2])
+        self.assertEquals(
+            [{"field": "activity.transactions", "calls": 2, "seconds": 1.5},
+             {"field": "activity.budgets", "calls": 2, "seconds": 0.5}],
+            json.loads(profile.to_json()))
+
+
 class TestFunctional(AppTestCase):
     def test_save_parsed_activity(self):
         act = parse.activity(fixture("default_currency.xml"))
@@ -724,6 +908,29 @@ class TestActivity(AppTestCase):
                 '''))
         self.assertEquals(0, len(list(activities)))
 
+    def test_element_in_document(self):
+        # an element still attached to its <iati-activities> tree parses
+        # the same as the serialized activity on its own
+        doc = ET.XML(
+            u'''<iati-activities>
+                  <iati-activity default-currency="GBP">
+                    <iati-identifier>AAA-AA</iati-identifier>
+                    <reporting-org ref="GB-2" type="15">CDC Group plc</reporting-org>
+                    <sector code="11130" percentage="100" />
+                  </iati-activity>
+                  <iati-activity>
+                    <iati-identifier>AAA-BB</iati-identifier>
+                  </iati-activity>
+                </iati-activities>''')
+        ele = doc.find('iati-activity')
+        from_element = parse.activity(ele)
+        from_string = parse.activity(ET.tostring(ele, with_tail=False))
+        self.assertEquals(from_string.raw_xml, from_element.raw_xml)
+        self.assertEquals(u"AAA-AA", from_element.iati_identifier)
+        self.assertEquals(cl.Currency.pound_sterling, from_element.default_currency)
+        self.assertEquals(1, len(from_element.sector_percentages))
+        self.assertNotIn(u"AAA-BB", from_element.raw_xml)
+
     def test_dates(self):
         activities = list(parse.document(fixture_filename("CD.xml")))
         self.assertEquals(datetime.date(2004, 1, 1), activities[0].start_planned)
@@ -943,6 +1150,37 @@ class TestDates(TestCase):
             datetime.date(2010, 1, 2),
             parse.iati_date("2010-01-02-06:00"))
 
+    def test_iso_datetime(self):
+        for value in ["2010-01-02T10:20", "2010-01-02T10:20:30",
+                      "2010-01-02T10:20:30.123Z", "2010-01-02 10:20:30+01:00"]:
+            self.assertEquals(datetime.date(2010, 1, 2), parse.iati_date(value))
+
+    def test_fast_path_matches_dateutil(self):
+        for value in ["2010-01-02", " 2010-01-02 ", "2010-01-02T23:59:59-05:00",
+                      "2010-01-02Z"]:
+            parse._date_cache.clear()
+            self.assertEquals(
+                parse_date(value, fuzzy=True).date(), parse.iati_date(value))
+
+    def test_invalid_date(self):
+        with self.assertRaises(parse.InvalidDateError):
+            parse.iati_date("2012-13-45")
+
+    def test_invalid_time(self):
+        for value in ["2012-01-01T25:99:00", "2012-01-01T24:00:00",
+                      "2012-01-01T12:60", "2012-01-01T23:59:60"]:
+            with self.assertRaises(parse.InvalidDateError):
+                parse.iati_date(value)
+
+    def test_cache_bounded(self):
+        parse._date_cache.clear()
+        with mock.patch.object(parse, 'DATE_CACHE_SIZE', 10):
+            for day in range(1, 29):
+                parse.iati_date("2010-01-%02d" % day)
+            self.assertLessEqual(len(parse._date_cache), 10)
+            self.assertEquals(
+                datetime.date(2010, 1, 28), parse.iati_date("2010-01-28"))
+
 
 class TestValue(TestCase):
     def test_thousand_sep(self):
@@ -970,3 +1208,12 @@ class TestXVal(TestCase):
             None,
             parse.xval(ET.XML(u"<foo />"), "bar", None))
 
+    def test_compiled_xpath(self):
+        xpath = parse.compiled_xpath("@ref")
+        self.assertIs(xpath, parse.compiled_xpath("@ref"))
+        self.assertEquals(u"a", parse.xval(ET.XML(u'<foo ref="a" />'), xpath))
+
+    def test_xpaths_per_major_version(self):
+        ele = ET.XML(u'<foo>text<narrative>narrative</narrative></foo>')
+        self.assertEquals(u"text", parse.xval(ele, parse.XPATHS['1']['text']))
+        self.assertEquals(u"narrative", parse.xval(ele, parse.XPATHS['2']['text']))
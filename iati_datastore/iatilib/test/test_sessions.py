@@ -0,0 +1,59 @@
+import os
+from unittest import TestCase
+
+import mock
+import requests
+
+from .test_fetcher import PublisherServer, hosts
+
+from iatilib import crawler, fetcher, sessions
+
+
+class TestSessions(TestCase):
+    def setUp(self):
+        self.server = PublisherServer(keep_alive=True)
+        self.addCleanup(self.server.stop)
+        sessions.stats.clear()
+
+    def test_reuses_connections(self):
+        session = sessions.new_session()
+        for i in range(20):
+            self.assertEquals(
+                200, session.get(self.server.url("127.0.0.1", i)).status_code)
+        self.assertEquals(
+            {"requests": 20, "connections": 1, "reused": 19},
+            sessions.stats.stats())
+
+    def test_fetcher_reuses_connections(self):
+        session = sessions.new_session(pool_size=2)
+        requests = [(i, self.server.url(host, i), {})
+                    for i, host in enumerate(hosts(2) * 20)]
+        results = list(fetcher.Fetcher(threads=8, per_host=2, get=session.get)
+                       .fetch(requests))
+        self.assertEquals(40, len(results))
+        stats = sessions.stats.stats()
+        self.assertEquals(40, stats["requests"])
+        self.assertLessEqual(stats["connections"], 4)
+        self.assertGreaterEqual(stats["reused"], 36)
+
+    def test_accept_encoding(self):
+        sessions.new_session().get(self.server.url("127.0.0.1", "gz"))
+        self.assertIn("gzip", self.server.headers["/gz"]["accept-encoding"])
+
+    def test_default_timeout(self):
+        slow = PublisherServer(delay=0.5, keep_alive=True)
+        self.addCleanup(slow.stop)
+        session = sessions.new_session(timeout=(1, 0.1))
+        self.assertRaises(requests.Timeout, session.get, slow.url("127.0.0.1", "a"))
+        self.assertEquals(
+            200, session.get(slow.url("127.0.0.1", "b"), timeout=5).status_code)
+
+    def test_session_per_process(self):
+        session = sessions.session()
+        self.assertIs(session, sessions.session())
+        with mock.patch.object(sessions.os, "getpid", return_value=os.getpid() + 1):
+            forked = sessions.session()
+        self.assertIsNot(session, forked)
+
+    def test_registry_uses_session(self):
+        self.assertEquals(sessions.session().get, crawler.registry.session.get)
@@ -0,0 +1,128 @@
+import codecs
+from StringIO import StringIO
+from unittest import TestCase
+
+from iatilib import sniff
+
+DOC = u"""<?xml version="1.0" encoding="%s"?>
+<iati-activities version="2.01">
+  <iati-activity><iati-identifier>A</iati-identifier></iati-activity>
+</iati-activities>"""
+
+
+class TestEncoding(TestCase):
+    def test_utf8(self):
+        self.assertEquals(sniff.accept("UTF-8"),
+                          sniff.sniff((DOC % "UTF-8").encode("utf-8")))
+
+    def test_undeclared(self):
+        self.assertEquals(sniff.accept("UTF-8"),
+                          sniff.sniff("<iati-activities />"))
+
+    def test_declared(self):
+        self.assertEquals(
+            sniff.accept("ISO-8859-1"),
+            sniff.sniff((DOC % "ISO-8859-1").encode("iso-8859-1")))
+
+    def test_boms(self):
+        for encoding, bom in [("UTF-8", codecs.BOM_UTF8),
+                              ("UTF-16LE", codecs.BOM_UTF16_LE),
+                              ("UTF-16BE", codecs.BOM_UTF16_BE),
+                              ("UTF-32LE", codecs.BOM_UTF32_LE)]:
+            head = bom + (DOC % "UTF-16").encode(encoding.replace("LE", "-LE")
+                                                  .replace("BE", "-BE"))
+            verdict = sniff.sniff(head)
+            self.assertTrue(verdict.accept)
+            self.assertEquals(encoding, verdict.encoding)
+
+    def test_bom_contradicts_declaration(self):
+        verdict = sniff.sniff(codecs.BOM_UTF8 + (DOC % "UTF-16").encode("utf-8"))
+        self.assertEquals(sniff.accept("UTF-8", "UTF-8"), verdict)
+
+    def test_utf16_without_bom(self):
+        self.assertEquals(sniff.accept("UTF-16LE"),
+                          sniff.sniff((DOC % "UTF-16").encode("utf-16-le")))
+
+    def test_mislabelled_utf16(self):
+        self.assertEquals(sniff.accept("UTF-8", "UTF-8"),
+                          sniff.sniff((DOC % "UTF-16").encode("utf-8")))
+
+    def test_undeclared_single_byte(self):
+        head = (u"<iati-activities><iati-activity><title>" +
+                u"Soci\xe9t\xe9 civile \xe0 S\xe9gou, d\xe9centralisation " * 20 +
+                u"</title></iati-activity></iati-activities>").encode("iso-8859-1")
+        verdict = sniff.sniff(head)
+        self.assertTrue(verdict.accept)
+        self.assertEquals(verdict.encoding, verdict.override)
+        self.assertEquals(u"\xe9", "\xe9".decode(verdict.override))
+
+    def test_character_cut_at_end_of_head(self):
+        head = (u"<iati-activities>" + u"\xe9" * sniff.SNIFF_BYTES).encode("utf-8")
+        self.assertEquals(sniff.accept("UTF-8"),
+                          sniff.sniff(head[:sniff.SNIFF_BYTES]))
+
+    def test_unknown_encoding(self):
+        verdict = sniff.sniff((DOC % "X-NOT-AN-ENCODING").encode("utf-8"))
+        self.assertFalse(verdict.accept)
+        self.assertEquals(u"Unknown encoding X-NOT-AN-ENCODING", verdict.reason)
+
+
+class TestContent(TestCase):
+    def assertRejected(self, reason, head):
+        self.assertEquals(sniff.reject(reason, "UTF-8"), sniff.sniff(head))
+
+    def test_empty(self):
+        self.assertRejected(u"Empty document", "")
+
+    def test_whitespace(self):
+        self.assertRejected(u"Empty document", " \r\n\t")
+
+    def test_html(self):
+        self.assertRejected(u"HTML document",
+                            "<!DOCTYPE html>\n<html><body>Not Found</body></html>")
+
+    def test_html_without_doctype(self):
+        self.assertRejected(u"HTML document", "\n<HTML><BODY>Error</BODY></HTML>")
+
+    def test_not_xml(self):
+        self.assertRejected(u"Not an XML document", '{"error": "Not Found"}')
+
+    def test_other_root(self):
+        self.assertRejected(
+            u"Root element <iati-organisations> is not <iati-activities>",
+            '<?xml version="1.0"?>\n<iati-organisations version="2.01"/>')
+
+    def test_prolog(self):
+        self.assertEquals(sniff.accept("UTF-8"), sniff.sniff(
+            '<?xml version="1.0"?>\n<!-- <html> -->\n<?pi x?>\n'
+            '<!DOCTYPE iati-activities [<!ENTITY a "b">]>\n<iati-activities/>'))
+
+    def test_prefixed_root(self):
+        self.assertEquals(sniff.accept("UTF-8"), sniff.sniff(
+            '<i:iati-activities xmlns:i="urn:x"/>'))
+
+    def test_prolog_past_head(self):
+        head = "<!-- " + "x" * sniff.SNIFF_BYTES
+        self.assertEquals(sniff.accept("UTF-8"),
+                          sniff.sniff(head[:sniff.SNIFF_BYTES]))
+
+    def test_root_cut_at_end_of_head(self):
+        head = " " * (sniff.SNIFF_BYTES - 8) + "<iati-ac"
+        self.assertEquals(sniff.accept("UTF-8"), sniff.sniff(head))
+
+
+class TestSniffFile(TestCase):
+    def test_position_kept(self):
+        f = StringIO("<html/>")
+        self.assertFalse(sniff.sniff_file(f).accept)
+        self.assertEquals(0, f.tell())
+
+    def test_unseekable(self):
+        class Pipe(object):
+            def tell(self):
+                raise IOError("Illegal seek")
+
+            def read(self, size=-1):
+                raise AssertionError("read")
+
+        self.assertEquals(sniff.accept(), sniff.sniff_file(Pipe()))
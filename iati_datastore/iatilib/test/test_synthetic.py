@@ -0,0 +1,73 @@
+import os
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from . import AppTestCase
+
+from iatilib import bench, parse, synthetic
+
+
+class TestParseSize(TestCase):
+    def test_units(self):
+        self.assertEquals(512, synthetic.parse_size("512"))
+        self.assertEquals(500 * 1024, synthetic.parse_size("500KB"))
+        self.assertEquals(1024 ** 2, synthetic.parse_size("1MB"))
+        self.assertEquals(1024 ** 3, synthetic.parse_size("1gb"))
+        self.assertEquals(1536 * 1024, synthetic.parse_size("1.5M"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, synthetic.parse_size, "large")
+
+
+class TestGenerator(AppTestCase):
+    def generate(self, size=64 * 1024, version="2.03", seed=0):
+        f = StringIO()
+        count = synthetic.write(f, size, version, seed)
+        return count, f.getvalue()
+
+    def test_size(self):
+        count, data = self.generate()
+        self.assertGreaterEqual(len(data), 64 * 1024)
+        self.assertEquals(count, data.count("</iati-activity>"))
+
+    def test_at_least_one_activity(self):
+        count, data = self.generate(size=0)
+        self.assertEquals(1, count)
+
+    def test_count(self):
+        f = StringIO()
+        self.assertEquals(3, synthetic.write(f, count=3))
+        self.assertEquals(3, f.getvalue().count("</iati-activity>"))
+
+    def test_repeatable(self):
+        self.assertEquals(self.generate(), self.generate())
+        self.assertNotEquals(self.generate(), self.generate(seed=1))
+
+    def test_parses_cleanly(self):
+        for version in ["1.05", "2.03"]:
+            count, data = self.generate(version=version)
+            document = parse.document(data)
+            activities = list(document)
+            self.assertEquals(version, document.version)
+            self.assertEquals(count, len(activities))
+            self.assertEquals(0, document.warning_count)
+            for activity in activities:
+                self.assertTrue(activity.reporting_org)
+                self.assertTrue(activity.sector_percentages)
+                self.assertTrue(activity.participating_orgs)
+                self.assertEquals(100, sum(
+                    sp.percentage for sp in activity.sector_percentages))
+            self.assertTrue(any(a.transactions for a in activities))
+
+
+class TestParseBenchmark(AppTestCase):
+    def test_time_document(self):
+        fd, filename = tempfile.mkstemp(suffix=".xml")
+        self.addCleanup(os.remove, filename)
+        with os.fdopen(fd, "wb") as f:
+            count = synthetic.write(f, 16 * 1024)
+        for in_memory in (False, True):
+            document = bench.time_document(filename, in_memory)
+            self.assertEquals(count, document.activity_count)
+            self.assertGreater(document.seconds, 0)